@@ -0,0 +1,421 @@
+"""
+Schema bootstrap for the AspAIra DynamoDB tables.
+Core functionality:
+1. Describe every table the application uses
+2. Create missing tables and wait for them to become active
+3. Add global secondary indexes that exist in the definitions but not yet in AWS
+   and turn on TTL where a table defines a TTL attribute
+4. Safe to run repeatedly; existing tables and indexes are left untouched
+5. Optionally rebuild the conversation summaries from the chats table
+6. Optionally add quiz turns written before the QuizIndex existed to that index
+7. Optionally queue conversations that have never been evaluated
+8. Optionally replay chat messages the write queue moved to its dead-letter file
+
+Run before starting the services (e.g. as a deploy step):
+    cd backend && python -m app.bootstrap [--backfill-conversations] [--backfill-quiz-index]
+        [--backfill-eval-queue] [--replay-chat-dead-letters]
+"""
+import argparse
+import sys
+import time
+from typing import Dict, List
+from botocore.exceptions import ClientError
+from .services.chat_write_queue import replay_dead_letters
+from .database import (
+    get_dynamodb,
+    summarize_chat_items,
+    USERS_TABLE,
+    CHATS_TABLE,
+    EVALUATIONS_TABLE,
+    CONVERSATIONS_TABLE,
+    EVAL_RUNS_TABLE,
+    EVAL_CHECKPOINTS_TABLE,
+    IDEMPOTENCY_TABLE,
+    USER_TIMESTAMP_INDEX,
+    USER_ACTIVITY_INDEX,
+    QUIZ_INDEX,
+    QUIZ_INTERACTION_TYPES,
+    EVAL_STATUS_INDEX,
+    EVAL_STATUS_PENDING
+)
+
+DEFAULT_THROUGHPUT = {
+    'ReadCapacityUnits': 5,
+    'WriteCapacityUnits': 5
+}
+
+TABLE_DEFINITIONS: Dict[str, Dict] = {
+    USERS_TABLE: {
+        'KeySchema': [
+            {'AttributeName': 'username', 'KeyType': 'HASH'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'username', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': []
+    },
+    CHATS_TABLE: {
+        'KeySchema': [
+            {'AttributeName': 'username', 'KeyType': 'HASH'},
+            {'AttributeName': 'message_id', 'KeyType': 'RANGE'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'username', 'AttributeType': 'S'},
+            {'AttributeName': 'message_id', 'AttributeType': 'S'},
+            {'AttributeName': 'conversation_id', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'},
+            {'AttributeName': 'quiz_username', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': [
+            {
+                'IndexName': 'ConversationIndex',
+                'KeySchema': [
+                    {'AttributeName': 'conversation_id', 'KeyType': 'HASH'},
+                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': DEFAULT_THROUGHPUT
+            },
+            {
+                # A user's messages in time order (the base table sorts by message_id)
+                'IndexName': USER_TIMESTAMP_INDEX,
+                'KeySchema': [
+                    {'AttributeName': 'username', 'KeyType': 'HASH'},
+                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': DEFAULT_THROUGHPUT
+            },
+            {
+                # Sparse: only quiz turns set quiz_username
+                'IndexName': QUIZ_INDEX,
+                'KeySchema': [
+                    {'AttributeName': 'quiz_username', 'KeyType': 'HASH'},
+                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': ['conversation_id', 'agent_id', 'interaction_type', 'quiz_data']
+                },
+                'ProvisionedThroughput': DEFAULT_THROUGHPUT
+            }
+        ]
+    },
+    EVALUATIONS_TABLE: {
+        'KeySchema': [
+            {'AttributeName': 'conversation_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'evaluation_timestamp', 'KeyType': 'RANGE'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'conversation_id', 'AttributeType': 'S'},
+            {'AttributeName': 'evaluation_timestamp', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': []
+    },
+    CONVERSATIONS_TABLE: {
+        # One summary item per conversation, maintained on every chat write
+        'KeySchema': [
+            {'AttributeName': 'username', 'KeyType': 'HASH'},
+            {'AttributeName': 'conversation_id', 'KeyType': 'RANGE'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'username', 'AttributeType': 'S'},
+            {'AttributeName': 'conversation_id', 'AttributeType': 'S'},
+            {'AttributeName': 'last_timestamp', 'AttributeType': 'S'},
+            {'AttributeName': 'eval_status', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': [
+            {
+                'IndexName': USER_ACTIVITY_INDEX,
+                'KeySchema': [
+                    {'AttributeName': 'username', 'KeyType': 'HASH'},
+                    {'AttributeName': 'last_timestamp', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': DEFAULT_THROUGHPUT
+            },
+            {
+                # Sparse evaluation queue: eval_status is removed once a conversation is evaluated
+                'IndexName': EVAL_STATUS_INDEX,
+                'KeySchema': [
+                    {'AttributeName': 'eval_status', 'KeyType': 'HASH'},
+                    {'AttributeName': 'last_timestamp', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': ['agent_id', 'eval_attempts', 'eval_lease_expires']
+                },
+                'ProvisionedThroughput': DEFAULT_THROUGHPUT
+            }
+        ]
+    },
+    EVAL_RUNS_TABLE: {
+        # One item per evaluation run: status and progress counters
+        'KeySchema': [
+            {'AttributeName': 'run_id', 'KeyType': 'HASH'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'run_id', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': []
+    },
+    EVAL_CHECKPOINTS_TABLE: {
+        # Judge results saved as they complete (checkpoint_id is conversation_id#judge_id), plus
+        # one conversation_id#manifest row per conversation the run scheduled
+        'KeySchema': [
+            {'AttributeName': 'run_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'checkpoint_id', 'KeyType': 'RANGE'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'run_id', 'AttributeType': 'S'},
+            {'AttributeName': 'checkpoint_id', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': []
+    },
+    IDEMPOTENCY_TABLE: {
+        # One reservation per (username, Idempotency-Key) of /api/chat; expires via TTL
+        'KeySchema': [
+            {'AttributeName': 'username', 'KeyType': 'HASH'},
+            {'AttributeName': 'idempotency_key', 'KeyType': 'RANGE'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'username', 'AttributeType': 'S'},
+            {'AttributeName': 'idempotency_key', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': [],
+        'TimeToLiveAttribute': 'expires_at'
+    }
+}
+
+def _describe_table(table_name: str):
+    """Return the table description, or None if the table does not exist"""
+    try:
+        return get_dynamodb().meta.client.describe_table(TableName=table_name)['Table']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
+
+def _create_table(table_name: str, definition: Dict):
+    print(f"Creating table {table_name}")
+    kwargs = {
+        'TableName': table_name,
+        'KeySchema': definition['KeySchema'],
+        'AttributeDefinitions': definition['AttributeDefinitions'],
+        'ProvisionedThroughput': DEFAULT_THROUGHPUT
+    }
+    if definition['GlobalSecondaryIndexes']:
+        kwargs['GlobalSecondaryIndexes'] = definition['GlobalSecondaryIndexes']
+    try:
+        table = get_dynamodb().create_table(**kwargs)
+        table.wait_until_exists()
+        print(f"Table {table_name} created successfully")
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceInUseException':
+            print(f"Table {table_name} already exists")
+        else:
+            raise
+
+def _wait_for_index(table_name: str, index_name: str, poll_seconds: float = 5):
+    while True:
+        description = _describe_table(table_name)
+        statuses = {
+            index['IndexName']: index['IndexStatus']
+            for index in description.get('GlobalSecondaryIndexes', [])
+        }
+        if statuses.get(index_name) == 'ACTIVE':
+            return
+        time.sleep(poll_seconds)
+
+def _add_missing_indexes(table_name: str, definition: Dict, description: Dict):
+    """Create indexes one at a time; DynamoDB allows a single index creation per update"""
+    existing = {index['IndexName'] for index in description.get('GlobalSecondaryIndexes', [])}
+    attribute_types = {a['AttributeName']: a for a in definition['AttributeDefinitions']}
+    for index in definition['GlobalSecondaryIndexes']:
+        if index['IndexName'] in existing:
+            continue
+        print(f"Adding index {index['IndexName']} to {table_name}")
+        key_attributes = [key['AttributeName'] for key in index['KeySchema']]
+        get_dynamodb().meta.client.update_table(
+            TableName=table_name,
+            AttributeDefinitions=[attribute_types[name] for name in key_attributes],
+            GlobalSecondaryIndexUpdates=[{'Create': index}]
+        )
+        _wait_for_index(table_name, index['IndexName'])
+        print(f"Index {index['IndexName']} on {table_name} is active")
+
+def _ensure_ttl(table_name: str, attribute_name: str):
+    client = get_dynamodb().meta.client
+    description = client.describe_time_to_live(TableName=table_name)['TimeToLiveDescription']
+    if description.get('TimeToLiveStatus') in ('ENABLED', 'ENABLING'):
+        return
+    print(f"Enabling TTL on {table_name}.{attribute_name}")
+    client.update_time_to_live(
+        TableName=table_name,
+        TimeToLiveSpecification={'Enabled': True, 'AttributeName': attribute_name}
+    )
+
+def ensure_tables(table_names: List[str] = None):
+    """Create missing tables and indexes; existing ones are left as they are"""
+    for table_name in table_names or TABLE_DEFINITIONS:
+        definition = TABLE_DEFINITIONS[table_name]
+        description = _describe_table(table_name)
+        if description is None:
+            _create_table(table_name, definition)
+        else:
+            print(f"Table {table_name} exists")
+            _add_missing_indexes(table_name, definition, description)
+        if definition.get('TimeToLiveAttribute'):
+            _ensure_ttl(table_name, definition['TimeToLiveAttribute'])
+
+def backfill_conversation_summaries():
+    """
+    Rebuild every conversation summary from the chats table. Summary fields
+    are set to absolute totals, so this is safe to repeat; the evaluation
+    queue and claim fields on existing conversations are left alone.
+    Conversations that got a newer message during the scan are skipped.
+    """
+    chats_table = get_dynamodb().Table(CHATS_TABLE)
+    items = []
+    scan_kwargs = {}
+    while True:
+        response = chats_table.scan(**scan_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    summaries = summarize_chat_items(items)
+    conversations_table = get_dynamodb().Table(CONVERSATIONS_TABLE)
+    skipped = 0
+    for summary in summaries:
+        # update_item rather than put_item, which would wipe eval_status, eval_attempts and the claim
+        try:
+            conversations_table.update_item(
+                Key={'username': summary['username'], 'conversation_id': summary['conversation_id']},
+                UpdateExpression=(
+                    'SET agent_id = :agent_id, first_timestamp = :first_timestamp, '
+                    'last_timestamp = :last_timestamp, last_message_id = :last_message_id, '
+                    'last_interaction_type = :last_interaction_type, message_count = :message_count, '
+                    'aborted_count = :aborted_count, total_tokens = :total_tokens, total_price = :total_price'
+                ),
+                ConditionExpression='attribute_not_exists(last_timestamp) OR last_timestamp <= :last_timestamp',
+                ExpressionAttributeValues={
+                    ':' + name: summary[name]
+                    for name in (
+                        'agent_id', 'first_timestamp', 'last_timestamp', 'last_message_id',
+                        'last_interaction_type', 'message_count', 'aborted_count', 'total_tokens', 'total_price'
+                    )
+                }
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            skipped += 1
+    print(f"Backfilled {len(summaries) - skipped} conversation summaries from {len(items)} messages "
+          f"({skipped} skipped, updated during the scan)")
+
+def backfill_quiz_index():
+    """Set quiz_username on older quiz turns so the sparse QuizIndex picks them up"""
+    table = get_dynamodb().Table(CHATS_TABLE)
+    scan_kwargs = {
+        'FilterExpression': 'interaction_type IN (:prompt, :result) AND attribute_not_exists(quiz_username)',
+        'ExpressionAttributeValues': {
+            ':prompt': QUIZ_INTERACTION_TYPES[0],
+            ':result': QUIZ_INTERACTION_TYPES[1]
+        },
+        'ProjectionExpression': 'username, message_id'
+    }
+    updated = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            table.update_item(
+                Key={'username': item['username'], 'message_id': item['message_id']},
+                UpdateExpression='SET quiz_username = :username',
+                ExpressionAttributeValues={':username': item['username']}
+            )
+            updated += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print(f"Added {updated} quiz turns to {QUIZ_INDEX}")
+
+def backfill_eval_queue():
+    """
+    Queue conversations that have no stored evaluation and no eval_status yet,
+    i.e. those written before the evaluation queue existed. Run after
+    --backfill-conversations when that created summaries for older chats:
+    it leaves existing statuses alone but gives new summaries none.
+    """
+    evaluated = set()
+    evaluations_table = get_dynamodb().Table(EVALUATIONS_TABLE)
+    scan_kwargs = {'ProjectionExpression': 'conversation_id'}
+    while True:
+        response = evaluations_table.scan(**scan_kwargs)
+        evaluated.update(item['conversation_id'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    table = get_dynamodb().Table(CONVERSATIONS_TABLE)
+    scan_kwargs = {
+        'FilterExpression': 'attribute_not_exists(eval_status)',
+        'ProjectionExpression': 'username, conversation_id'
+    }
+    queued = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            if item['conversation_id'] in evaluated:
+                continue
+            table.update_item(
+                Key={'username': item['username'], 'conversation_id': item['conversation_id']},
+                UpdateExpression='SET eval_status = :pending',
+                ExpressionAttributeValues={':pending': EVAL_STATUS_PENDING}
+            )
+            queued += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print(f"Queued {queued} unevaluated conversations on {EVAL_STATUS_INDEX}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or migrate the AspAIra DynamoDB tables")
+    parser.add_argument(
+        "--backfill-conversations",
+        action="store_true",
+        help="rebuild the conversation summary table from existing chat messages"
+    )
+    parser.add_argument(
+        "--backfill-quiz-index",
+        action="store_true",
+        help="index quiz turns written before the QuizIndex existed"
+    )
+    parser.add_argument(
+        "--backfill-eval-queue",
+        action="store_true",
+        help="queue conversations that have never been evaluated"
+    )
+    parser.add_argument(
+        "--replay-chat-dead-letters",
+        action="store_true",
+        help="write chat messages from the write queue's dead-letter file"
+    )
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    try:
+        ensure_tables()
+        if args.backfill_conversations:
+            backfill_conversation_summaries()
+        if args.backfill_quiz_index:
+            backfill_quiz_index()
+        if args.backfill_eval_queue:
+            backfill_eval_queue()
+        if args.replay_chat_dead_letters:
+            replay_dead_letters()
+    except Exception as e:
+        print(f"Error bootstrapping tables: {str(e)}")
+        sys.exit(1)
+    print(f"Schema bootstrap finished in {time.perf_counter() - start_time:.1f}s")
@@ -0,0 +1,60 @@
+"""
+In-process caches for the AspAIra backend.
+
+Entries expire after a TTL and the least recently used entry is evicted once
+the cache is full. Hits, misses and evictions are reported to the metrics
+registry under the cache's name.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from .metrics import metrics
+
+
+class TTLCache:
+    """Thread-safe, size-bounded LRU cache with per-entry expiry"""
+
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                metrics.increment(f"{self.name}_misses")
+                return None
+            self._entries.move_to_end(key)
+            metrics.increment(f"{self.name}_hits")
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None):
+        """Store a value; ttl_seconds overrides the cache default for this entry"""
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                metrics.increment(f"{self.name}_evictions")
+            metrics.set_gauge(f"{self.name}_size", len(self._entries))
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            metrics.set_gauge(f"{self.name}_size", len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            metrics.set_gauge(f"{self.name}_size", 0)
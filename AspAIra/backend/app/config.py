@@ -3,12 +3,23 @@ Configuration settings for the AspAIra application.
 
 This module defines configurations for:
 - Agent settings including API keys, base URLs, and required inputs.
+- Dify HTTP client settings (timeouts and connection pool limits).
+- Admission control limits for concurrent LLM calls.
+- Agent fallback order and circuit breaker thresholds.
+- Location of the Dify app exports used to serve opening statements locally.
 - AWS DynamoDB and general AWS region settings.
+- Worker pool for the async DynamoDB repository.
+- In-process user/profile cache used by request authentication.
+- Decoded access-token cache.
+- Password hashing cost and the worker pool that runs bcrypt off the event loop.
+- Write-behind queue settings for chat persistence.
+- Chat stream buffer settings for idempotent and resumed chat requests.
 - FastAPI application metadata.
 - Default versions used across the application.
 """
 
 import os
+from pathlib import Path
 from typing import Dict
 
 # ===================== Agent Configurations =====================
@@ -17,6 +28,7 @@ AGENT_CONFIGS: Dict[str, Dict] = {
         "api_key": os.getenv("BASELINE_GPT_API_KEY", "app-local-default"),
         "base_url": os.getenv("DIFY_API_URL", "http://localhost"),
         "model": "gpt-4o",
+        "app_export": "Baseline_gpt.yml",
         "required_inputs": {
             "number_of_kids": {"source": "profile1", "type": "string"},
             "bank_account": {"source": "profile2", "type": "string"},
@@ -33,6 +45,7 @@ AGENT_CONFIGS: Dict[str, Dict] = {
         "api_key": os.getenv("BASELINE_CLAUDE_API_KEY", "app-local-default"),
         "base_url": os.getenv("DIFY_API_URL", "http://localhost"),
         "model": "clause-3-5-sonnet-20241022",
+        "app_export": "Baseline_claude.yml",
         "required_inputs": {
             "number_of_kids": {"source": "profile1", "type": "string"},
             "bank_account": {"source": "profile2", "type": "string"},
@@ -49,6 +62,7 @@ AGENT_CONFIGS: Dict[str, Dict] = {
         "api_key": os.getenv("V2_CLAUDE_API_KEY", "app-local-default"),
         "base_url": os.getenv("DIFY_API_URL", "http://localhost"),
         "model": "clause-3-5-sonnet-20241022",
+        "app_export": "V2_claude.yml",
         "required_inputs": {
             "number_of_kids": {"source": "profile1", "type": "string"},
             "bank_account": {"source": "profile2", "type": "string"},
@@ -69,12 +83,134 @@ AGENT_CONFIGS: Dict[str, Dict] = {
 # Specifies the currently active agent configuration.
 ACTIVE_AGENT_VERSION = os.getenv("ACTIVE_AGENT_VERSION", "V2_claude")
 
+# ===================== Dify HTTP Client Configuration =====================
+# Shared by every request on a worker; streams hold a pooled connection open
+# for the whole generation, so max_connections bounds in-flight chats.
+DIFY_CLIENT_CONFIG = {
+    "connect_timeout": float(os.getenv("DIFY_CONNECT_TIMEOUT", "5")),
+    "read_timeout": float(os.getenv("DIFY_READ_TIMEOUT", "120")),
+    "write_timeout": float(os.getenv("DIFY_WRITE_TIMEOUT", "10")),
+    "pool_timeout": float(os.getenv("DIFY_POOL_TIMEOUT", "10")),
+    "max_connections": int(os.getenv("DIFY_MAX_CONNECTIONS", "500")),
+    "max_keepalive_connections": int(os.getenv("DIFY_MAX_KEEPALIVE_CONNECTIONS", "100")),
+    "keepalive_expiry": float(os.getenv("DIFY_KEEPALIVE_EXPIRY", "30"))
+}
+
+# ===================== Admission Control =====================
+def _parse_agent_limits(value: str) -> Dict[str, int]:
+    """Parse "agent=limit,agent=limit" into a dict"""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        agent_id, _, limit = entry.partition("=")
+        limits[agent_id.strip()] = int(limit)
+    return limits
+
+# Caps concurrent Dify streams per worker; excess requests queue briefly and
+# are then turned away with 429 + Retry-After.
+ADMISSION_CONFIG = {
+    "max_in_flight": int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "200")),
+    "default_agent_max_in_flight": int(os.getenv("ADMISSION_AGENT_MAX_IN_FLIGHT", "200")),
+    "per_agent_max_in_flight": _parse_agent_limits(os.getenv("ADMISSION_AGENT_LIMITS", "")),
+    "max_queue_size": int(os.getenv("ADMISSION_MAX_QUEUE_SIZE", "100")),
+    "queue_timeout": float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10")),
+    "retry_after_seconds": int(os.getenv("ADMISSION_RETRY_AFTER", "10"))
+}
+
+# ===================== Dify App Exports =====================
+# Directory holding the exported Dify app definitions (<agent>.yml); the
+# opening statement is read from here instead of asking the LLM for it.
+# Defaults to the repository root (AspAIra/) of a source checkout; the backend
+# Docker image points it at dify_exports/. Agents without an export file fall
+# back to Dify's /parameters endpoint.
+DIFY_APP_EXPORT_DIR = os.getenv(
+    "DIFY_APP_EXPORT_DIR",
+    str(Path(__file__).resolve().parents[2])
+)
+
+# ===================== Agent Fallback & Circuit Breakers =====================
+# New conversations go to the first agent in this list whose breaker is closed
+# (or half-open and probing); the active agent always comes first.
+AGENT_FALLBACK_ORDER = [ACTIVE_AGENT_VERSION] + [
+    agent_id.strip()
+    for agent_id in os.getenv("AGENT_FALLBACK_ORDER", "V2_claude,Baseline_claude,Baseline_gpt").split(",")
+    if agent_id.strip() in AGENT_CONFIGS and agent_id.strip() != ACTIVE_AGENT_VERSION
+]
+
+CIRCUIT_BREAKER_CONFIG = {
+    "window_size": int(os.getenv("CIRCUIT_BREAKER_WINDOW_SIZE", "20")),
+    "min_calls": int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", "5")),
+    "failure_rate_threshold": float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATE", "0.5")),
+    "slow_call_ms": float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_MS", "15000")),  # Time to first event
+    "slow_call_rate_threshold": float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_RATE", "0.8")),
+    "open_seconds": float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30")),
+    "half_open_max_probes": int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_PROBES", "2"))
+}
+
 # ===================== Database Configuration =====================
 DATABASE_CONFIG = {
     "table_name": os.getenv("DYNAMODB_TABLE_NAME", "chat_interactions"),
     "region": os.getenv("AWS_REGION", "us-east-1")
 }
 
+# ===================== Repository Configuration =====================
+# Blocking boto3 calls run on this many threads; the boto3 connection pool is
+# sized to match so every worker can hold a connection.
+REPOSITORY_CONFIG = {
+    "max_workers": int(os.getenv("DYNAMODB_MAX_WORKERS", "16"))
+}
+
+# ===================== User Cache Configuration =====================
+# Users (without the password hash) loaded for request authentication are
+# cached per worker; profile updates invalidate their entry.
+USER_CACHE_CONFIG = {
+    "ttl_seconds": float(os.getenv("USER_CACHE_TTL_SECONDS", "300")),
+    "max_entries": int(os.getenv("USER_CACHE_MAX_ENTRIES", "5000"))
+}
+
+# ===================== Token Cache Configuration =====================
+# Verified token claims are cached by token digest until the token expires.
+TOKEN_CACHE_CONFIG = {
+    "max_entries": int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+}
+
+# ===================== Password Hashing Configuration =====================
+# bcrypt runs on a small thread pool; logins beyond max_pending get a 503 rather
+# than queueing behind each other. Changing bcrypt_rounds rehashes on next login.
+PASSWORD_HASHING_CONFIG = {
+    "bcrypt_rounds": int(os.getenv("BCRYPT_ROUNDS", "12")),
+    "max_workers": int(os.getenv("PASSWORD_HASH_WORKERS", "2")),
+    "max_pending": int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64")),
+    "retry_after_seconds": int(os.getenv("PASSWORD_HASH_RETRY_AFTER_SECONDS", "2"))
+}
+
+# ===================== Chat Write Queue Configuration =====================
+# Chat messages are persisted write-behind; DynamoDB batches hold at most 25 items.
+# Once the queue is backpressure_ratio full, admission turns new chats away.
+# Batches that still fail after max_retries are appended to the dead-letter file
+# (replay with python -m app.bootstrap --replay-chat-dead-letters).
+WRITE_QUEUE_CONFIG = {
+    "batch_size": min(int(os.getenv("CHAT_WRITE_BATCH_SIZE", "25")), 25),
+    "flush_interval": float(os.getenv("CHAT_WRITE_FLUSH_INTERVAL", "0.2")),
+    "max_queue_size": int(os.getenv("CHAT_WRITE_MAX_QUEUE_SIZE", "10000")),
+    "backpressure_ratio": float(os.getenv("CHAT_WRITE_BACKPRESSURE_RATIO", "0.8")),
+    "max_retries": int(os.getenv("CHAT_WRITE_MAX_RETRIES", "5")),
+    "base_backoff": float(os.getenv("CHAT_WRITE_BASE_BACKOFF", "0.1")),
+    "max_backoff": float(os.getenv("CHAT_WRITE_MAX_BACKOFF", "5")),
+    "dead_letter_path": os.getenv("CHAT_WRITE_DEAD_LETTER_PATH", "chat_write_dead_letters.jsonl")
+}
+
+# ===================== Chat Stream Buffers =====================
+# Frames of recent chat turns are buffered so a repeated Idempotency-Key or a
+# reconnect with Last-Event-ID replays the answer instead of paying for
+# another generation.
+CHAT_STREAM_CONFIG = {
+    "ttl_seconds": float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600")),
+    "max_entries": int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000")),
+    "max_frames_per_stream": int(os.getenv("CHAT_STREAM_MAX_FRAMES", "2000")),
+    "max_buffered_bytes": int(os.getenv("CHAT_STREAM_MAX_BUFFERED_BYTES", str(64 * 1024 * 1024))),
+    "resume_grace_seconds": float(os.getenv("CHAT_STREAM_RESUME_GRACE_SECONDS", "15"))
+}
+
 # ===================== API Configuration =====================
 API_CONFIG = {
     "title": "AspAIra API",
@@ -3,15 +3,20 @@ Database operations for AspAIra application.
 """
 import boto3
 import os
-from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 from botocore.config import Config
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from typing import Optional, Dict, List, Any
-from .config import DATABASE_CONFIG
+from .config import DATABASE_CONFIG, USER_CACHE_CONFIG, TOKEN_CACHE_CONFIG, REPOSITORY_CONFIG
+from .cache import TTLCache
 import uuid
+import hashlib
+import time
+import threading
 import json
+import base64
 from decimal import Decimal
 from fastapi import Request
 
@@ -20,186 +25,118 @@ SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # DynamoDB configuration for AWS production
 # Remove local testing parameters; credentials and region will be provided by AWS environment/IAM roles.
-dynamodb = boto3.resource('dynamodb', region_name=os.getenv("AWS_REGION", "us-east-1"))
+# The resource is created on first use so importing this module makes no AWS calls;
+# tables are created by the bootstrap command (python -m app.bootstrap), not here.
+_dynamodb = None
+_dynamodb_lock = threading.Lock()
+
+def get_dynamodb():
+    """Shared DynamoDB resource, created lazily"""
+    global _dynamodb
+    if _dynamodb is None:
+        with _dynamodb_lock:
+            if _dynamodb is None:
+                _dynamodb = boto3.resource(
+                    'dynamodb',
+                    region_name=os.getenv("AWS_REGION", "us-east-1"),
+                    config=Config(max_pool_connections=REPOSITORY_CONFIG["max_workers"])
+                )
+    return _dynamodb
 
 # Table names
 USERS_TABLE = 'AspAIra_Users'
 CHATS_TABLE = 'AspAIra_Chats'
 EVALUATIONS_TABLE = 'AspAIra_ConversationEvaluations'
+CONVERSATIONS_TABLE = 'AspAIra_Conversations'
+EVAL_RUNS_TABLE = 'AspAIra_EvaluationRuns'
+EVAL_CHECKPOINTS_TABLE = 'AspAIra_EvaluationCheckpoints'
+IDEMPOTENCY_TABLE = 'AspAIra_IdempotencyKeys'
 
-def _create_tables_if_not_exists():
-    try:
-        # Create Users table
-        try:
-            dynamodb.Table(USERS_TABLE).table_status
-            print(f"Table {USERS_TABLE} exists")
-        except (ClientError, AttributeError):
-            print(f"Creating table {USERS_TABLE}")
-            try:
-                table = dynamodb.create_table(
-                    TableName=USERS_TABLE,
-                    KeySchema=[
-                        {
-                            'AttributeName': 'username',
-                            'KeyType': 'HASH'
-                        }
-                    ],
-                    AttributeDefinitions=[
-                        {
-                            'AttributeName': 'username',
-                            'AttributeType': 'S'
-                        }
-                    ],
-                    ProvisionedThroughput={
-                        'ReadCapacityUnits': 5,
-                        'WriteCapacityUnits': 5
-                    }
-                )
-                table.wait_until_exists()
-                print(f"Table {USERS_TABLE} created successfully")
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'ResourceInUseException':
-                    print(f"Table {USERS_TABLE} already exists")
-                else:
-                    raise
-
-        # Create Chats table
-        try:
-            dynamodb.Table(CHATS_TABLE).table_status
-            print(f"Table {CHATS_TABLE} exists")
-        except (ClientError, AttributeError):
-            print(f"Creating table {CHATS_TABLE}")
-            try:
-                table = dynamodb.create_table(
-                    TableName=CHATS_TABLE,
-                    KeySchema=[
-                        {
-                            'AttributeName': 'username',
-                            'KeyType': 'HASH'
-                        },
-                        {
-                            'AttributeName': 'message_id',
-                            'KeyType': 'RANGE'
-                        }
-                    ],
-                    AttributeDefinitions=[
-                        {
-                            'AttributeName': 'username',
-                            'AttributeType': 'S'
-                        },
-                        {
-                            'AttributeName': 'message_id',
-                            'AttributeType': 'S'
-                        },
-                        {
-                            'AttributeName': 'conversation_id',
-                            'AttributeType': 'S'
-                        },
-                        {
-                            'AttributeName': 'timestamp',
-                            'AttributeType': 'S'
-                        }
-                    ],
-                    ProvisionedThroughput={
-                        'ReadCapacityUnits': 5,
-                        'WriteCapacityUnits': 5
-                    },
-                    GlobalSecondaryIndexes=[
-                        {
-                            'IndexName': 'ConversationIndex',
-                            'KeySchema': [
-                                {
-                                    'AttributeName': 'conversation_id',
-                                    'KeyType': 'HASH'
-                                },
-                                {
-                                    'AttributeName': 'timestamp',
-                                    'KeyType': 'RANGE'
-                                }
-                            ],
-                            'Projection': {
-                                'ProjectionType': 'ALL'
-                            },
-                            'ProvisionedThroughput': {
-                                'ReadCapacityUnits': 5,
-                                'WriteCapacityUnits': 5
-                            }
-                        }
-                    ]
-                )
-                table.wait_until_exists()
-                print(f"Table {CHATS_TABLE} created successfully")
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'ResourceInUseException':
-                    print(f"Table {CHATS_TABLE} already exists")
-                else:
-                    raise
-
-        # Create Evaluations table
-        try:
-            dynamodb.Table(EVALUATIONS_TABLE).table_status
-            print(f"Table {EVALUATIONS_TABLE} exists")
-        except (ClientError, AttributeError):
-            print(f"Creating table {EVALUATIONS_TABLE}")
-            try:
-                table = dynamodb.create_table(
-                    TableName=EVALUATIONS_TABLE,
-                    KeySchema=[
-                        {
-                            'AttributeName': 'conversation_id',
-                            'KeyType': 'HASH'
-                        },
-                        {
-                            'AttributeName': 'evaluation_timestamp',
-                            'KeyType': 'RANGE'
-                        }
-                    ],
-                    AttributeDefinitions=[
-                        {
-                            'AttributeName': 'conversation_id',
-                            'AttributeType': 'S'
-                        },
-                        {
-                            'AttributeName': 'evaluation_timestamp',
-                            'AttributeType': 'S'
-                        }
-                    ],
-                    ProvisionedThroughput={
-                        'ReadCapacityUnits': 5,
-                        'WriteCapacityUnits': 5
-                    }
-                )
-                table.wait_until_exists()
-                print(f"Table {EVALUATIONS_TABLE} created successfully")
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'ResourceInUseException':
-                    print(f"Table {EVALUATIONS_TABLE} already exists")
-                else:
-                    raise
+# Everything request authentication needs from a user record, minus the password hash
+USER_AUTH_ATTRIBUTES = [
+    'username', 'profile1', 'profile2', 'is_active',
+    'profile1_complete', 'profile2_complete', 'profile_version', 'created_at', 'last_login'
+]
 
-    except Exception as e:
-        print(f"Error creating tables: {str(e)}")
-        raise
+# Users loaded for request authentication, keyed by username
+user_cache = TTLCache("user_cache", **USER_CACHE_CONFIG)
+
+# Verified token claims keyed by token digest; entries expire with the token
+token_cache = TTLCache(
+    "token_cache",
+    ttl_seconds=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    max_entries=TOKEN_CACHE_CONFIG["max_entries"]
+)
+
+# Chats GSI keyed by username + timestamp, for chronological paging of a user's history
+USER_TIMESTAMP_INDEX = 'UserTimestampIndex'
+
+# Chats GSI keyed by conversation_id + timestamp
+CONVERSATION_INDEX = 'ConversationIndex'
+
+# Message attributes returned by history reads unless the heavy dify_metadata is requested
+CHAT_MESSAGE_ATTRIBUTES = [
+    'username', 'message_id', 'conversation_id', 'agent_id', 'timestamp', 'message',
+    'response', 'interaction_type', 'status', 'quiz_data', 'usage_metrics'
+]
+
+# Conversations GSI keyed by username + last_timestamp, for listing by recent activity
+USER_ACTIVITY_INDEX = 'UserActivityIndex'
+
+# Sparse chats GSI: only quiz turns carry quiz_username, so only they are indexed
+QUIZ_INDEX = 'QuizIndex'
+QUIZ_INTERACTION_TYPES = ('quiz_prompt', 'quiz_result')
+
+# Sparse conversations GSI keyed by eval_status + last_timestamp: only conversations
+# waiting for (or undergoing) evaluation carry eval_status, so finding work costs O(pending)
+EVAL_STATUS_INDEX = 'EvalStatusIndex'
+EVAL_STATUS_PENDING = 'pending'
+EVAL_STATUS_IN_PROGRESS = 'in_progress'
+EVAL_STATUS_FAILED = 'failed'
+
+# Idempotency-Key reservations for /api/chat, shared by every worker; expires_at
+# (epoch seconds) is the table's TTL attribute
+IDEMPOTENCY_IN_PROGRESS = 'in_progress'
+IDEMPOTENCY_COMPLETED = 'completed'
 
-# Create tables on module import
-_create_tables_if_not_exists()
+# DynamoDB error codes that signal throttling rather than a bad request
+THROTTLING_ERROR_CODES = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded'
+}
+
+# Server-side DynamoDB errors that usually go away when the call is repeated
+TRANSIENT_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'InternalServerError',
+    'ServiceUnavailable'
+}
+
+# Per-action reasons a TransactWriteItems call was cancelled that a retry may fix
+TRANSIENT_CANCELLATION_CODES = {
+    'TransactionConflict',
+    'ThrottlingError',
+    'ProvisionedThroughputExceeded',
+    'RequestLimitExceeded'
+}
+
+# Chat messages written per conversation transaction (TransactWriteItems takes
+# at most 100 actions and 4 MB; one action is the conversation summary update)
+CHAT_TRANSACTION_SIZE = 25
 
 def get_table():
-    return dynamodb.Table(USERS_TABLE)
+    return get_dynamodb().Table(USERS_TABLE)
 
 class UserExistsError(Exception):
     pass
 
-def create_user(username: str, password: str):
+def create_user(username: str, hashed_password: str):
+    """Create a user; the password must already be hashed (see passwords.password_hasher)"""
     print(f"Attempting to create user: {username}")
-    hashed_password = pwd_context.hash(password)
     try:
-        table = dynamodb.Table(USERS_TABLE)
+        table = get_dynamodb().Table(USERS_TABLE)
         print(f"Got table reference: {USERS_TABLE}")
         
         # First check if user exists
@@ -235,25 +172,46 @@ def create_user(username: str, password: str):
 
 def get_user(username: str):
     try:
-        table = dynamodb.Table(USERS_TABLE)
+        table = get_dynamodb().Table(USERS_TABLE)
         response = table.get_item(Key={'username': username})
         return response.get('Item')
     except ClientError:
         return None
 
-def authenticate_user(username: str, password: str):
-    """Authenticate user with username and password"""
+def get_user_for_auth(username: str):
+    """Get a user without the password hash, served from the user cache when possible"""
+    user = user_cache.get(username)
+    if user is not None:
+        return dict(user)
     try:
-        user = get_user(username)
-        if not user:
-            return None
-        if not pwd_context.verify(password, user['password']):
-            return None
-        return user
-    except Exception as e:
-        print(f"Error authenticating user: {str(e)}")
+        table = get_dynamodb().Table(USERS_TABLE)
+        response = table.get_item(
+            Key={'username': username},
+            ProjectionExpression=', '.join(f'#a{i}' for i in range(len(USER_AUTH_ATTRIBUTES))),
+            ExpressionAttributeNames={f'#a{i}': name for i, name in enumerate(USER_AUTH_ATTRIBUTES)}
+        )
+        user = response.get('Item')
+        if user is not None:
+            user_cache.set(username, user)
+            return dict(user)
+        return None
+    except ClientError:
         return None
 
+def update_password_hash(username: str, hashed_password: str):
+    """Replace a user's password hash, e.g. after the bcrypt cost changed"""
+    try:
+        table = get_dynamodb().Table(USERS_TABLE)
+        table.update_item(
+            Key={'username': username},
+            UpdateExpression='SET password = :password',
+            ExpressionAttributeValues={':password': hashed_password}
+        )
+        return True
+    except Exception as e:
+        print(f"Error updating password hash for user {username}: {str(e)}")
+        return False
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -261,39 +219,76 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_user_from_token(token: str):
+def build_token_claims(username: str, profile1_complete: bool, profile2_complete: bool,
+                       profile_version: int = 0) -> dict:
+    """
+    Claims for an access token. Profile completion flags and the profile version
+    travel in the token so identity-only routes never need to read the user.
+    """
+    return {
+        "sub": username,
+        "p1": bool(profile1_complete),
+        "p2": bool(profile2_complete),
+        "pv": int(profile_version)
+    }
+
+def token_claims_for_user(user: dict) -> dict:
+    return build_token_claims(
+        user['username'],
+        user.get('profile1_complete', False),
+        user.get('profile2_complete', False),
+        user.get('profile_version', 0)
+    )
+
+def decode_access_token(token: str) -> Optional[dict]:
+    """
+    Verify a token and return its claims, or None if it is invalid or expired.
+    Verified claims are cached until the token's exp, so a repeated token skips
+    the signature check and JSON parsing.
+    """
+    cache_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    payload = token_cache.get(cache_key)
+    if payload is not None:
+        return dict(payload)
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-        return get_user(username)
     except JWTError:
         return None
+    if payload.get("sub") is None:
+        return None
+    if "exp" in payload:
+        token_cache.set(cache_key, payload, ttl_seconds=payload["exp"] - time.time())
+    return dict(payload)
+
+def get_user_from_token(token: str):
+    payload = decode_access_token(token)
+    if payload is None:
+        return None
+    return get_user_for_auth(payload["sub"])
 
 def update_profile_part1(username: str, profile_data: dict):
     try:
         print(f"Attempting to update profile1 for user {username}")
         print(f"Profile data to save: {profile_data}")
-        table = dynamodb.Table(USERS_TABLE)
-        
-        # First check if user exists
-        existing_user = table.get_item(Key={'username': username})
-        print(f"Existing user data: {existing_user}")
-        
+        table = get_dynamodb().Table(USERS_TABLE)
+        # The condition keeps the update from creating a bare item for an unknown user
         response = table.update_item(
             Key={
                 'username': username
             },
-            UpdateExpression='SET profile1 = :profile_data, profile1_complete = :complete',
+            UpdateExpression='SET profile1 = :profile_data, profile1_complete = :complete ADD profile_version :one',
+            ConditionExpression='attribute_exists(username)',
             ExpressionAttributeValues={
                 ':profile_data': profile_data,
-                ':complete': True
+                ':complete': True,
+                ':one': 1
             },
-            ReturnValues="UPDATED_NEW"
+            ReturnValues="ALL_NEW"
         )
-        print(f"DynamoDB response: {response}")
-        return True
+        user_cache.invalidate(username)
+        # ALL_NEW includes the password hash, so log only the result
+        print(f"Updated profile1 for user {username}")
+        return response['Attributes']
     except Exception as e:
         print(f"Error updating profile1 for user {username}")
         print(f"Error type: {type(e)}")
@@ -303,27 +298,30 @@ def update_profile_part1(username: str, profile_data: dict):
 
 def update_profile_part2(username: str, profile_data: dict):
     try:
-        table = dynamodb.Table(USERS_TABLE)
+        table = get_dynamodb().Table(USERS_TABLE)
         response = table.update_item(
             Key={
                 'username': username
             },
-            UpdateExpression='SET profile2 = :profile_data, profile2_complete = :complete',
+            UpdateExpression='SET profile2 = :profile_data, profile2_complete = :complete ADD profile_version :one',
+            ConditionExpression='attribute_exists(username)',
             ExpressionAttributeValues={
                 ':profile_data': profile_data,
-                ':complete': True
+                ':complete': True,
+                ':one': 1
             },
-            ReturnValues="UPDATED_NEW"
+            ReturnValues="ALL_NEW"
         )
-        print(f"Updated profile2 for user {username}: {response}")
-        return True
+        user_cache.invalidate(username)
+        print(f"Updated profile2 for user {username}")
+        return response['Attributes']
     except Exception as e:
         print(f"Error updating profile2 for user {username}: {str(e)}")
         return False
 
 def get_profile_status(username: str):
     try:
-        table = dynamodb.Table(USERS_TABLE)
+        table = get_dynamodb().Table(USERS_TABLE)
         response = table.get_item(
             Key={
                 'username': username
@@ -348,13 +346,130 @@ def get_profile_status(username: str):
 
 def scan_all_users():
     try:
-        table = dynamodb.Table(USERS_TABLE)
+        table = get_dynamodb().Table(USERS_TABLE)
         response = table.scan()
         return response.get('Items', [])
     except Exception as e:
         print(f"Error scanning users: {str(e)}")
         return []
 
+def build_chat_item(
+    message_id: str,
+    conversation_id: str,
+    username: str,
+    agent_id: str,
+    timestamp: datetime,
+    message: str,
+    response: str,
+    interaction_type: str,
+    dify_metadata: dict,
+    quiz_data: Optional[dict] = None,
+    usage_metrics: Optional[dict] = None,
+    status: str = 'completed',
+    idempotency_key: Optional[str] = None
+) -> Optional[dict]:
+    """
+    Validate a chat turn and convert it into a DynamoDB item, or None if it is incomplete.
+    Aborted turns (client went away mid-answer) may carry an empty partial response.
+    """
+    aborted = status == 'aborted'
+    print("\n=== Starting build_chat_item ===")
+    print(f"Input parameters:")
+    print(f"message_id: {message_id}")
+    print(f"conversation_id: {conversation_id}")
+    print(f"username: {username}")
+    print(f"agent_id: {agent_id}")
+    print(f"timestamp: {timestamp}")
+    print(f"message length: {len(message)}")
+    print(f"response length: {len(response)}")
+    print(f"interaction_type: {interaction_type}")
+    print(f"dify_metadata: {dify_metadata}")
+    print(f"quiz_data: {quiz_data}")
+    print(f"usage_metrics: {usage_metrics}")
+
+    # Validate required fields
+    if not message_id or not conversation_id or not username or not agent_id or not timestamp or not message or (not response and not aborted) or not interaction_type:
+        print("Missing required fields:")
+        print(f"message_id: {bool(message_id)}")
+        print(f"conversation_id: {bool(conversation_id)}")
+        print(f"username: {bool(username)}")
+        print(f"agent_id: {bool(agent_id)}")
+        print(f"timestamp: {bool(timestamp)}")
+        print(f"message: {bool(message)}")
+        print(f"response: {bool(response)}")
+        print(f"interaction_type: {bool(interaction_type)}")
+        return None
+
+    # Validate response content
+    if not aborted and (not response or not response.strip()):
+        print("Empty response content")
+        return None
+
+    # Convert timestamp to ISO format string
+    timestamp_str = timestamp.isoformat()
+    
+    # Convert numeric values in usage_metrics to Decimal (flags such as 'estimated' stay booleans)
+    if usage_metrics:
+        converted_metrics = {}
+        for key, value in usage_metrics.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                converted_metrics[key] = Decimal(str(value))
+            elif isinstance(value, dict):
+                converted_metrics[key] = {
+                    k: Decimal(str(v)) if isinstance(v, (int, float)) else v
+                    for k, v in value.items()
+                }
+            else:
+                converted_metrics[key] = value
+        usage_metrics = converted_metrics
+    
+    # Manual latency override (commented out to test Dify's native latency handling)
+    if dify_metadata and 'manual_latency' in dify_metadata:
+        if not usage_metrics:
+            usage_metrics = {}
+        usage_metrics['latency'] = f"{dify_metadata['manual_latency']:.8f}"
+        print(f"Updated usage_metrics with manual latency: {dify_metadata['manual_latency']}ms")
+    
+    # Prepare the item for DynamoDB
+    item = {
+        'username': username,
+        'message_id': message_id,
+        'conversation_id': conversation_id,
+        'agent_id': agent_id,
+        'timestamp': timestamp_str,
+        'message': message,
+        'response': response,
+        'interaction_type': interaction_type,
+        'status': status,
+        'dify_metadata': dify_metadata or {}
+    }
+    
+    # Add optional fields if present
+    if interaction_type in QUIZ_INTERACTION_TYPES:
+        item['quiz_username'] = username
+    if idempotency_key:
+        item['idempotency_key'] = idempotency_key
+    if quiz_data:
+        item['quiz_data'] = quiz_data
+    if usage_metrics:
+        item['usage_metrics'] = usage_metrics
+    
+    print("\nPrepared DynamoDB item:")
+    print(f"username: {item['username']}")
+    print(f"message_id: {item['message_id']}")
+    print(f"conversation_id: {item['conversation_id']}")
+    print(f"agent_id: {item['agent_id']}")
+    print(f"timestamp: {item['timestamp']}")
+    print(f"message length: {len(item['message'])}")
+    print(f"response length: {len(item['response'])}")
+    print(f"interaction_type: {item['interaction_type']}")
+    print(f"dify_metadata keys: {list(item['dify_metadata'].keys())}")
+    if 'quiz_data' in item:
+        print(f"quiz_data present: {bool(item['quiz_data'])}")
+    if 'usage_metrics' in item:
+        print(f"usage_metrics present: {bool(item['usage_metrics'])}")
+    return item
+
 def save_chat_message(
     message_id: str,
     conversation_id: str,
@@ -370,103 +485,25 @@ def save_chat_message(
 ) -> bool:
     """Save a chat message to DynamoDB"""
     try:
-        print("\n=== Starting save_chat_message ===")
-        print(f"Input parameters:")
-        print(f"message_id: {message_id}")
-        print(f"conversation_id: {conversation_id}")
-        print(f"username: {username}")
-        print(f"agent_id: {agent_id}")
-        print(f"timestamp: {timestamp}")
-        print(f"message length: {len(message)}")
-        print(f"response length: {len(response)}")
-        print(f"interaction_type: {interaction_type}")
-        print(f"dify_metadata: {dify_metadata}")
-        print(f"quiz_data: {quiz_data}")
-        print(f"usage_metrics: {usage_metrics}")
-
-        # Validate required fields
-        if not message_id or not conversation_id or not username or not agent_id or not timestamp or not message or not response or not interaction_type:
-            print("Missing required fields:")
-            print(f"message_id: {bool(message_id)}")
-            print(f"conversation_id: {bool(conversation_id)}")
-            print(f"username: {bool(username)}")
-            print(f"agent_id: {bool(agent_id)}")
-            print(f"timestamp: {bool(timestamp)}")
-            print(f"message: {bool(message)}")
-            print(f"response: {bool(response)}")
-            print(f"interaction_type: {bool(interaction_type)}")
-            return False
-
-        # Validate response content
-        if not response or not response.strip():
-            print("Empty response content")
+        item = build_chat_item(
+            message_id=message_id,
+            conversation_id=conversation_id,
+            username=username,
+            agent_id=agent_id,
+            timestamp=timestamp,
+            message=message,
+            response=response,
+            interaction_type=interaction_type,
+            dify_metadata=dify_metadata,
+            quiz_data=quiz_data,
+            usage_metrics=usage_metrics
+        )
+        if item is None:
             return False
-
-        # Convert timestamp to ISO format string
-        timestamp_str = timestamp.isoformat()
-        
-        # Convert numeric values in usage_metrics to Decimal
-        if usage_metrics:
-            converted_metrics = {}
-            for key, value in usage_metrics.items():
-                if isinstance(value, (int, float)):
-                    converted_metrics[key] = Decimal(str(value))
-                elif isinstance(value, dict):
-                    converted_metrics[key] = {
-                        k: Decimal(str(v)) if isinstance(v, (int, float)) else v
-                        for k, v in value.items()
-                    }
-                else:
-                    converted_metrics[key] = value
-            usage_metrics = converted_metrics
-        
-        # Manual latency override (commented out to test Dify's native latency handling)
-        if dify_metadata and 'manual_latency' in dify_metadata:
-            if not usage_metrics:
-                usage_metrics = {}
-            usage_metrics['latency'] = f"{dify_metadata['manual_latency']:.8f}"
-            print(f"Updated usage_metrics with manual latency: {dify_metadata['manual_latency']}ms")
-        
-        # Prepare the item for DynamoDB
-        item = {
-            'username': username,
-            'message_id': message_id,
-            'conversation_id': conversation_id,
-            'agent_id': agent_id,
-            'timestamp': timestamp_str,
-            'message': message,
-            'response': response,
-            'interaction_type': interaction_type,
-            'dify_metadata': dify_metadata or {}
-        }
-        
-        # Add optional fields if present
-        if quiz_data:
-            item['quiz_data'] = quiz_data
-        if usage_metrics:
-            item['usage_metrics'] = usage_metrics
-        
-        print("\nPrepared DynamoDB item:")
-        print(f"username: {item['username']}")
-        print(f"message_id: {item['message_id']}")
-        print(f"conversation_id: {item['conversation_id']}")
-        print(f"agent_id: {item['agent_id']}")
-        print(f"timestamp: {item['timestamp']}")
-        print(f"message length: {len(item['message'])}")
-        print(f"response length: {len(item['response'])}")
-        print(f"interaction_type: {item['interaction_type']}")
-        print(f"dify_metadata keys: {list(item['dify_metadata'].keys())}")
-        if 'quiz_data' in item:
-            print(f"quiz_data present: {bool(item['quiz_data'])}")
-        if 'usage_metrics' in item:
-            print(f"usage_metrics present: {bool(item['usage_metrics'])}")
         
         print("\nAttempting to save to DynamoDB...")
-        # Save to DynamoDB
-        table = dynamodb.Table(CHATS_TABLE)
-        response = table.put_item(Item=item)
-        
-        print(f"DynamoDB response: {response}")
+        # Save to DynamoDB, together with the conversation summary
+        write_conversation_turns([item])
         print("=== Save completed successfully ===")
         return True
         
@@ -477,88 +514,515 @@ def save_chat_message(
         print(f"Traceback: {traceback.format_exc()}")
         return False
 
+def reserve_idempotency_key(username: str, idempotency_key: str, request_hash: str, owner: str,
+                            ttl_seconds: float) -> Optional[dict]:
+    """
+    Reserve an Idempotency-Key for a new chat turn before Dify is called.
+    Returns None once owner holds the key, or the record of the request
+    that holds it (in progress on some worker, or completed with its result).
+    Records past expires_at count as free even before DynamoDB's TTL deletes them.
+    """
+    table = get_dynamodb().Table(IDEMPOTENCY_TABLE)
+    key = {'username': username, 'idempotency_key': idempotency_key}
+    for _ in range(2):
+        now = int(time.time())
+        try:
+            table.put_item(
+                Item={
+                    **key,
+                    'request_hash': request_hash,
+                    'owner': owner,
+                    'status': IDEMPOTENCY_IN_PROGRESS,
+                    'created_at': datetime.utcnow().isoformat(),
+                    'expires_at': now + int(ttl_seconds)
+                },
+                ConditionExpression='attribute_not_exists(idempotency_key) OR expires_at < :now',
+                ExpressionAttributeValues={':now': now}
+            )
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        existing = table.get_item(Key=key, ConsistentRead=True).get('Item')
+        if existing is not None:
+            return existing
+        # Released between the put and the read; try to take it again
+    raise RuntimeError(f"Could not reserve idempotency key {idempotency_key}")
+
+def complete_idempotency_key(username: str, idempotency_key: str, owner: str, result: str,
+                             ttl_seconds: float) -> bool:
+    """Store the finished turn's final response (JSON) so duplicates on any worker can replay it"""
+    try:
+        get_dynamodb().Table(IDEMPOTENCY_TABLE).update_item(
+            Key={'username': username, 'idempotency_key': idempotency_key},
+            UpdateExpression='SET #status = :completed, #result = :result, expires_at = :expires_at',
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={'#status': 'status', '#result': 'result', '#owner': 'owner'},
+            ExpressionAttributeValues={
+                ':completed': IDEMPOTENCY_COMPLETED,
+                ':result': result,
+                ':owner': owner,
+                ':expires_at': int(time.time() + ttl_seconds)
+            }
+        )
+        return True
+    except Exception as e:
+        print(f"Error completing idempotency key {idempotency_key}: {str(e)}")
+        return False
+
+def release_idempotency_key(username: str, idempotency_key: str, owner: str) -> bool:
+    """Drop owner's in-progress reservation whose turn never completed, so a retry can run it"""
+    try:
+        get_dynamodb().Table(IDEMPOTENCY_TABLE).delete_item(
+            Key={'username': username, 'idempotency_key': idempotency_key},
+            ConditionExpression='#owner = :owner AND #status = :in_progress',
+            ExpressionAttributeNames={'#status': 'status', '#owner': 'owner'},
+            ExpressionAttributeValues={':owner': owner, ':in_progress': IDEMPOTENCY_IN_PROGRESS}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f"Error releasing idempotency key {idempotency_key}: {str(e)}")
+        return False
+
+def is_throttling_error(error: Exception) -> bool:
+    """Check whether a DynamoDB error is a throttling error worth retrying"""
+    if not isinstance(error, ClientError):
+        return False
+    return error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+def is_transient_error(error: Exception) -> bool:
+    """Check whether a DynamoDB call failed for a reason a retry may fix (throttling, 5xx, network)"""
+    if isinstance(error, (BotoConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get('Error', {}).get('Code')
+    if code == 'TransactionCanceledException':
+        return any(reason.get('Code') in TRANSIENT_CANCELLATION_CODES
+                   for reason in error.response.get('CancellationReasons', []))
+    return code in TRANSIENT_ERROR_CODES
+
+class InvalidCursorError(ValueError):
+    pass
+
+def encode_cursor(key: Optional[dict]) -> Optional[str]:
+    """Turn a DynamoDB LastEvaluatedKey (or any position dict) into an opaque cursor"""
+    if not key:
+        return None
+    payload = json.dumps(key, sort_keys=True, default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+def decode_cursor(cursor: Optional[str], username: Optional[str] = None) -> Optional[dict]:
+    """Decode a cursor; when username is given the cursor must belong to that user"""
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise InvalidCursorError("Invalid cursor")
+    if not isinstance(key, dict) or (username is not None and key.get('username') != username):
+        raise InvalidCursorError("Invalid cursor")
+    return key
+
+def get_chat_history_page(
+    username: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    newest_first: bool = False
+) -> Dict[str, Any]:
+    """
+    One page of a user's messages in timestamp order, via the UserTimestampIndex GSI.
+    Returns {'messages': [...], 'next_cursor': str or None}; raises InvalidCursorError.
+    """
+    table = get_dynamodb().Table(CHATS_TABLE)
+    query_kwargs = {
+        'IndexName': USER_TIMESTAMP_INDEX,
+        'KeyConditionExpression': 'username = :username',
+        'ExpressionAttributeValues': {':username': username},
+        'ScanIndexForward': not newest_first,
+        'Limit': limit
+    }
+    start_key = decode_cursor(cursor, username)
+    if start_key:
+        query_kwargs['ExclusiveStartKey'] = start_key
+    response = table.query(**query_kwargs)
+    return {
+        'messages': response.get('Items', []),
+        'next_cursor': encode_cursor(response.get('LastEvaluatedKey'))
+    }
+
+class ConversationNotFoundError(LookupError):
+    """The conversation does not exist or belongs to another user"""
+    pass
+
+def _projection(attributes: List[str]) -> Dict[str, Any]:
+    """ProjectionExpression kwargs with every attribute aliased (several are reserved words)"""
+    return {
+        'ProjectionExpression': ', '.join(f'#a{i}' for i in range(len(attributes))),
+        'ExpressionAttributeNames': {f'#a{i}': name for i, name in enumerate(attributes)}
+    }
+
+def get_conversation_messages_page(
+    username: str,
+    conversation_id: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    include_metadata: bool = False
+) -> Dict[str, Any]:
+    """
+    One page of a conversation's messages in chronological order, via the ConversationIndex GSI.
+    Reads are proportional to the conversation, not the user's whole history.
+    Raises ConversationNotFoundError if the conversation is not the user's, InvalidCursorError on bad cursors.
+    """
+    table = get_dynamodb().Table(CHATS_TABLE)
+    query_kwargs = {
+        'IndexName': CONVERSATION_INDEX,
+        'KeyConditionExpression': 'conversation_id = :conversation_id',
+        'ExpressionAttributeValues': {':conversation_id': conversation_id},
+        'ScanIndexForward': True,
+        'Limit': limit
+    }
+    if not include_metadata:
+        query_kwargs.update(_projection(CHAT_MESSAGE_ATTRIBUTES))
+    start_key = decode_cursor(cursor, username)
+    if start_key:
+        if start_key.get('conversation_id') != conversation_id:
+            raise InvalidCursorError("Invalid cursor")
+        query_kwargs['ExclusiveStartKey'] = start_key
+    response = table.query(**query_kwargs)
+    items = response.get('Items', [])
+    # Every message carries its owner, so one foreign item means a foreign conversation
+    if (not items and not start_key) or any(item['username'] != username for item in items):
+        raise ConversationNotFoundError(conversation_id)
+    return {
+        'messages': items,
+        'next_cursor': encode_cursor(response.get('LastEvaluatedKey'))
+    }
+
+def _query_all_pages(table, **query_kwargs) -> List[dict]:
+    """Follow LastEvaluatedKey until the query is exhausted"""
+    items = []
+    while True:
+        response = table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
 def get_chat_history(username: str, conversation_id: Optional[str] = None) -> List[dict]:
     """Get chat history for a user, optionally filtered by conversation_id"""
     try:
-        table = dynamodb.Table(CHATS_TABLE)
+        table = get_dynamodb().Table(CHATS_TABLE)
         
         if conversation_id:
-            # Get messages for specific conversation
-            response = table.query(
-                KeyConditionExpression='username = :username AND conversation_id = :conversation_id',
+            # conversation_id is not a key of the base table; use its index and keep
+            # only the user's own messages
+            items = _query_all_pages(
+                table,
+                IndexName=CONVERSATION_INDEX,
+                KeyConditionExpression='conversation_id = :conversation_id',
                 ExpressionAttributeValues={
-                    ':username': username,
                     ':conversation_id': conversation_id
                 },
                 ScanIndexForward=True  # Get messages in chronological order
             )
+            return [item for item in items if item['username'] == username]
         else:
-            # Get all messages for user
-            response = table.query(
+            # Get all messages for user, across every DynamoDB page
+            return _query_all_pages(
+                table,
+                IndexName=USER_TIMESTAMP_INDEX,
                 KeyConditionExpression='username = :username',
                 ExpressionAttributeValues={
                     ':username': username
                 },
                 ScanIndexForward=True
             )
-        
-        return response.get('Items', [])
     except Exception as e:
         print(f"Error getting chat history: {str(e)}")
         return []
 
 def get_conversations(username: str) -> List[dict]:
-    """Get all unique conversations for a user"""
+    """Summaries of all of a user's conversations, newest activity first"""
     try:
-        table = dynamodb.Table(CHATS_TABLE)
-        
-        # Get all messages for user
-        response = table.query(
+        table = get_dynamodb().Table(CONVERSATIONS_TABLE)
+        return _query_all_pages(
+            table,
+            IndexName=USER_ACTIVITY_INDEX,
             KeyConditionExpression='username = :username',
-            ExpressionAttributeValues={
-                ':username': username
-            }
-        )
-        
-        # Extract unique conversations
-        conversations = {}
-        for item in response.get('Items', []):
-            conv_id = item['conversation_id']
-            if conv_id not in conversations:
-                conversations[conv_id] = {
-                    'conversation_id': conv_id,
-                    'last_message': item['message'],
-                    'last_timestamp': item['timestamp'],
-                    'message_count': 0
-                }
-            conversations[conv_id]['message_count'] += 1
-        
-        # Convert to list and sort by last timestamp
-        return sorted(
-            list(conversations.values()),
-            key=lambda x: x['last_timestamp'],
-            reverse=True
+            ExpressionAttributeValues={':username': username},
+            ScanIndexForward=False
         )
     except Exception as e:
         print(f"Error getting conversations: {str(e)}")
         return []
 
+def get_conversations_page(username: str, limit: int = 20, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """
+    One page of conversation summaries, newest activity first, read from the
+    conversations table (one item per conversation, not per message).
+    Returns {'conversations': [...], 'next_cursor': str or None}; raises InvalidCursorError.
+    """
+    table = get_dynamodb().Table(CONVERSATIONS_TABLE)
+    query_kwargs = {
+        'IndexName': USER_ACTIVITY_INDEX,
+        'KeyConditionExpression': 'username = :username',
+        'ExpressionAttributeValues': {':username': username},
+        'ScanIndexForward': False,
+        'Limit': limit
+    }
+    start_key = decode_cursor(cursor, username)
+    if start_key:
+        query_kwargs['ExclusiveStartKey'] = start_key
+    response = table.query(**query_kwargs)
+    return {
+        'conversations': response.get('Items', []),
+        'next_cursor': encode_cursor(response.get('LastEvaluatedKey'))
+    }
+
+def _usage_number(usage_metrics: Optional[dict], key: str) -> Decimal:
+    """Token counts and prices arrive as numbers or numeric strings"""
+    try:
+        return Decimal(str((usage_metrics or {}).get(key) or 0))
+    except ArithmeticError:
+        return Decimal(0)
+
+def summarize_chat_items(items: List[dict]) -> List[dict]:
+    """Fold chat items into one summary delta per (username, conversation_id)"""
+    summaries = {}
+    for item in sorted(items, key=lambda i: i['timestamp']):
+        key = (item['username'], item['conversation_id'])
+        if key not in summaries:
+            summaries[key] = {
+                'username': item['username'],
+                'conversation_id': item['conversation_id'],
+                'first_timestamp': item['timestamp'],
+                'message_count': 0,
+                'aborted_count': 0,
+                'total_tokens': Decimal(0),
+                'total_price': Decimal(0)
+            }
+        summary = summaries[key]
+        summary['agent_id'] = item.get('agent_id')
+        summary['last_timestamp'] = item['timestamp']
+        summary['last_message_id'] = item['message_id']
+        summary['last_interaction_type'] = item.get('interaction_type')
+        summary['message_count'] += 1
+        if item.get('status') == 'aborted':
+            summary['aborted_count'] += 1
+        summary['total_tokens'] += _usage_number(item.get('usage_metrics'), 'total_tokens')
+        summary['total_price'] += _usage_number(item.get('usage_metrics'), 'total_price')
+    return list(summaries.values())
+
+# How a summary delta is applied to its conversation (see _summary_update)
+SUMMARY_LATEST = 'latest'          # Newest message so far; the conversation was not failed
+SUMMARY_RETRY_FAILED = 'retry'     # Newest message for a conversation whose evaluation failed
+SUMMARY_COUNTERS = 'counters'      # A newer message is already stored; counters only
+
+_deserializer = TypeDeserializer()
+
+def _summary_update(summary: dict, mode: str) -> dict:
+    """
+    TransactWriteItems Update adding a summary delta to its conversation.
+    Except in SUMMARY_COUNTERS mode, the delta's newest message also becomes
+    the conversation's last message, guarded so an older batch arriving late
+    cannot move it back. Every write queues the conversation for evaluation
+    (again, if it had already been evaluated or was being evaluated);
+    eval_attempts is kept, so the evaluator's retry budget is not refilled
+    by every message. Only a new last message on a conversation marked failed
+    (SUMMARY_RETRY_FAILED) starts its attempts afresh.
+    """
+    set_clauses = [
+        'first_timestamp = if_not_exists(first_timestamp, :first_timestamp)',
+        'eval_status = :eval_status'
+    ]
+    values = {
+        ':first_timestamp': summary['first_timestamp'],
+        ':message_count': summary['message_count'],
+        ':aborted_count': summary['aborted_count'],
+        ':total_tokens': summary['total_tokens'],
+        ':total_price': summary['total_price'],
+        ':eval_status': EVAL_STATUS_PENDING
+    }
+    update = {
+        'TableName': CONVERSATIONS_TABLE,
+        'Key': {'username': summary['username'], 'conversation_id': summary['conversation_id']}
+    }
+    remove = ''
+    if mode != SUMMARY_COUNTERS:
+        set_clauses = [
+            'agent_id = :agent_id', 'last_timestamp = :last_timestamp',
+            'last_message_id = :last_message_id', 'last_interaction_type = :last_interaction_type'
+        ] + set_clauses
+        values.update({
+            ':agent_id': summary['agent_id'],
+            ':last_timestamp': summary['last_timestamp'],
+            ':last_message_id': summary['last_message_id'],
+            ':last_interaction_type': summary['last_interaction_type'],
+            ':failed': EVAL_STATUS_FAILED
+        })
+        guard = '(attribute_not_exists(last_timestamp) OR last_timestamp <= :last_timestamp)'
+        if mode == SUMMARY_RETRY_FAILED:
+            update['ConditionExpression'] = f'{guard} AND eval_status = :failed'
+            remove = ' REMOVE eval_attempts'
+        else:
+            update['ConditionExpression'] = f'{guard} AND (attribute_not_exists(eval_status) OR eval_status <> :failed)'
+        # Tells a failed guard apart from a failed conversation
+        update['ReturnValuesOnConditionCheckFailure'] = 'ALL_OLD'
+    update['UpdateExpression'] = (
+        'SET ' + ', '.join(set_clauses) + ' '
+        'ADD message_count :message_count, aborted_count :aborted_count, '
+        'total_tokens :total_tokens, total_price :total_price' + remove
+    )
+    update['ExpressionAttributeValues'] = values
+    return update
+
+def _write_conversation_chunk(items: List[dict]) -> bool:
+    """
+    Put one conversation's chat items and update its summary in a single
+    transaction, so the summary always matches the stored messages.
+    Puts are conditional on the message being new: a retried or replayed
+    write leaves out the messages already stored, so counters are only
+    added once. Returns False when every message was already stored.
+    """
+    client = get_dynamodb().meta.client
+    mode = SUMMARY_LATEST
+    while items:
+        summary = summarize_chat_items(items)[0]
+        actions = [
+            {'Put': {
+                'TableName': CHATS_TABLE,
+                'Item': item,
+                'ConditionExpression': 'attribute_not_exists(message_id)'
+            }}
+            for item in items
+        ]
+        actions.append({'Update': _summary_update(summary, mode)})
+        try:
+            client.transact_write_items(TransactItems=actions)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = e.response.get('CancellationReasons', [])
+            codes = [reason.get('Code') for reason in reasons]
+            if len(codes) != len(actions) or any(code not in ('None', 'ConditionalCheckFailed') for code in codes):
+                # Conflicts and throttling; is_transient_error lets the caller retry
+                raise
+            stored = {items[n]['message_id'] for n, code in enumerate(codes[:-1]) if code == 'ConditionalCheckFailed'}
+            if stored:
+                items = [item for item in items if item['message_id'] not in stored]
+                continue
+            if mode == SUMMARY_COUNTERS or codes[-1] != 'ConditionalCheckFailed':
+                raise
+            # The error carries the conversation in DynamoDB's typed form
+            old = {name: _deserializer.deserialize(value) for name, value in reasons[-1].get('Item', {}).items()}
+            if 'last_timestamp' in old and old['last_timestamp'] > summary['last_timestamp']:
+                # A newer message already moved the conversation on; only add the counters
+                mode = SUMMARY_COUNTERS
+            elif old.get('eval_status') == EVAL_STATUS_FAILED:
+                mode = SUMMARY_RETRY_FAILED
+            else:
+                mode = SUMMARY_LATEST
+    return False
+
+def write_conversation_turns(items: List[dict]) -> int:
+    """
+    Write chat items together with their conversation summaries, one
+    transaction per conversation (in chunks of CHAT_TRANSACTION_SIZE messages,
+    oldest first). Returns the number of summary updates applied; errors are
+    raised so the caller can decide whether to retry.
+    """
+    conversations: Dict[tuple, List[dict]] = {}
+    for item in sorted(items, key=lambda i: i['timestamp']):
+        conversations.setdefault((item['username'], item['conversation_id']), []).append(item)
+    updated = 0
+    for conversation_items in conversations.values():
+        for start in range(0, len(conversation_items), CHAT_TRANSACTION_SIZE):
+            if _write_conversation_chunk(conversation_items[start:start + CHAT_TRANSACTION_SIZE]):
+                updated += 1
+    return updated
+
+def _parse_quiz_item(item: dict) -> dict:
+    """Quiz turn as returned by the quiz history API, with the score as an int"""
+    quiz_data = item.get('quiz_data') or {}
+    score = quiz_data.get('score')
+    return {
+        'message_id': item['message_id'],
+        'conversation_id': item['conversation_id'],
+        'agent_id': item.get('agent_id'),
+        'timestamp': item['timestamp'],
+        'interaction_type': item['interaction_type'],
+        'quiz_data': quiz_data,
+        'score': int(score) if score is not None else None
+    }
+
+def get_user_quiz_history_page(
+    username: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    interaction_type: Optional[str] = None,
+    newest_first: bool = True
+) -> Dict[str, Any]:
+    """
+    One page of a user's quiz turns from the sparse QuizIndex GSI.
+    Returns {'quizzes': [...], 'next_cursor': str or None}; raises InvalidCursorError.
+    """
+    table = get_dynamodb().Table(CHATS_TABLE)
+    query_kwargs = {
+        'IndexName': QUIZ_INDEX,
+        'KeyConditionExpression': 'quiz_username = :username',
+        'ExpressionAttributeValues': {':username': username},
+        'ScanIndexForward': not newest_first,
+        'Limit': limit
+    }
+    if interaction_type:
+        query_kwargs['FilterExpression'] = 'interaction_type = :interaction_type'
+        query_kwargs['ExpressionAttributeValues'][':interaction_type'] = interaction_type
+    start_key = decode_cursor(cursor, username)
+    if start_key:
+        query_kwargs['ExclusiveStartKey'] = start_key
+    response = table.query(**query_kwargs)
+    return {
+        'quizzes': [_parse_quiz_item(item) for item in response.get('Items', [])],
+        'next_cursor': encode_cursor(response.get('LastEvaluatedKey'))
+    }
+
 def get_user_quiz_history(username: str) -> List[Dict]:
-    """Get user's quiz history"""
+    """Get user's quiz history (quiz prompts and results), oldest first"""
     try:
-        table = dynamodb.Table(CHATS_TABLE)
-        response = table.scan(
-            FilterExpression='username = :username AND interaction_type = :type',
+        table = get_dynamodb().Table(CHATS_TABLE)
+        items = _query_all_pages(
+            table,
+            IndexName=QUIZ_INDEX,
+            KeyConditionExpression='quiz_username = :username',
             ExpressionAttributeValues={
-                ':username': username,
-                ':type': 'quiz'
-            }
+                ':username': username
+            },
+            ScanIndexForward=True
         )
-        return response.get('Items', [])
+        return [_parse_quiz_item(item) for item in items]
     except Exception as e:
         print(f"Error getting quiz history: {str(e)}")
         return []
 
+def get_conversation_evaluations(conversation_id: str) -> List[Dict]:
+    """Get evaluations for a conversation, newest first"""
+    try:
+        table = get_dynamodb().Table(EVALUATIONS_TABLE)
+        response = table.query(
+            KeyConditionExpression='conversation_id = :conversation_id',
+            ExpressionAttributeValues={
+                ':conversation_id': conversation_id
+            },
+            ScanIndexForward=False
+        )
+        return response.get('Items', [])
+    except Exception as e:
+        print(f"Error getting evaluations: {str(e)}")
+        return []
+
 def verify_token(request: Request) -> Optional[str]:
     """Verify JWT token from request header"""
     try:
@@ -569,11 +1033,8 @@ def verify_token(request: Request) -> Optional[str]:
         # Get token part after 'Bearer '
         token = auth_header.split(' ', 1)[1] if ' ' in auth_header else auth_header
         
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-            return payload.get('username')
-        except jwt.InvalidTokenError:
-            return None
+        payload = decode_access_token(token)
+        return payload.get('sub') if payload else None
     except Exception as e:
         print(f"Error verifying token: {str(e)}")
         return None
\ No newline at end of file
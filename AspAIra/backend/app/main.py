@@ -1,12 +1,24 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+import time
+# Startup time is measured from before the heavy imports below
+_import_started_at = time.perf_counter()
+
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from . import models, database
 from typing import Optional, List, Literal, Dict, Tuple
 import uvicorn
-from .services.dify_service import DifyService
-from .config import API_CONFIG, ACTIVE_AGENT_VERSION, AGENT_CONFIGS
+from .services.dify_service import DifyService, DifyCallContext
+from .services.chat_write_queue import ChatWriteQueue
+from .services.admission import AdmissionController, AdmissionRejected
+from .services.chat_streams import (
+    ChatStreamRegistry, IdempotencyKeyBusy, IdempotencyKeyReused, parse_last_event_id
+)
+from .metrics import metrics
+from .passwords import password_hasher, PasswordHasherBusy
+from .repository import repository
+from .config import API_CONFIG, ACTIVE_AGENT_VERSION, AGENT_CONFIGS, CIRCUIT_BREAKER_CONFIG
 import json
 import asyncio
 import requests
@@ -119,7 +131,77 @@ def detect_quiz_interaction(response: str) -> Tuple[str, Optional[Dict]]:
 app = FastAPI(**API_CONFIG)
 
 # Initialize services
+# DifyService is stateless apart from its pooled client and caches; per-request
+# conversation state is carried in a DifyCallContext.
 dify_service = DifyService()
+chat_write_queue = ChatWriteQueue()
+admission_controller = AdmissionController()
+# A backed-up write queue refuses new turns instead of putting DynamoDB on the response path
+admission_controller.add_backpressure("write_queue", lambda: chat_write_queue.saturated)
+# Keys are also reserved in DynamoDB, so duplicates reaching another worker don't call Dify again
+chat_streams = ChatStreamRegistry(key_store=repository)
+
+# Fire-and-forget tasks (e.g. aborting a cancelled turn) must be referenced until done
+_background_tasks = set()
+
+def spawn_background(coro):
+    """Run a coroutine outside the current request's (possibly cancelled) task"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def abort_chat_turn(call_context: DifyCallContext, message: str, chat_data: dict, started_at: float):
+    """Stop the upstream generation for a turn nobody is reading and record what was produced"""
+    try:
+        metrics.increment("chat_turns_aborted")
+        stopped = await dify_service.stop_generation(call_context)
+        logger.info(f"Aborted chat turn for {call_context.username} (upstream stopped: {stopped})")
+
+        conversation_id = chat_data['conversation_id'] or call_context.conversation_id
+        if not conversation_id:
+            # Dify never reported a conversation, so there is nothing to attach the turn to
+            return
+        partial_response = chat_data['response'] or chat_data['streamed_response']
+        # Dify never sent message_end, so tokens and price are estimated from what was streamed
+        usage_metrics = dify_service.estimate_partial_usage(call_context, message, partial_response)
+        usage_metrics['partial_response_chars'] = len(partial_response)
+        usage_metrics['elapsed_ms'] = (time.monotonic() - started_at) * 1000
+        if call_context.first_event_latency_ms is not None:
+            usage_metrics['latency'] = call_context.first_event_latency_ms
+        chat_item = database.build_chat_item(
+            message_id=chat_data['message_id'] or call_context.message_id or str(uuid.uuid4()),
+            conversation_id=conversation_id,
+            username=call_context.username,
+            agent_id=call_context.agent_id,
+            timestamp=datetime.now(),
+            message=message,
+            response=partial_response,
+            interaction_type=chat_data['interaction_type'],
+            dify_metadata={**chat_data['dify_metadata'], 'task_id': call_context.task_id},
+            usage_metrics=usage_metrics,
+            status='aborted'
+        )
+        if chat_item:
+            await chat_write_queue.submit(chat_item)
+    except Exception as e:
+        logger.error(f"Error aborting chat turn: {str(e)}")
+
+@app.on_event("startup")
+async def start_services():
+    """Start background workers"""
+    await chat_write_queue.start()
+    startup_seconds = time.perf_counter() - _import_started_at
+    metrics.set_gauge("startup_seconds", round(startup_seconds, 3))
+    logger.info(f"Backend ready {startup_seconds:.2f}s after app import")
+
+@app.on_event("shutdown")
+async def shutdown_services():
+    """Drain pending chat writes and release pooled upstream connections"""
+    await chat_write_queue.stop()
+    await dify_service.aclose()
+    password_hasher.shutdown()
+    repository.shutdown()
 
 # CORS configuration
 # For production, update the ALLOWED_ORIGINS environment variable to your production frontend URL(s)
@@ -135,7 +217,7 @@ app.add_middleware(
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
-    user = database.get_user_from_token(token)
+    user = await repository.get_user_from_token(token)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -144,17 +226,80 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         )
     return user
 
+async def get_token_claims(token: str = Depends(oauth2_scheme)):
+    """
+    Identity and profile status taken from the signed token, without reading the user.
+    Tokens issued before the profile claims existed fall back to one status lookup.
+    """
+    payload = database.decode_access_token(token)
+    if not payload:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if "p1" not in payload or "p2" not in payload:
+        profile_status = await repository.get_profile_status(payload["sub"])
+        payload["p1"] = profile_status["profile1_complete"]
+        payload["p2"] = profile_status["profile2_complete"]
+    return {
+        "username": payload["sub"],
+        "profile1_complete": payload["p1"],
+        "profile2_complete": payload["p2"],
+        "profile_version": payload.get("pv", 0)
+    }
+
+def token_response(claims: dict) -> dict:
+    """Access token plus the profile flags it carries, so clients need no status call"""
+    return {
+        "access_token": database.create_access_token(claims),
+        "token_type": "bearer",
+        "profile1_complete": claims["p1"],
+        "profile2_complete": claims["p2"]
+    }
+
+def password_hashing_busy(e: PasswordHasherBusy) -> JSONResponse:
+    logger.warning("Rejected sign-in: password hashing pool is saturated")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Too many sign-ins in progress, please try again shortly"},
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+async def authenticate_user(username: str, password: str) -> Optional[dict]:
+    """
+    Check a username and password with bcrypt running off the event loop.
+    Hashes made with an outdated bcrypt cost are replaced transparently.
+    """
+    user = await repository.get_user(username)
+    if not user:
+        return None
+    verified, new_hash = await password_hasher.verify_and_update(password, user['password'])
+    if not verified:
+        return None
+    if new_hash:
+        logger.info(f"Rehashing password for {username} with the current bcrypt cost")
+        await repository.update_password_hash(username, new_hash)
+    return user
+
 @app.post("/token")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = database.authenticate_user(form_data.username, form_data.password)
+    start_time = time.perf_counter()
+    try:
+        user = await authenticate_user(form_data.username, form_data.password)
+    except PasswordHasherBusy as e:
+        return password_hashing_busy(e)
+    finally:
+        metrics.observe("login_latency_ms", (time.perf_counter() - start_time) * 1000)
     if not user:
+        metrics.increment("login_failed")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = database.create_access_token({"sub": user["username"]})
-    return {"access_token": access_token, "token_type": "bearer"}
+    metrics.increment("login_succeeded")
+    return token_response(database.token_claims_for_user(user))
 
 @app.post("/signup")
 async def create_user(user: models.UserCreate):
@@ -172,9 +317,12 @@ async def create_user(user: models.UserCreate):
                 content={"message": "Password must be at least 6 characters long"}
             )
             
-        database.create_user(user.username, user.password)
+        hashed_password = await password_hasher.hash(user.password)
+        await repository.create_user(user.username, hashed_password)
         logger.info(f"User created successfully: {user.username}")
         return {"message": "User created successfully"}
+    except PasswordHasherBusy as e:
+        return password_hashing_busy(e)
     except UserExistsError as e:
         logger.info(f"User already exists: {str(e)}")
         return JSONResponse(
@@ -191,12 +339,12 @@ async def create_user(user: models.UserCreate):
 @app.post("/user/profile1")
 async def update_profile_part1(
     profile: models.ProfilePart1,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_token_claims)
 ):
     logger.info(f"Received profile update request for user: {current_user['username']}")
     logger.info(f"Profile data received: {profile.dict()}")
     try:
-        result = database.update_profile_part1(current_user["username"], profile.dict())
+        result = await repository.update_profile_part1(current_user["username"], profile.dict())
         if not result:
             logger.error("Failed to update profile in database")
             raise HTTPException(
@@ -204,7 +352,9 @@ async def update_profile_part1(
                 detail="Failed to update profile. Please check server logs for details."
             )
         logger.info("Profile updated successfully")
-        return {"message": "Profile updated successfully"}
+        # Re-issue the token from the saved user so both profile claims match the database
+        claims = database.token_claims_for_user(result)
+        return {"message": "Profile updated successfully", **token_response(claims)}
     except Exception as e:
         logger.error(f"Error updating profile: {str(e)}")
         raise HTTPException(
@@ -215,41 +365,153 @@ async def update_profile_part1(
 @app.post("/user/profile2")
 async def update_profile_part2(
     profile: models.ProfilePart2,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_token_claims)
 ):
-    result = database.update_profile_part2(current_user["username"], profile.dict())
+    result = await repository.update_profile_part2(current_user["username"], profile.dict())
     if not result:
         raise HTTPException(status_code=500, detail="Failed to update profile")
-    return {"message": "Profile updated successfully"}
+    claims = database.token_claims_for_user(result)
+    return {"message": "Profile updated successfully", **token_response(claims)}
 
 @app.get("/user/profile-status")
-async def get_profile_status(current_user: dict = Depends(get_current_user)):
-    status = database.get_profile_status(current_user["username"])
-    return status
+async def get_profile_status(current_user: dict = Depends(get_token_claims)):
+    return {
+        "profile1_complete": current_user["profile1_complete"],
+        "profile2_complete": current_user["profile2_complete"]
+    }
 
 @app.get("/debug/users")
 async def get_all_users():
-    users = database.scan_all_users()
+    users = await repository.scan_all_users()
     return {"users": users}
 
+@app.get("/debug/metrics")
+async def get_metrics(current_user: dict = Depends(get_token_claims)):
+    """In-process metrics for this worker; signed-in users only, and only in debug mode"""
+    if not API_CONFIG["debug"]:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return metrics.snapshot()
+
+@app.get("/api/chat/opening")
+async def get_opening_statement(current_user: dict = Depends(get_current_user)):
+    """
+    Return the agent's opening statement from the cached Dify app definition.
+    No Dify conversation is created here; it starts with the user's first real message.
+    """
+    profile_data = {
+        "profile1": current_user.get("profile1", {}),
+        "profile2": current_user.get("profile2", {})
+    }
+    # Greet with the agent the first message will be routed to; the client sends it back as agent_id
+    agent_id = dify_service.router.peek_agent() or ACTIVE_AGENT_VERSION
+    opening_statement = await dify_service.get_opening_statement(profile_data, agent_id)
+    if not opening_statement:
+        raise HTTPException(status_code=503, detail="Opening statement is not available")
+    return {
+        "conversation_id": None,
+        "agent_id": agent_id,
+        "response": opening_statement,
+        "interaction_type": "content",
+        "quiz_data": None
+    }
+
 @app.post("/api/chat")
 async def chat(
     chat_request: models.ChatRequest,
+    request: Request,
     current_user: dict = Depends(get_current_user)
 ):
-    """Process a chat message and return the response"""
+    """
+    Process a chat message and return the response.
+    Requests repeating an Idempotency-Key attach to the original turn's stream
+    (or replay it once finished) instead of calling Dify again. Frames carry
+    event IDs so a dropped connection can resume via /api/chat/stream/{stream_id}.
+    """
+    stream = None
     try:
         logger.info("=== Starting Chat Request ===")
         logger.info(f"Current user: {current_user}")
         logger.info(f"Chat request: {chat_request}")
         logger.info(f"Conversation ID from request: {chat_request.conversation_id}")
         
+        idempotency_key = request.headers.get("Idempotency-Key") or chat_request.idempotency_key
+        request_signature = (chat_request.conversation_id, chat_request.message)
+        if idempotency_key:
+            # Reserved locally before the first await (duplicates arriving while this request
+            # waits attach to its stream) and then in DynamoDB, for duplicates on other workers
+            try:
+                stream, is_owner = await chat_streams.reserve(
+                    current_user["username"], idempotency_key, request_signature
+                )
+            except IdempotencyKeyReused:
+                return JSONResponse(
+                    status_code=422,
+                    content={"detail": "Idempotency-Key was already used for a different message"}
+                )
+            except IdempotencyKeyBusy:
+                return JSONResponse(
+                    status_code=409,
+                    content={"detail": "This message is still being answered, please retry shortly"},
+                    headers={"Retry-After": "2"}
+                )
+            if not is_owner:
+                logger.info(f"Attaching duplicate request to chat stream {stream.stream_id}")
+                _, after_seq = parse_last_event_id(request.headers.get("Last-Event-ID"))
+                return StreamingResponse(
+                    stream.subscribe(after_seq),
+                    media_type="text/event-stream"
+                )
+        else:
+            stream = chat_streams.create(current_user["username"])
+
+        async def reject(status_code: int, detail: str, headers: Optional[dict] = None) -> JSONResponse:
+            """Turn the request away; duplicates already attached receive the same error"""
+            await stream.fail(detail)
+            chat_streams.discard(stream)
+            return JSONResponse(status_code=status_code, content={"detail": detail}, headers=headers)
+
         profile_data = {
             "profile1": current_user.get("profile1", {}),
             "profile2": current_user.get("profile2", {})
         }
         logger.info(f"Profile data: {json.dumps(profile_data, indent=2)}")
 
+        # Continue existing conversations on their agent; route new ones to a healthy agent
+        conversation_agent_id = None
+        if chat_request.conversation_id:
+            conversation_agent_id = chat_request.agent_id or ACTIVE_AGENT_VERSION
+            if conversation_agent_id not in AGENT_CONFIGS:
+                return await reject(400, f"Unknown agent: {conversation_agent_id}")
+        agent_id = dify_service.router.select_agent(conversation_agent_id, chat_request.agent_id)
+        if agent_id is None:
+            logger.warning("No healthy agent available for chat request")
+            return await reject(
+                503,
+                "The coach is temporarily unavailable",
+                headers={"Retry-After": str(int(CIRCUIT_BREAKER_CONFIG["open_seconds"]))}
+            )
+        logger.info(f"Routing chat request to agent {agent_id}")
+
+        # Wait for an LLM slot (bounded) or turn the request away with Retry-After
+        try:
+            admission_ticket = await admission_controller.acquire(agent_id)
+        except AdmissionRejected as e:
+            dify_service.router.breaker(agent_id).release_probe()
+            logger.warning(f"Rejected chat request: {e.reason}, retry after {e.retry_after}s")
+            return await reject(429, e.reason, headers={"Retry-After": str(e.retry_after)})
+        except asyncio.CancelledError:
+            # The client went away while queued; free the key and the probe slot
+            dify_service.router.breaker(agent_id).release_probe()
+            await stream.fail("Request cancelled")
+            chat_streams.discard(stream)
+            raise
+
+        call_context = DifyCallContext(
+            username=current_user["username"],
+            agent_id=agent_id,
+            conversation_id=chat_request.conversation_id
+        )
+
         async def event_generator():
             try:
                 logger.info("=== Starting Event Generator ===")
@@ -262,19 +524,23 @@ async def chat(
                     'is_complete': False,
                     'has_saved': False,
                     'interaction_type': 'content',
-                    'quiz_data': None
+                    'quiz_data': None,
+                    'streamed_response': ''
                 }
                 
                 logger.info(f"Initial chat_data: {json.dumps(chat_data, indent=2)}")
                 
+                started_at = time.monotonic()
                 try:
                     logger.info("Calling Dify service process_message...")
-                    for event in dify_service.process_message(
+                    events = dify_service.process_message(
                         username=current_user["username"],
                         message=chat_request.message,
                         profile_data=profile_data,
-                        conversation_id=chat_request.conversation_id
-                    ):
+                        agent_id=agent_id,
+                        context=call_context
+                    )
+                    async for event in events:
                         try:
                             logger.info(f"New Event Received: {json.dumps(event, indent=2)}")
                             logger.info(f"Event type: {event.get('event')}")
@@ -285,6 +551,15 @@ async def chat(
                                     chat_data['message_id'] = event.get('data', {}).get('message_id')
                                 if event.get('data', {}).get('conversation_id'):
                                     chat_data['conversation_id'] = event.get('data', {}).get('conversation_id')
+                                delta = event.get('data', {}).get('answer', '')
+                                if delta:
+                                    chat_data['streamed_response'] += delta
+                                    if chat_request.stream:
+                                        delta_data = {
+                                            'conversation_id': chat_data['conversation_id'],
+                                            'delta': delta
+                                        }
+                                        yield f"data: {json.dumps(delta_data)}\n\n"
                                 logger.info(f"Updated chat_data after agent_message: {json.dumps(chat_data, indent=2)}")
                             
                             elif event.get('event') == 'agent_thought':
@@ -311,6 +586,13 @@ async def chat(
                                 chat_data['usage_metrics'] = event.get('data', {}).get('metadata', {}).get('usage', {})
                                 chat_data['is_complete'] = True
                                 
+                                # Fall back to the streamed deltas when no agent_thought carried the full answer
+                                if not chat_data['response'] and chat_data['streamed_response']:
+                                    chat_data['response'] = chat_data['streamed_response']
+                                    interaction_type, quiz_data = detect_quiz_interaction(chat_data['response'])
+                                    chat_data['interaction_type'] = interaction_type
+                                    chat_data['quiz_data'] = quiz_data
+                                
                                 logger.info("Chat Data State Before Save:")
                                 logger.info(f"message_id: {chat_data['message_id']}")
                                 logger.info(f"conversation_id: {chat_data['conversation_id']}")
@@ -320,32 +602,38 @@ async def chat(
                                 
                                 if chat_data['message_id'] and chat_data['conversation_id'] and chat_data['response']:
                                     try:
-                                        success = database.save_chat_message(
+                                        chat_item = database.build_chat_item(
                                             message_id=chat_data['message_id'],
                                             conversation_id=chat_data['conversation_id'],
                                             username=current_user["username"],
-                                            agent_id=ACTIVE_AGENT_VERSION,
+                                            agent_id=agent_id,
                                             timestamp=datetime.now(),
                                             message=chat_request.message,
                                             response=chat_data['response'],
                                             interaction_type=chat_data['interaction_type'],
                                             quiz_data=chat_data.get('quiz_data'),
                                             dify_metadata=chat_data['dify_metadata'],
-                                            usage_metrics=chat_data['usage_metrics']
+                                            usage_metrics=chat_data['usage_metrics'],
+                                            idempotency_key=idempotency_key
                                         )
-                                        if success:
+                                        if chat_item:
+                                            # Persisted write-behind so DynamoDB latency stays off the response path
+                                            await chat_write_queue.submit(chat_item)
                                             chat_data['has_saved'] = True
-                                            logger.info("Successfully saved chat message")
+                                            logger.info("Queued chat message for saving")
                                             response_data = {
                                                 'conversation_id': chat_data['conversation_id'], 
+                                                'agent_id': agent_id,
                                                 'response': chat_data['response'],
                                                 'interaction_type': chat_data['interaction_type'],
                                                 'quiz_data': chat_data.get('quiz_data')
                                             }
+                                            # Duplicates reaching any worker now replay this answer
+                                            chat_streams.complete(stream, response_data)
                                             yield f"data: {json.dumps(response_data)}\n\n"
                                             yield "data: [DONE]\n\n"
                                         else:
-                                            logger.error("Failed to save chat message")
+                                            logger.error("Failed to build chat message")
                                     except Exception as e:
                                         logger.error(f"Error saving chat message: {str(e)}")
                                 else:
@@ -356,14 +644,22 @@ async def chat(
                                 logger.info("Skipping second message_end event (already saved)")
                                 continue
                             
-                            elif event.get('event') == 'error':
+                            elif event.get('event') == 'error' or 'error' in event:
                                 logger.error(f"Error event received: {event.get('error')}")
+                                # Relay upstream errors (e.g. overloaded) so the client can back off
+                                yield f"data: {json.dumps({'error': event.get('error') or 'Unknown error'})}\n\n"
                                 return
                                 
                         except Exception as e:
                             logger.error(f"Error processing event: {str(e)}")
                             continue
                             
+                except asyncio.CancelledError:
+                    # The stream cancels its producer once every client has disconnected
+                    if not chat_data['has_saved']:
+                        logger.info("Chat stream cancelled, cancelling upstream generation")
+                        spawn_background(abort_chat_turn(call_context, chat_request.message, chat_data, started_at))
+                    raise
                 except Exception as e:
                     logger.error(f"Error in Dify service process_message: {str(e)}")
                     return
@@ -371,60 +667,86 @@ async def chat(
             except Exception as e:
                 logger.error(f"Error in event_generator: {str(e)}")
                 return
+            finally:
+                await admission_ticket.release()
+
+        async def on_stream_done():
+            # Runs even if the producer is cancelled before it starts; a turn that never
+            # completed frees its idempotency key so a retry can run it
+            chat_streams.release(stream)
+            await admission_ticket.release()
 
+        # Generate in a producer task so duplicate requests can attach to the same turn
+        stream.start(event_generator(), on_done=on_stream_done)
         return StreamingResponse(
-            event_generator(),
+            stream.subscribe(),
             media_type="text/event-stream"
         )
         
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
+        if stream is not None and not stream.started:
+            await stream.fail("Internal error")
+            chat_streams.discard(stream)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
         )
 
+@app.get("/api/chat/stream/{stream_id}")
+async def resume_chat_stream(
+    stream_id: str,
+    request: Request,
+    current_user: dict = Depends(get_token_claims)
+):
+    """Resume a chat stream after the frame named in the Last-Event-ID header"""
+    stream = chat_streams.get(stream_id)
+    if stream is None or stream.username != current_user["username"]:
+        raise HTTPException(status_code=404, detail="Chat stream not found or expired")
+    last_stream_id, after_seq = parse_last_event_id(request.headers.get("Last-Event-ID"))
+    if last_stream_id and last_stream_id != stream_id:
+        after_seq = 0
+    metrics.increment("chat_streams_resumed")
+    logger.info(f"Resuming chat stream {stream_id} after event {after_seq}")
+    return StreamingResponse(
+        stream.subscribe(after_seq),
+        media_type="text/event-stream"
+    )
+
 @app.get("/api/chat/history")
 async def get_chat_history(
     conversation_id: Optional[str] = None,
-    current_user: dict = Depends(get_current_user)
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    order: Literal["asc", "desc"] = "asc",
+    include_metadata: bool = False,
+    current_user: dict = Depends(get_token_claims)
 ):
-    """Get chat history for the current user.
-       If conversation_id is not provided, group messages by conversation.
+    """Get chat history for the current user, one page at a time.
+       Pass the returned next_cursor to fetch the following page; order=desc returns newest first.
+       With conversation_id, that conversation's messages are returned in chronological order.
+       dify_metadata is only included when include_metadata is set.
     """
     try:
-        messages = database.get_chat_history(
-            username=current_user["username"],
-            conversation_id=conversation_id
-        )
-        # If a specific conversation_id is requested, return messages as is.
         if conversation_id:
-            return {"messages": messages}
-
-        # Otherwise, group messages by conversation_id.
-        conversations = {}
-        for msg in messages:
-            conv_id = msg.get("conversation_id")
-            if conv_id not in conversations:
-                conversations[conv_id] = {
-                    "conversation_id": conv_id,
-                    # Initialize last_timestamp with the message timestamp
-                    "last_timestamp": msg.get("timestamp"),
-                    "messages": []
-                }
-            # Update last_timestamp if the current message is newer.
-            if msg.get("timestamp") > conversations[conv_id]["last_timestamp"]:
-                conversations[conv_id]["last_timestamp"] = msg.get("timestamp")
-            conversations[conv_id]["messages"].append(msg)
-        
-        # Convert the grouped conversations to a sorted list,
-        # sorted by last_timestamp in descending order.
-        sorted_conversations = sorted(
-            conversations.values(), 
-            key=lambda x: x["last_timestamp"], 
-            reverse=True
+            return await repository.get_conversation_messages_page(
+                current_user["username"],
+                conversation_id,
+                limit=limit,
+                cursor=cursor,
+                include_metadata=include_metadata
+            )
+
+        return await repository.get_chat_history_page(
+            current_user["username"],
+            limit=limit,
+            cursor=cursor,
+            newest_first=(order == "desc")
         )
-        return {"conversations": sorted_conversations}
+    except database.InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    except database.ConversationNotFoundError:
+        raise HTTPException(status_code=404, detail="Conversation not found")
     except Exception as e:
         logger.error(f"Error getting chat history: {str(e)}")
         raise HTTPException(
@@ -432,18 +754,57 @@ async def get_chat_history(
             detail=str(e)
         )
 
+@app.get("/api/chat/conversations")
+async def list_conversations(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_token_claims)
+):
+    """List the current user's conversations (no message bodies), newest activity first"""
+    try:
+        return await repository.get_conversations_page(
+            current_user["username"],
+            limit=limit,
+            cursor=cursor
+        )
+    except database.InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    except Exception as e:
+        logger.error(f"Error listing conversations: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/quiz/history")
+async def get_quiz_history(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    interaction_type: Optional[Literal["quiz_prompt", "quiz_result"]] = None,
+    order: Literal["asc", "desc"] = "desc",
+    current_user: dict = Depends(get_token_claims)
+):
+    """Get the current user's quiz prompts and results (with scores), one page at a time"""
+    try:
+        return await repository.get_user_quiz_history_page(
+            current_user["username"],
+            limit=limit,
+            cursor=cursor,
+            interaction_type=interaction_type,
+            newest_first=(order == "desc")
+        )
+    except database.InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    except Exception as e:
+        logger.error(f"Error getting quiz history: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/user/profile")
 async def get_user_profile(current_user: dict = Depends(get_current_user)):
     """Get complete user profile data"""
     try:
-        user = database.get_user(current_user["username"])
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+        # get_current_user already loaded the (cached) profile; no second read needed
         profile_data = {
-            "profile1": user.get("profile1", {}),
-            "profile2": user.get("profile2", {})
+            "profile1": current_user.get("profile1", {}),
+            "profile2": current_user.get("profile2", {})
         }
-        logger.info(f"User data from database: {user}")
         logger.info(f"Returning profile data: {profile_data}")
         return profile_data
     except Exception as e:
@@ -452,7 +813,10 @@ async def get_user_profile(current_user: dict = Depends(get_current_user)):
 
 @app.get("/token/verify")
 async def verify_token(request: Request):
-    """Verify JWT token and return user data"""
+    """
+    Verify JWT token and return user data. Unlike the chat endpoints, which
+    trust the token's claims, this checks that the user still exists (via the user cache).
+    """
     try:
         auth_header = request.headers.get('Authorization')
         if not auth_header:
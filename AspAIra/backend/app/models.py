@@ -65,15 +65,23 @@ class ProfilePart2(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    profile1_complete: bool = False
+    profile2_complete: bool = False
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+    profile1_complete: bool = False
+    profile2_complete: bool = False
+    profile_version: int = 0
 
 class ChatRequest(BaseModel):
     message: str
     conversation_id: Optional[str] = None
     agent_type: str = "dify"  # Default to dify for now
     agent_version: str = "v1"  # Default to v1 for now
+    stream: bool = False  # Forward each agent_message delta as its own SSE frame
+    agent_id: Optional[str] = None  # Agent that owns conversation_id; for new conversations, the agent that sent the opening
+    idempotency_key: Optional[str] = None  # Same as the Idempotency-Key header; repeats attach to the original turn
 
 class ChatResponse(BaseModel):
     message: str
@@ -152,6 +160,21 @@ class QuizData(BaseModel):
     score: Optional[int] = None  # For quiz_result
     feedback: Optional[str] = None  # For quiz_result
 
+class QuizHistoryEntry(BaseModel):
+    """A quiz prompt or result from the quiz history API"""
+    message_id: str
+    conversation_id: str
+    agent_id: Optional[str] = None
+    timestamp: datetime
+    interaction_type: Literal["quiz_prompt", "quiz_result"]
+    quiz_data: Dict = Field(default_factory=dict)
+    score: Optional[int] = None
+
+class QuizHistoryPage(BaseModel):
+    """Model for a page of quiz history"""
+    quizzes: List[QuizHistoryEntry]
+    next_cursor: Optional[str] = None
+
 class ChatMessage(BaseModel):
     """Model for chat messages stored in the database"""
     message_id: str
@@ -165,7 +188,28 @@ class ChatMessage(BaseModel):
     dify_metadata: Optional[dict] = None
     quiz_data: Optional[dict] = None
     usage_metrics: Optional[dict] = None
+    status: Literal["completed", "aborted"] = "completed"
 
 class ChatHistory(BaseModel):
     """Model for chat history response"""
-    messages: List[ChatMessage] 
\ No newline at end of file
+    messages: List[ChatMessage]
+    next_cursor: Optional[str] = None
+
+class ConversationSummary(BaseModel):
+    """Conversation summary item in AspAIra_Conversations, updated on every chat write"""
+    username: str
+    conversation_id: str
+    agent_id: Optional[str] = None
+    first_timestamp: datetime
+    last_timestamp: datetime
+    last_message_id: str
+    last_interaction_type: Optional[str] = None
+    message_count: int = 0
+    aborted_count: int = 0
+    total_tokens: int = 0
+    total_price: float = 0.0
+
+class ConversationPage(BaseModel):
+    """Model for a page of the conversation listing"""
+    conversations: List[ConversationSummary]
+    next_cursor: Optional[str] = None 
\ No newline at end of file
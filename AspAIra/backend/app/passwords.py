@@ -0,0 +1,66 @@
+"""
+Password hashing for the AspAIra backend.
+Core functionality:
+1. Run bcrypt hashing and verification on a bounded thread pool, off the event loop
+2. Reject work beyond the pending limit instead of queueing it without bound
+3. Report rehashed passwords when the configured bcrypt cost changes
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+from .config import PASSWORD_HASHING_CONFIG
+from .metrics import metrics
+
+_rounds = PASSWORD_HASHING_CONFIG["bcrypt_rounds"]
+
+# Hashes at any other cost are flagged by needs_update and rehashed on next login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=_rounds,
+    bcrypt__min_rounds=_rounds,
+    bcrypt__max_rounds=_rounds
+)
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hash operations are already pending"""
+    def __init__(self, retry_after: int):
+        super().__init__("Too many sign-ins in progress")
+        self.retry_after = retry_after
+
+class PasswordHasher:
+    def __init__(self, config: Optional[dict] = None):
+        """Initialize the bcrypt worker pool"""
+        self.config = config or PASSWORD_HASHING_CONFIG
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.config["max_workers"],
+            thread_name_prefix="bcrypt"
+        )
+        self._pending = 0
+
+    async def hash(self, password: str) -> str:
+        return await self._run(pwd_context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """Verify a password; the second value is a new hash if the stored one is outdated"""
+        return await self._run(pwd_context.verify_and_update, password, hashed)
+
+    async def _run(self, func, *args):
+        if self._pending >= self.config["max_pending"]:
+            metrics.increment("password_hash_rejected")
+            raise PasswordHasherBusy(self.config["retry_after_seconds"])
+        self._pending += 1
+        metrics.set_gauge("password_hash_pending", self._pending)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+            metrics.set_gauge("password_hash_pending", self._pending)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+# Shared hasher for the worker process
+password_hasher = PasswordHasher()
@@ -0,0 +1,126 @@
+"""
+Async data access for the AspAIra backend.
+Core functionality:
+1. Run the blocking boto3 calls in database.py on a bounded thread pool
+2. Expose awaitable user, chat and evaluation operations to FastAPI routes
+3. Record per-operation DynamoDB latency
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from . import database
+from .config import REPOSITORY_CONFIG
+from .metrics import metrics
+
+class AsyncRepository:
+    def __init__(self, config: Optional[dict] = None):
+        """Initialize the worker pool; its size bounds concurrent DynamoDB calls"""
+        self.config = config or REPOSITORY_CONFIG
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.config["max_workers"],
+            thread_name_prefix="dynamodb"
+        )
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        try:
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            metrics.observe(
+                f"dynamodb_latency_ms.{func.__name__}",
+                (time.perf_counter() - start_time) * 1000
+            )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    # ============ USERS ============
+    async def get_user(self, username: str) -> Optional[Dict]:
+        return await self._run(database.get_user, username)
+
+    async def get_user_from_token(self, token: str) -> Optional[Dict]:
+        return await self._run(database.get_user_from_token, token)
+
+    async def create_user(self, username: str, hashed_password: str) -> bool:
+        return await self._run(database.create_user, username, hashed_password)
+
+    async def update_password_hash(self, username: str, hashed_password: str) -> bool:
+        return await self._run(database.update_password_hash, username, hashed_password)
+
+    async def update_profile_part1(self, username: str, profile_data: dict):
+        return await self._run(database.update_profile_part1, username, profile_data)
+
+    async def update_profile_part2(self, username: str, profile_data: dict):
+        return await self._run(database.update_profile_part2, username, profile_data)
+
+    async def get_profile_status(self, username: str) -> Dict:
+        return await self._run(database.get_profile_status, username)
+
+    async def scan_all_users(self) -> List[Dict]:
+        return await self._run(database.scan_all_users)
+
+    # ============ CHATS ============
+    async def save_chat_message(self, **kwargs) -> bool:
+        return await self._run(database.save_chat_message, **kwargs)
+
+    async def get_chat_history(self, username: str, conversation_id: Optional[str] = None) -> List[Dict]:
+        return await self._run(database.get_chat_history, username, conversation_id)
+
+    async def get_conversations(self, username: str) -> List[Dict]:
+        return await self._run(database.get_conversations, username)
+
+    async def get_chat_history_page(self, username: str, limit: int = 50, cursor: Optional[str] = None,
+                                    newest_first: bool = False) -> Dict:
+        return await self._run(database.get_chat_history_page, username, limit, cursor, newest_first)
+
+    async def get_conversation_messages_page(self, username: str, conversation_id: str, limit: int = 50,
+                                             cursor: Optional[str] = None, include_metadata: bool = False) -> Dict:
+        return await self._run(
+            database.get_conversation_messages_page, username, conversation_id, limit, cursor, include_metadata
+        )
+
+    async def get_conversations_page(self, username: str, limit: int = 20, cursor: Optional[str] = None) -> Dict:
+        return await self._run(database.get_conversations_page, username, limit, cursor)
+
+    async def get_user_quiz_history(self, username: str) -> List[Dict]:
+        return await self._run(database.get_user_quiz_history, username)
+
+    async def get_user_quiz_history_page(self, username: str, limit: int = 20, cursor: Optional[str] = None,
+                                         interaction_type: Optional[str] = None,
+                                         newest_first: bool = True) -> Dict:
+        return await self._run(
+            database.get_user_quiz_history_page, username, limit, cursor, interaction_type, newest_first
+        )
+
+    # ============ IDEMPOTENCY KEYS ============
+    async def reserve_idempotency_key(self, username: str, idempotency_key: str, request_hash: str, owner: str,
+                                      ttl_seconds: float) -> Optional[Dict]:
+        return await self._run(
+            database.reserve_idempotency_key, username, idempotency_key, request_hash, owner, ttl_seconds
+        )
+
+    async def complete_idempotency_key(self, username: str, idempotency_key: str, owner: str, result: str,
+                                       ttl_seconds: float) -> bool:
+        return await self._run(
+            database.complete_idempotency_key, username, idempotency_key, owner, result, ttl_seconds
+        )
+
+    async def release_idempotency_key(self, username: str, idempotency_key: str, owner: str) -> bool:
+        return await self._run(database.release_idempotency_key, username, idempotency_key, owner)
+
+    # ============ WRITE-BEHIND ============
+    # Used by the chat write queue, so its flushes share this pool's thread limit
+    async def write_conversation_turns(self, items: List[Dict]) -> int:
+        return await self._run(database.write_conversation_turns, items)
+
+    # ============ EVALUATIONS ============
+    async def get_conversation_evaluations(self, conversation_id: str) -> List[Dict]:
+        return await self._run(database.get_conversation_evaluations, conversation_id)
+
+# Shared repository for the worker process
+repository = AsyncRepository()
@@ -0,0 +1,113 @@
+"""
+Admission control for LLM calls.
+Core functionality:
+1. Cap in-flight Dify streams globally and per agent
+2. Hold excess requests in a bounded wait queue with a deadline
+3. Reject immediately with a Retry-After hint once the queue is full
+4. Reject while a downstream dependency reports backpressure (e.g. the chat write queue)
+"""
+import asyncio
+import math
+from typing import Callable, Dict, Optional
+from ..config import ADMISSION_CONFIG
+from ..metrics import metrics
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries the Retry-After hint in seconds"""
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    """A granted slot; release() is idempotent so it can be called from several cleanup paths"""
+    def __init__(self, controller: "AdmissionController", agent_id: str):
+        self.controller = controller
+        self.agent_id = agent_id
+        self.released = False
+
+    async def release(self):
+        if self.released:
+            return
+        self.released = True
+        await self.controller._release(self.agent_id)
+
+class AdmissionController:
+    def __init__(self, config: Optional[dict] = None):
+        """Initialize counters; limits come from ADMISSION_CONFIG"""
+        self.config = config or ADMISSION_CONFIG
+        self._condition = asyncio.Condition()
+        self._in_flight = 0
+        self._in_flight_by_agent: Dict[str, int] = {}
+        self._waiting = 0
+        self._backpressure: Dict[str, Callable[[], bool]] = {}
+
+    def add_backpressure(self, name: str, is_saturated: Callable[[], bool]):
+        """Turn new requests away while is_saturated() returns True"""
+        self._backpressure[name] = is_saturated
+
+    def _agent_limit(self, agent_id: str) -> int:
+        return self.config["per_agent_max_in_flight"].get(
+            agent_id, self.config["default_agent_max_in_flight"]
+        )
+
+    def _has_capacity(self, agent_id: str) -> bool:
+        return (
+            self._in_flight < self.config["max_in_flight"]
+            and self._in_flight_by_agent.get(agent_id, 0) < self._agent_limit(agent_id)
+        )
+
+    def _retry_after(self) -> int:
+        """Rough wait estimate: how many queue drains the backlog represents"""
+        capacity = max(self.config["max_in_flight"], 1)
+        backlog_rounds = (self._waiting + 1) / capacity
+        return max(1, math.ceil(backlog_rounds * self.config["retry_after_seconds"]))
+
+    def _update_gauges(self):
+        metrics.set_gauge("admission_in_flight", self._in_flight)
+        metrics.set_gauge("admission_waiting", self._waiting)
+
+    async def acquire(self, agent_id: str) -> AdmissionTicket:
+        """Wait for a slot for agent_id, or raise AdmissionRejected"""
+        for name, is_saturated in self._backpressure.items():
+            if is_saturated():
+                metrics.increment(f"admission_rejected_{name}")
+                raise AdmissionRejected("The coach is busy, please try again shortly",
+                                        self.config["retry_after_seconds"])
+        async with self._condition:
+            if self._has_capacity(agent_id):
+                self._grant(agent_id)
+                return AdmissionTicket(self, agent_id)
+            if self._waiting >= self.config["max_queue_size"]:
+                metrics.increment("admission_rejected_queue_full")
+                raise AdmissionRejected("Too many requests waiting for the coach", self._retry_after())
+
+            self._waiting += 1
+            self._update_gauges()
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self._has_capacity(agent_id)),
+                    timeout=self.config["queue_timeout"]
+                )
+            except asyncio.TimeoutError:
+                metrics.increment("admission_rejected_timeout")
+                raise AdmissionRejected("Timed out waiting for the coach", self._retry_after())
+            finally:
+                self._waiting -= 1
+                self._update_gauges()
+
+            self._grant(agent_id)
+            return AdmissionTicket(self, agent_id)
+
+    def _grant(self, agent_id: str):
+        self._in_flight += 1
+        self._in_flight_by_agent[agent_id] = self._in_flight_by_agent.get(agent_id, 0) + 1
+        metrics.increment("admission_granted")
+        self._update_gauges()
+
+    async def _release(self, agent_id: str):
+        async with self._condition:
+            self._in_flight -= 1
+            self._in_flight_by_agent[agent_id] -= 1
+            self._update_gauges()
+            self._condition.notify_all()
@@ -0,0 +1,313 @@
+"""
+Shared, resumable chat streams for /api/chat.
+Core functionality:
+1. Run each chat turn as a producer task that records its SSE frames
+2. Tag frames with "<stream_id>:<seq>" event IDs and keep a bounded ring buffer
+3. Let any number of requests subscribe, resuming after a Last-Event-ID
+4. Cancel the producer once nobody has been subscribed for the grace period
+5. Keep finished streams for a while so duplicates and reconnects can be replayed
+6. Reserve an idempotency key before the turn is admitted, so simultaneous
+   duplicates attach to one stream instead of each calling Dify
+7. Reserve the key in a shared store too, so duplicates reaching another worker
+   (or a restarted one) replay the stored answer instead of generating a new one
+"""
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+from ..config import CHAT_STREAM_CONFIG
+from ..database import IDEMPOTENCY_COMPLETED
+from ..metrics import metrics
+
+# on_done callbacks and key-store writes in flight; the event loop only keeps weak references to tasks
+_callback_tasks: Set[asyncio.Task] = set()
+
+def _spawn(coro: Awaitable):
+    task = asyncio.ensure_future(coro)
+    _callback_tasks.add(task)
+    task.add_done_callback(_callback_tasks.discard)
+
+class IdempotencyKeyReused(Exception):
+    """The Idempotency-Key was first used for a different message"""
+    pass
+
+class IdempotencyKeyBusy(Exception):
+    """Another worker is still generating the turn for this Idempotency-Key"""
+    pass
+
+def request_hash(request_signature: tuple) -> str:
+    """Stable digest of a request signature, comparable across workers"""
+    return hashlib.sha256(json.dumps(list(request_signature)).encode('utf-8')).hexdigest()
+
+async def _replay_frames(result: str) -> AsyncIterator[str]:
+    """Final frames of a turn completed on another worker"""
+    yield f"data: {result}\n\n"
+    yield "data: [DONE]\n\n"
+
+def parse_last_event_id(last_event_id: Optional[str]) -> Tuple[Optional[str], int]:
+    """Split a "<stream_id>:<seq>" event ID; malformed IDs resume from the start"""
+    if not last_event_id or ':' not in last_event_id:
+        return None, 0
+    stream_id, _, seq = last_event_id.rpartition(':')
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return stream_id, 0
+
+class ChatStream:
+    """Frames produced by one chat turn, shared by every request attached to it"""
+
+    def __init__(self, username: str, config: Optional[dict] = None, idempotency_key: Optional[str] = None,
+                 request_signature: Optional[tuple] = None):
+        self.config = config or CHAT_STREAM_CONFIG
+        self.stream_id = uuid.uuid4().hex
+        self.username = username
+        self.idempotency_key = idempotency_key
+        self.request_signature = request_signature  # Identifies the request an idempotency key was first used for
+        self.key_settled = False  # The key's shared reservation was completed or released
+        self.frames = deque(maxlen=self.config["max_frames_per_stream"])  # (seq, frame) ring buffer
+        self.last_seq = 0
+        self.buffered_bytes = 0
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self._condition = asyncio.Condition()
+        self._producer: Optional[asyncio.Task] = None
+        self._abandon_handle: Optional[asyncio.TimerHandle] = None
+        # Set by the registry while it holds the stream, to keep its totals current
+        self.on_bytes: Optional[Callable[[int], None]] = None
+        self.on_finish: Optional[Callable[["ChatStream"], None]] = None
+
+    def start(self, frames: AsyncIterator[str], on_done: Optional[Callable[[], Awaitable]] = None):
+        """Start pumping frames from the generator into the stream"""
+        self._producer = asyncio.create_task(self._pump(frames))
+        if on_done is not None:
+            # Runs even if the producer is cancelled before it gets to execute
+            self._producer.add_done_callback(lambda _: _spawn(on_done()))
+
+    @property
+    def started(self) -> bool:
+        return self._producer is not None
+
+    async def _append(self, frame: str):
+        async with self._condition:
+            self.last_seq += 1
+            frame = f"id: {self.stream_id}:{self.last_seq}\n{frame}"
+            delta = len(frame)
+            if len(self.frames) == self.frames.maxlen:
+                delta -= len(self.frames[0][1])
+            self.frames.append((self.last_seq, frame))
+            self.buffered_bytes += delta
+            if self.on_bytes is not None:
+                self.on_bytes(delta)
+            self._condition.notify_all()
+
+    async def _finish(self):
+        if not self.done:
+            self.done = True
+            self.finished_at = time.monotonic()
+            if self.on_finish is not None:
+                self.on_finish(self)
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def _pump(self, frames: AsyncIterator[str]):
+        try:
+            async for frame in frames:
+                await self._append(frame)
+        finally:
+            await self._finish()
+
+    async def fail(self, error: str):
+        """End a stream whose turn never started, telling any attached duplicates why"""
+        await self._append(f"data: {json.dumps({'error': error})}\n\n")
+        await self._finish()
+
+    async def subscribe(self, after_seq: int = 0) -> AsyncIterator[str]:
+        """
+        Yield frames with a sequence number above after_seq, then new frames
+        until the turn is done. Frames already evicted from the ring buffer are
+        skipped; the final frame always carries the complete response.
+        """
+        self.subscribers += 1
+        if self._abandon_handle is not None:
+            self._abandon_handle.cancel()
+            self._abandon_handle = None
+        position = after_seq
+        try:
+            while True:
+                async with self._condition:
+                    await self._condition.wait_for(lambda: position < self.last_seq or self.done)
+                    pending = [frame for seq, frame in self.frames if seq > position]
+                    position = self.last_seq
+                    finished = self.done
+                for frame in pending:
+                    yield frame
+                if finished and position >= self.last_seq:
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self._producer is not None:
+                # Give the client a chance to reconnect before abandoning the answer
+                self._abandon_handle = asyncio.get_running_loop().call_later(
+                    self.config["resume_grace_seconds"], self._cancel_if_abandoned
+                )
+
+    def _cancel_if_abandoned(self):
+        self._abandon_handle = None
+        if self.subscribers == 0 and not self.done:
+            metrics.increment("chat_streams_abandoned")
+            self._producer.cancel()
+
+class ChatStreamRegistry:
+    """
+    In-flight and recently finished chat streams, by stream id and idempotency
+    key. With a key_store (see AsyncRepository) keys are also reserved in
+    DynamoDB, which is what stops duplicates that reach a different worker.
+    Finished streams are queued in finish order and buffered bytes are kept
+    as a running total, so pruning on every lookup costs O(1) amortized.
+    """
+
+    def __init__(self, config: Optional[dict] = None, key_store: Optional[Any] = None):
+        self.config = config or CHAT_STREAM_CONFIG
+        self.key_store = key_store
+        self._streams: "OrderedDict[str, ChatStream]" = OrderedDict()
+        self._keys: Dict[Tuple[str, str], str] = {}  # (username, idempotency key) -> stream_id
+        self._stream_keys: Dict[str, Tuple[str, str]] = {}  # stream_id -> (username, idempotency key)
+        self._finished: Deque[str] = deque()  # stream_ids in finish order; may hold removed ones
+        self._buffered_bytes = 0
+
+    def get(self, stream_id: str) -> Optional[ChatStream]:
+        self._prune()
+        return self._streams.get(stream_id)
+
+    def get_by_key(self, username: str, idempotency_key: str) -> Optional[ChatStream]:
+        self._prune()
+        stream = self._streams.get(self._keys.get((username, idempotency_key), ""))
+        if stream is not None:
+            metrics.increment("idempotency_replays" if stream.done else "idempotency_attached")
+        return stream
+
+    def create(self, username: str, idempotency_key: Optional[str] = None,
+               request_signature: Optional[tuple] = None) -> ChatStream:
+        """Register a stream and, locally, its idempotency key"""
+        self._prune()
+        stream = ChatStream(username, self.config, idempotency_key, request_signature)
+        stream.on_bytes = self._add_bytes
+        stream.on_finish = self._on_finish
+        self._streams[stream.stream_id] = stream
+        if idempotency_key:
+            self._keys[(username, idempotency_key)] = stream.stream_id
+            self._stream_keys[stream.stream_id] = (username, idempotency_key)
+        return stream
+
+    def _add_bytes(self, delta: int):
+        self._buffered_bytes += delta
+
+    def _on_finish(self, stream: ChatStream):
+        self._finished.append(stream.stream_id)
+
+    async def reserve(self, username: str, idempotency_key: str,
+                      request_signature: tuple) -> Tuple[ChatStream, bool]:
+        """
+        Find or reserve the turn for an idempotency key. Returns (stream, True)
+        when the caller owns a new turn and must start the stream, or fail and
+        discard it; (stream, False) when it should subscribe to an existing one:
+        this worker's turn, or a replay of a turn completed on another worker.
+        The stream is registered before the first await, so duplicates arriving
+        meanwhile attach to it. Raises IdempotencyKeyReused or IdempotencyKeyBusy.
+        """
+        stream = self.get_by_key(username, idempotency_key)
+        if stream is not None:
+            if stream.request_signature != request_signature:
+                raise IdempotencyKeyReused(idempotency_key)
+            return stream, False
+
+        stream = self.create(username, idempotency_key, request_signature)
+        if self.key_store is None:
+            return stream, True
+        digest = request_hash(request_signature)
+        try:
+            existing = await self.key_store.reserve_idempotency_key(
+                username, idempotency_key, digest, stream.stream_id, self.config["ttl_seconds"]
+            )
+        except BaseException:
+            await self._abandon(stream, "Internal error")
+            raise
+        if existing is None:
+            return stream, True
+
+        stream.key_settled = True  # The reservation belongs to the original request
+        if existing.get('request_hash') != digest:
+            await self._abandon(stream, "Idempotency-Key was already used for a different message")
+            raise IdempotencyKeyReused(idempotency_key)
+        if existing.get('status') == IDEMPOTENCY_COMPLETED:
+            metrics.increment("idempotency_replays_shared")
+            stream.start(_replay_frames(existing['result']))
+            return stream, False
+        metrics.increment("idempotency_busy_elsewhere")
+        await self._abandon(stream, "This message is still being answered")
+        raise IdempotencyKeyBusy(idempotency_key)
+
+    async def _abandon(self, stream: ChatStream, error: str):
+        await stream.fail(error)
+        self.discard(stream)
+
+    def complete(self, stream: ChatStream, response_data: dict):
+        """Record a keyed turn's final response, so duplicates on other workers replay it"""
+        if stream.idempotency_key is None or stream.key_settled:
+            return
+        stream.key_settled = True
+        if self.key_store is not None:
+            _spawn(self.key_store.complete_idempotency_key(
+                stream.username, stream.idempotency_key, stream.stream_id, json.dumps(response_data),
+                self.config["ttl_seconds"]
+            ))
+
+    def release(self, stream: ChatStream):
+        """Free the shared reservation of a turn that did not complete, so a retry runs it"""
+        if stream.idempotency_key is None or stream.key_settled:
+            return
+        stream.key_settled = True
+        if self.key_store is not None:
+            _spawn(self.key_store.release_idempotency_key(
+                stream.username, stream.idempotency_key, stream.stream_id
+            ))
+
+    def discard(self, stream: ChatStream):
+        """Forget a stream whose turn was rejected, so a retry with the same key starts afresh"""
+        self.release(stream)
+        self._remove(stream.stream_id)
+
+    def _remove(self, stream_id: str):
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return
+        stream.on_bytes = None
+        stream.on_finish = None
+        self._buffered_bytes -= stream.buffered_bytes
+        key = self._stream_keys.pop(stream_id, None)
+        if key is not None and self._keys.get(key) == stream_id:
+            del self._keys[key]
+
+    def _prune(self):
+        """Drop expired finished streams, then the oldest finished ones beyond the entry and memory caps"""
+        now = time.monotonic()
+        while self._finished:
+            stream = self._streams.get(self._finished[0])
+            if stream is None:
+                # Already discarded; just drop the stale id
+                self._finished.popleft()
+                continue
+            if (now - stream.finished_at <= self.config["ttl_seconds"]
+                    and len(self._streams) <= self.config["max_entries"]
+                    and self._buffered_bytes <= self.config["max_buffered_bytes"]):
+                break
+            self._finished.popleft()
+            self._remove(stream.stream_id)
+
+        metrics.set_gauge("chat_streams_registered", len(self._streams))
+        metrics.set_gauge("chat_streams_buffered_bytes", self._buffered_bytes)
@@ -0,0 +1,187 @@
+"""
+Write-behind persistence for chat messages.
+Core functionality:
+1. Accept prepared chat items and acknowledge immediately
+2. Coalesce queued items into batches, written one transaction per conversation
+3. Write each conversation's messages and its summary update atomically
+4. Retry throttled or otherwise transient failures with exponential backoff
+5. Append items that still fail to a dead-letter file instead of dropping them
+6. Report saturation so admission control can turn new chats away
+7. Drain everything still queued on shutdown
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional
+from .. import database
+from ..config import WRITE_QUEUE_CONFIG
+from ..metrics import metrics
+from ..repository import repository
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def append_dead_letters(path: str, items: List[dict]):
+    """Append chat items that could not be written, one JSON object per line"""
+    with open(path, 'a', encoding='utf-8') as dead_letters:
+        for item in items:
+            dead_letters.write(json.dumps(item, default=_json_default) + "\n")
+        dead_letters.flush()
+        os.fsync(dead_letters.fileno())
+
+class ChatWriteQueue:
+    def __init__(self, config: Optional[dict] = None):
+        """Initialize the queue; the flush worker starts with start()"""
+        self.config = config or WRITE_QUEUE_CONFIG
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Start the background flush worker"""
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.config["max_queue_size"])
+        self._worker = asyncio.create_task(self._run())
+        print(f"Started chat write queue (batch_size={self.config['batch_size']})")
+
+    @property
+    def saturated(self) -> bool:
+        """Whether the backlog is large enough that new chat turns should be refused"""
+        if self._queue is None:
+            return False
+        return self._queue.qsize() >= self.config["max_queue_size"] * self.config["backpressure_ratio"]
+
+    async def submit(self, item: dict):
+        """Queue a chat item for persistence without waiting for DynamoDB"""
+        if self._queue is None:
+            # Queue not running (e.g. scripts or tests); write synchronously off-loop
+            await self._flush([item])
+            return
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Admission stops new turns well before this; turns already running wait for room
+            print("Chat write queue is full, waiting for a flush")
+            metrics.increment("chat_write_queue_overflow")
+            await self._queue.put(item)
+        metrics.increment("chat_write_queue_submitted")
+        metrics.set_gauge("chat_write_queue_depth", self._queue.qsize())
+
+    async def stop(self):
+        """Flush everything still queued and stop the worker"""
+        if self._worker is None:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._queue = None
+        print("Chat write queue drained and stopped")
+
+    async def _run(self):
+        """Collect items into batches and flush them"""
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.config["flush_interval"]
+            while len(batch) < self.config["batch_size"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+                metrics.set_gauge("chat_write_queue_depth", self._queue.qsize())
+
+    async def _flush(self, batch: List[dict]):
+        """Write a batch, each conversation's messages together with its summary"""
+        start_time = time.perf_counter()
+        conversations: Dict[tuple, List[dict]] = {}
+        for item in batch:
+            conversations.setdefault((item['username'], item['conversation_id']), []).append(item)
+        # Conversations are independent transactions, so one failing does not hold up the rest
+        results = await asyncio.gather(*(
+            self._with_retries(repository.write_conversation_turns, items) for items in conversations.values()
+        ))
+        failed = [item for items, updated in zip(conversations.values(), results) if updated is None for item in items]
+        if failed:
+            metrics.increment("chat_write_items_failed", len(failed))
+            print(f"Error flushing {len(failed)} chat messages, moving them to the dead-letter file")
+            await self._dead_letter(failed)
+        written = len(batch) - len(failed)
+        if written:
+            metrics.observe("chat_write_flush_latency_ms", (time.perf_counter() - start_time) * 1000)
+            metrics.increment("chat_write_flushes")
+            metrics.increment("chat_write_items_written", written)
+            metrics.increment("conversation_summary_updates", sum(updated or 0 for updated in results))
+
+    async def _dead_letter(self, items: List[dict]):
+        """Keep items that could not be written on disk so they can be replayed"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, append_dead_letters, self.config["dead_letter_path"], items)
+            metrics.increment("chat_write_items_dead_lettered", len(items))
+        except Exception as e:
+            metrics.increment("chat_write_items_lost", len(items))
+            print(f"Error writing {len(items)} chat messages to the dead-letter file: {str(e)}")
+
+    async def _with_retries(self, func, *args):
+        """Await a repository call, backing off while it fails transiently; None on failure"""
+        attempt = 0
+        while True:
+            try:
+                return await func(*args)
+            except Exception as e:
+                if database.is_transient_error(e) and attempt < self.config["max_retries"]:
+                    backoff = self.config["base_backoff"] * (2 ** attempt)
+                    backoff = min(backoff, self.config["max_backoff"]) * random.uniform(0.5, 1.0)
+                    attempt += 1
+                    metrics.increment(
+                        "chat_write_throttled" if database.is_throttling_error(e) else "chat_write_retried"
+                    )
+                    print(f"Chat write failed ({str(e)}), retry {attempt} in {backoff:.2f}s")
+                    await asyncio.sleep(backoff)
+                    continue
+                print(f"Error in {func.__name__}: {str(e)}")
+                return None
+
+def replay_dead_letters(path: Optional[str] = None) -> int:
+    """
+    Write the items of a dead-letter file through the normal flush path.
+    Messages already stored are skipped, so a file can safely be replayed twice.
+    Items that fail again are appended to a fresh dead-letter file.
+    Returns the number of items replayed.
+    """
+    queue = ChatWriteQueue()
+    path = path or queue.config["dead_letter_path"]
+    if not os.path.exists(path):
+        print(f"No dead-letter file at {path}")
+        return 0
+    replaying = f"{path}.replaying"
+    os.replace(path, replaying)
+    with open(replaying, encoding='utf-8') as dead_letters:
+        items = [json.loads(line, parse_float=Decimal) for line in dead_letters if line.strip()]
+
+    async def replay():
+        batch_size = queue.config["batch_size"]
+        for start in range(0, len(items), batch_size):
+            await queue._flush(items[start:start + batch_size])
+
+    asyncio.run(replay())
+    os.remove(replaying)
+    print(f"Replayed {len(items)} chat messages from {path}")
+    return len(items)
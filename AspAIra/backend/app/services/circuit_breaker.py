@@ -0,0 +1,149 @@
+"""
+Per-agent circuit breakers for Dify calls.
+Core functionality:
+1. Track recent call outcomes (errors and slow first events) per agent
+2. Trip open when the error or slow-call rate crosses its threshold
+3. Probe a tripped agent with a limited number of half-open calls
+4. Pick the first healthy agent from an ordered fallback list
+"""
+import time
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+from ..config import CIRCUIT_BREAKER_CONFIG, AGENT_FALLBACK_ORDER
+from ..metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    def __init__(self, agent_id: str, config: Optional[dict] = None):
+        """Initialize a closed breaker with an empty outcome window"""
+        self.agent_id = agent_id
+        self.config = config or CIRCUIT_BREAKER_CONFIG
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.half_open_probes = 0
+        self._outcomes = deque(maxlen=self.config["window_size"])  # (failed, slow) pairs
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """Whether a new call may be sent to this agent right now"""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.config["open_seconds"]:
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.half_open_probes >= self.config["half_open_max_probes"]:
+                    return False
+                self.half_open_probes += 1
+            return True
+
+    def is_available(self) -> bool:
+        """Whether allow_request would currently succeed, without taking a probe slot"""
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at >= self.config["open_seconds"]
+            if self.state == HALF_OPEN:
+                return self.half_open_probes < self.config["half_open_max_probes"]
+            return True
+
+    def record_success(self, latency_ms: float):
+        """Record a completed call; slow calls count against the agent"""
+        slow = latency_ms >= self.config["slow_call_ms"]
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.half_open_probes = max(0, self.half_open_probes - 1)
+                if slow:
+                    self._trip()
+                else:
+                    self._transition(CLOSED)
+                return
+            self._outcomes.append((False, slow))
+            self._evaluate()
+
+    def record_failure(self):
+        """Record a failed call (error status, error event or timeout)"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.half_open_probes = max(0, self.half_open_probes - 1)
+                self._trip()
+                return
+            self._outcomes.append((True, False))
+            self._evaluate()
+
+    def release_probe(self):
+        """Give back a half-open probe slot for a call that was never sent"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.half_open_probes = max(0, self.half_open_probes - 1)
+
+    def _evaluate(self):
+        total = len(self._outcomes)
+        if total < self.config["min_calls"]:
+            return
+        failures = sum(1 for failed, _ in self._outcomes if failed)
+        slow_calls = sum(1 for _, slow in self._outcomes if slow)
+        if (failures / total >= self.config["failure_rate_threshold"]
+                or slow_calls / total >= self.config["slow_call_rate_threshold"]):
+            self._trip()
+
+    def _trip(self):
+        self.opened_at = time.monotonic()
+        self._transition(OPEN)
+        metrics.increment(f"circuit_breaker_trips.{self.agent_id}")
+
+    def _transition(self, state: str):
+        if state != self.state:
+            print(f"Circuit breaker for {self.agent_id}: {self.state} -> {state}")
+        self.state = state
+        if state != HALF_OPEN:
+            self.half_open_probes = 0
+        if state == CLOSED:
+            self._outcomes.clear()
+        metrics.set_gauge(f"circuit_breaker_open.{self.agent_id}", 0 if state == CLOSED else 1)
+
+class AgentRouter:
+    """Routes new conversations to the first agent whose breaker allows traffic"""
+
+    def __init__(self, agent_ids: Optional[List[str]] = None):
+        self.fallback_order = agent_ids or AGENT_FALLBACK_ORDER
+        self.breakers: Dict[str, CircuitBreaker] = {
+            agent_id: CircuitBreaker(agent_id) for agent_id in self.fallback_order
+        }
+
+    def breaker(self, agent_id: str) -> CircuitBreaker:
+        if agent_id not in self.breakers:
+            self.breakers[agent_id] = CircuitBreaker(agent_id)
+        return self.breakers[agent_id]
+
+    def _candidates(self, preferred_agent_id: Optional[str] = None) -> List[str]:
+        if preferred_agent_id and preferred_agent_id in self.breakers:
+            return [preferred_agent_id] + [a for a in self.fallback_order if a != preferred_agent_id]
+        return self.fallback_order
+
+    def select_agent(self, conversation_agent_id: Optional[str] = None,
+                     preferred_agent_id: Optional[str] = None) -> Optional[str]:
+        """
+        Existing conversations stay on their agent because Dify conversations
+        belong to one app; new conversations try preferred_agent_id (the agent
+        whose opening statement the user saw) and then fall back along the
+        ordered list. Returns None when no agent is currently accepting traffic.
+        """
+        if conversation_agent_id:
+            return conversation_agent_id if self.breaker(conversation_agent_id).allow_request() else None
+        for agent_id in self._candidates(preferred_agent_id):
+            if self.breakers[agent_id].allow_request():
+                if agent_id != self.fallback_order[0]:
+                    metrics.increment(f"agent_fallback.{agent_id}")
+                return agent_id
+        return None
+
+    def peek_agent(self) -> Optional[str]:
+        """The agent a new conversation would be routed to now, without taking a probe slot"""
+        for agent_id in self.fallback_order:
+            if self.breakers[agent_id].is_available():
+                return agent_id
+        return None
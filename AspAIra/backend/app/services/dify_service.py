@@ -3,65 +3,189 @@ Service for handling Dify API integration.
 Core functionality:
 1. Send messages to Dify
 2. Handle streaming responses
-3. Save basic chat interactions
-4. Return essential response data
+3. Return essential response data (persistence is left to the caller)
+
+All Dify traffic goes through one pooled, keep-alive ``httpx.AsyncClient`` per
+service instance, so a slow LLM stream only occupies a connection rather than
+the event loop.
 """
 import os
+import re
 import json
-import requests
+import math
+import yaml
+import httpx
 #from sseclient import SSEClient
-from typing import Dict, AsyncGenerator, Optional, Any, List
-from datetime import datetime
+from typing import Dict, AsyncGenerator, Optional
 import time
-from ..database import save_chat_message, get_chat_history
-from ..config import AGENT_CONFIGS, ACTIVE_AGENT_VERSION
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+from ..config import AGENT_CONFIGS, ACTIVE_AGENT_VERSION, DIFY_CLIENT_CONFIG, DIFY_APP_EXPORT_DIR
+from .circuit_breaker import AgentRouter
+
+# Dify prompt variables look like {{variable_name}}
+TEMPLATE_VARIABLE_PATTERN = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+# Rough tokenizer-free estimate used for turns that never reached message_end
+ESTIMATED_CHARS_PER_TOKEN = 4
+
+@dataclass
+class DifyCallContext:
+    """
+    State for a single message sent to Dify. Created per request and never
+    shared, so concurrent conversations cannot see each other's ids.
+    """
+    username: str
+    agent_id: str
+    conversation_id: Optional[str] = None
+    message_id: Optional[str] = None
+    task_id: Optional[str] = None
+    first_event_latency_ms: Optional[float] = None
 
 class DifyService:
+    """
+    Shared, stateless Dify client. Holds only the pooled HTTP client, caches
+    and the agent router; agent settings are looked up per call and all
+    per-conversation state lives in a DifyCallContext.
+    """
     def __init__(self):
-        """Initialize DifyService with configuration and headers"""
-        self.conversation_id = None  # Initialize conversation_id as None
-        self.config = AGENT_CONFIGS[ACTIVE_AGENT_VERSION]
-        self.headers = {
-            "Authorization": f"Bearer {self.config['api_key']}",
+        """Initialize the service; agent configuration is looked up per call"""
+        self._client: Optional[httpx.AsyncClient] = None
+        self._opening_statements: Dict[str, str] = {}  # agent_id -> raw opening statement
+        self._token_prices: Dict[str, Dict] = {}  # agent_id -> prices from its last message_end
+        self.router = AgentRouter()  # Per-agent circuit breakers and fallback order
+        print(f"Initialized DifyService for agents: {', '.join(AGENT_CONFIGS)}")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Shared HTTP client, created on first use so it binds to the running loop"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    connect=DIFY_CLIENT_CONFIG["connect_timeout"],
+                    read=DIFY_CLIENT_CONFIG["read_timeout"],
+                    write=DIFY_CLIENT_CONFIG["write_timeout"],
+                    pool=DIFY_CLIENT_CONFIG["pool_timeout"]
+                ),
+                limits=httpx.Limits(
+                    max_connections=DIFY_CLIENT_CONFIG["max_connections"],
+                    max_keepalive_connections=DIFY_CLIENT_CONFIG["max_keepalive_connections"],
+                    keepalive_expiry=DIFY_CLIENT_CONFIG["keepalive_expiry"]
+                )
+            )
+        return self._client
+
+    async def aclose(self):
+        """Close the shared HTTP client and its pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _headers(self, agent_id: str) -> Dict[str, str]:
+        """Request headers for a specific agent's Dify app"""
+        return {
+            "Authorization": f"Bearer {AGENT_CONFIGS[agent_id]['api_key']}",
             "Content-Type": "application/json"
         }
-        print(f"Initialized DifyService with base_url: {self.config['base_url']}")
 
-    def get_conversation_id(self):
-        """Get current conversation ID"""
-        return self.conversation_id
+    def _build_inputs(self, profile_data: Dict, agent_id: str) -> Dict[str, str]:
+        """Map profile answers onto the Dify inputs required by the agent"""
+        config = AGENT_CONFIGS[agent_id]
+        profile1 = profile_data.get("profile1", {})
+        profile2 = profile_data.get("profile2", {})
+        required_inputs = {}
+        for input_name, input_config in config['required_inputs'].items():
+            source = profile1 if input_config['source'] == "profile1" else profile2
+            required_inputs[input_name] = str(source.get(input_name, ""))
+        return required_inputs
 
-    def set_conversation_id(self, conversation_id):
-        """Set conversation ID"""
-        self.conversation_id = conversation_id
-        print(f"Set conversation_id to: {conversation_id}")  # Debug log
+    def _load_opening_statement_from_export(self, agent_id: str) -> Optional[str]:
+        """Read the opening statement from the agent's exported Dify app definition"""
+        export_name = AGENT_CONFIGS[agent_id].get('app_export')
+        if not export_name:
+            return None
+        export_path = os.path.join(DIFY_APP_EXPORT_DIR, export_name)
+        if not os.path.isfile(export_path):
+            # Exports are optional (e.g. an image built without them)
+            return None
+        try:
+            with open(export_path, encoding='utf-8') as export_file:
+                app_export = yaml.safe_load(export_file) or {}
+            return app_export.get('model_config', {}).get('opening_statement') or None
+        except (OSError, yaml.YAMLError) as e:
+            print(f"Could not read opening statement from {export_path}: {str(e)}")
+            return None
 
-    def process_message(
+    async def _fetch_opening_statement(self, agent_id: str) -> Optional[str]:
+        """Ask Dify for the app parameters when no export file is available"""
+        try:
+            response = await self.client.get(
+                f"{AGENT_CONFIGS[agent_id]['base_url']}/parameters",
+                headers=self._headers(agent_id),
+                params={"user": "aspaira-backend"}
+            )
+            if response.status_code != 200:
+                print(f"Failed to fetch Dify parameters: {response.status_code}")
+                return None
+            return response.json().get('opening_statement') or None
+        except httpx.HTTPError as e:
+            print(f"Error fetching Dify parameters: {str(e)}")
+            return None
+
+    async def get_opening_statement(self, profile_data: Dict, agent_id: str = ACTIVE_AGENT_VERSION) -> Optional[str]:
+        """
+        Return the agent's opening statement without an LLM round trip.
+        The raw statement is cached per agent; profile variables are filled in per call.
+        """
+        statement = self._opening_statements.get(agent_id)
+        if statement is None:
+            statement = self._load_opening_statement_from_export(agent_id)
+            if statement is None:
+                statement = await self._fetch_opening_statement(agent_id)
+            if statement is None:
+                return None
+            self._opening_statements[agent_id] = statement
+            print(f"Cached opening statement for agent {agent_id}")
+
+        inputs = self._build_inputs(profile_data, agent_id)
+        return TEMPLATE_VARIABLE_PATTERN.sub(
+            lambda match: inputs.get(match.group(1), match.group(0)),
+            statement
+        )
+
+    async def process_message(
         self,
         username: str,
         message: str,
         profile_data: Dict,
-        conversation_id: Optional[str] = None
-    ) -> Dict:
-        """Process a message through Dify"""
+        agent_id: str = ACTIVE_AGENT_VERSION,
+        context: Optional[DifyCallContext] = None
+    ) -> AsyncGenerator[Dict, None]:
+        """
+        Process a message through Dify, yielding stream events as they arrive.
+        The Dify conversation to continue is context.conversation_id (a fresh
+        context, i.e. a new conversation, is created if none is passed); ids
+        reported by Dify are recorded on that context. The call outcome is
+        recorded on the agent's circuit breaker. A stream that ends without
+        message_end counts as a failure; a call abandoned by its consumer
+        (client disconnect, stop, cancelled producer) gives its half-open
+        probe slot back.
+        """
+        if context is None:
+            context = DifyCallContext(username=username, agent_id=agent_id)
+        config = AGENT_CONFIGS[agent_id]
+        breaker = self.router.breaker(agent_id)
+        outcome_recorded = False
         try:
-            # Extract profile data from the structured format
-            profile1 = profile_data.get("profile1", {})
-            profile2 = profile_data.get("profile2", {})
-            
             # Dynamically build required inputs based on config
-            required_inputs = {}
-            for input_name, input_config in self.config['required_inputs'].items():
-                source = input_config['source']
-                profile_data = profile1 if source == "profile1" else profile2
-                required_inputs[input_name] = str(profile_data.get(input_name, ""))
+            required_inputs = self._build_inputs(profile_data, agent_id)
             
             print(f"Initializing Dify API request...")
-            print(f"Base URL: {self.config['base_url']}")
-            print(f"Headers: {self.headers}")
+            print(f"Agent: {agent_id}")
+            print(f"Base URL: {config['base_url']}")
             print(f"Profile data received: {profile_data}")
             print(f"Mapped inputs for Dify: {required_inputs}")
-            print(f"Conversation ID: {conversation_id}")
+            print(f"Conversation ID: {context.conversation_id}")
 
             # Capture start timestamp
             start_time = time.time()
@@ -72,118 +196,184 @@ class DifyService:
                 "query": message,
                 "response_mode": "streaming",
                 "user": username,
-                "conversation_id": conversation_id  # Use the passed conversation_id directly
+                "conversation_id": context.conversation_id
             }
 
             print(f"Sending request to Dify: {json.dumps(request_data, indent=2)}")
 
             # Make request to Dify
-            response = requests.post(
-                f"{self.config['base_url']}/chat-messages",
-                headers=self.headers,
-                json=request_data,
-                stream=True
-            )
+            async with self.client.stream(
+                "POST",
+                f"{config['base_url']}/chat-messages",
+                headers=self._headers(agent_id),
+                json=request_data
+            ) as response:
+                print(f"Response status: {response.status_code}")
+                if response.status_code != 200:
+                    body = await response.aread()
+                    print(f"Response body: {body.decode('utf-8', errors='replace')}")
+                    breaker.record_failure()
+                    outcome_recorded = True
+                    yield {'error': f"Dify request failed with status {response.status_code}"}
+                    return
 
-            print(f"Response status: {response.status_code}")
-            if response.status_code != 200:
-                print(f"Response body: {response.text}")
-                return None
+                # Initialize response tracking variables
+                full_response = ""
+                dify_metadata = {
+                    "message_files": [],
+                    "feedback": None,
+                    "retriever_resources": [],
+                    "agent_thoughts": []
+                }
+                usage_metrics = None
+                first_event_received = False
 
-            # Initialize response tracking variables
-            message_id = None
-            conversation_id = None
-            full_response = ""
-            dify_metadata = {
-                "message_files": [],
-                "feedback": None,
-                "retriever_resources": [],
-                "agent_thoughts": []
-            }
-            usage_metrics = None
-            first_event_received = False
-
-            # Process streaming response
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data = json.loads(line[6:])
-                            event_type = data.get('event')
-                            print(f"\nReceived event type: {event_type}")
-                            print(f"Complete event data: {json.dumps(data, indent=2)}")
+                # Process streaming response
+                async for line in response.aiter_lines():
+                    if line:
+                        try:
+                            if line.startswith('data: '):
+                                data = json.loads(line[6:])
+                                event_type = data.get('event')
+                                if not context.task_id and data.get('task_id'):
+                                    context.task_id = data.get('task_id')
+                                print(f"\nReceived event type: {event_type}")
+                                print(f"Complete event data: {json.dumps(data, indent=2)}")
                             
-                            # Capture first event timestamp for latency calculation
-                            if not first_event_received:
-                                end_time = time.time()
-                                manual_latency = (end_time - start_time) * 1000  # Convert to milliseconds
-                                dify_metadata['manual_latency'] = manual_latency  # Store in dify_metadata
-                                first_event_received = True
-                                print(f"Calculated and stored manual latency: {manual_latency}ms")
+                                # Capture first event timestamp for latency calculation
+                                if not first_event_received:
+                                    end_time = time.time()
+                                    manual_latency = (end_time - start_time) * 1000  # Convert to milliseconds
+                                    dify_metadata['manual_latency'] = manual_latency  # Store in dify_metadata
+                                    context.first_event_latency_ms = manual_latency
+                                    first_event_received = True
+                                    print(f"Calculated and stored manual latency: {manual_latency}ms")
                             
-                            if event_type == 'agent_message':
-                                # Store message_id and conversation_id from any agent_message event
-                                if not message_id and data.get('message_id'):
-                                    message_id = data.get('message_id')
-                                if not conversation_id and data.get('conversation_id'):
-                                    conversation_id = data.get('conversation_id')
-                                # Yield the chunk for streaming
-                                yield {'event': 'agent_message', 'data': data}
+                                if event_type == 'agent_message':
+                                    # Store message_id and conversation_id from any agent_message event
+                                    if not context.message_id and data.get('message_id'):
+                                        context.message_id = data.get('message_id')
+                                    if not context.conversation_id and data.get('conversation_id'):
+                                        context.conversation_id = data.get('conversation_id')
+                                    # Yield the chunk for streaming
+                                    yield {'event': 'agent_message', 'data': data}
                             
-                            elif event_type == 'agent_thought':
-                                # This contains the complete response
-                                full_response = data.get('thought', '')
-                                # Update metadata
-                                dify_metadata['agent_thoughts'].append({
-                                    'thought': data.get('thought', ''),
-                                    'observation': data.get('observation', ''),
-                                    'tool': data.get('tool', ''),
-                                    'tool_labels': data.get('tool_labels', {})
-                                })
-                                # Yield the complete thought for streaming
-                                yield {'event': 'agent_thought', 'data': data}
+                                elif event_type == 'agent_thought':
+                                    # This contains the complete response
+                                    full_response = data.get('thought', '')
+                                    # Update metadata
+                                    dify_metadata['agent_thoughts'].append({
+                                        'thought': data.get('thought', ''),
+                                        'observation': data.get('observation', ''),
+                                        'tool': data.get('tool', ''),
+                                        'tool_labels': data.get('tool_labels', {})
+                                    })
+                                    # Yield the complete thought for streaming
+                                    yield {'event': 'agent_thought', 'data': data}
                             
-                            elif event_type == 'message_end':
-                                # Get usage metrics and override latency with manual calculation
-                                usage_metrics = data.get('metadata', {}).get('usage', {})
-                                if usage_metrics and first_event_received:
-                                    usage_metrics['latency'] = manual_latency
-                                if conversation_id:
-                                    self.set_conversation_id(conversation_id)
-                                yield {'event': 'message_end', 'data': data}
+                                elif event_type == 'message_end':
+                                    # Get usage metrics and override latency with manual calculation
+                                    usage_metrics = data.get('metadata', {}).get('usage', {})
+                                    if usage_metrics and first_event_received:
+                                        usage_metrics['latency'] = manual_latency
+                                    self._remember_token_prices(agent_id, usage_metrics)
+                                    if not outcome_recorded:
+                                        breaker.record_success(manual_latency if first_event_received else 0)
+                                        outcome_recorded = True
+                                    yield {'event': 'message_end', 'data': data}
                             
-                            elif event_type == 'error':
-                                print(f"Received error event: {data.get('message')}")
-                                yield {'error': data.get('message', 'Unknown error')}
-                                return
+                                elif event_type == 'error':
+                                    print(f"Received error event: {data.get('message')}")
+                                    breaker.record_failure()
+                                    outcome_recorded = True
+                                    yield {'error': data.get('message', 'Unknown error')}
+                                    return
                             
-                    except json.JSONDecodeError as e:
-                        print(f"Error decoding JSON: {str(e)}")
-                        continue
-                    except Exception as e:
-                        print(f"Error processing line: {str(e)}")
-                        continue
+                        except json.JSONDecodeError as e:
+                            print(f"Error decoding JSON: {str(e)}")
+                            continue
+                        except Exception as e:
+                            print(f"Error processing line: {str(e)}")
+                            continue
+
+            if not outcome_recorded:
+                print("Dify stream ended without message_end")
+                breaker.record_failure()
+                outcome_recorded = True
 
             print(f"\nFinal response data:")
-            print(f"message_id: {message_id}")
-            print(f"conversation_id: {conversation_id}")
+            print(f"message_id: {context.message_id}")
+            print(f"conversation_id: {context.conversation_id}")
             print(f"full_response: {full_response}")
             print(f"dify_metadata: {json.dumps(dify_metadata, indent=2)}")
             print(f"usage_metrics: {json.dumps(usage_metrics, indent=2)}")
 
-            return {
-                'message_id': message_id,
-                'conversation_id': conversation_id,
-                'response': full_response,
-                'dify_metadata': dify_metadata,
-                'usage_metrics': usage_metrics
-            }
-
+        except httpx.TimeoutException as e:
+            print(f"Timed out waiting for Dify: {str(e)}")
+            if not outcome_recorded:
+                breaker.record_failure()
+                outcome_recorded = True
+            yield {'error': 'Dify request timed out'}
         except Exception as e:
             print(f"Error processing message: {str(e)}")
-            return None
+            if not outcome_recorded:
+                breaker.record_failure()
+                outcome_recorded = True
+        finally:
+            if not outcome_recorded:
+                # GeneratorExit or CancelledError: the call was abandoned, not failed
+                breaker.release_probe()
+
+    def _remember_token_prices(self, agent_id: str, usage: Optional[Dict]):
+        """Keep the agent's per-token prices so aborted turns can be priced"""
+        try:
+            self._token_prices[agent_id] = {
+                'prompt': Decimal(str(usage['prompt_unit_price'])) * Decimal(str(usage['prompt_price_unit'])),
+                'completion': Decimal(str(usage['completion_unit_price'])) * Decimal(str(usage['completion_price_unit'])),
+                'currency': usage.get('currency')
+            }
+        except (KeyError, TypeError, InvalidOperation):
+            pass
 
-    def get_chat_history(self, username: str, conversation_id: Optional[str] = None) -> List[Dict]:
-        """Get chat history for a user"""
-        return get_chat_history(username, conversation_id) 
\ No newline at end of file
+    def estimate_partial_usage(self, context: DifyCallContext, message: str, partial_response: str) -> Dict:
+        """
+        Usage for a turn stopped before Dify reported it, in the shape of Dify's
+        message_end usage and flagged as estimated. Tokens are estimated from the
+        query and the streamed text (a lower bound: the system prompt and history
+        are not counted); prices use the agent's last reported per-token prices.
+        """
+        prompt_tokens = math.ceil(len(message) / ESTIMATED_CHARS_PER_TOKEN)
+        completion_tokens = math.ceil(len(partial_response) / ESTIMATED_CHARS_PER_TOKEN)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'estimated': True
+        }
+        prices = self._token_prices.get(context.agent_id)
+        if prices:
+            prompt_price = prompt_tokens * prices['prompt']
+            completion_price = completion_tokens * prices['completion']
+            usage.update({
+                'prompt_price': str(prompt_price),
+                'completion_price': str(completion_price),
+                'total_price': str(prompt_price + completion_price),
+                'currency': prices['currency']
+            })
+        return usage
+
+    async def stop_generation(self, context: DifyCallContext) -> bool:
+        """Ask Dify to stop the generation behind context.task_id"""
+        if not context.task_id:
+            return False
+        try:
+            response = await self.client.post(
+                f"{AGENT_CONFIGS[context.agent_id]['base_url']}/chat-messages/{context.task_id}/stop",
+                headers=self._headers(context.agent_id),
+                json={"user": context.username}
+            )
+            print(f"Stop generation for task {context.task_id}: {response.status_code}")
+            return response.status_code == 200
+        except httpx.HTTPError as e:
+            print(f"Error stopping generation for task {context.task_id}: {str(e)}")
+            return False
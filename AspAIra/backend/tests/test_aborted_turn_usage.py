@@ -0,0 +1,94 @@
+"""An aborted chat turn must still record estimated tokens and price"""
+import asyncio
+import json
+import time
+from decimal import Decimal
+
+import httpx
+
+from app import database, main
+from app.config import ACTIVE_AGENT_VERSION
+from app.services.dify_service import DifyCallContext
+
+USAGE = {
+    "prompt_tokens": 100, "prompt_unit_price": "3", "prompt_price_unit": "0.000001", "prompt_price": "0.0003",
+    "completion_tokens": 50, "completion_unit_price": "15", "completion_price_unit": "0.000001",
+    "completion_price": "0.00075", "total_tokens": 150, "total_price": "0.00105", "currency": "USD"
+}
+
+
+class SlowStream(httpx.AsyncByteStream):
+    """SSE events, then a generation that never finishes"""
+
+    def __init__(self, events, finish: bool):
+        self.events = events
+        self.finish = finish
+
+    async def __aiter__(self):
+        for event in self.events:
+            await asyncio.sleep(0)
+            yield f"data: {json.dumps(event)}\n\n".encode()
+        if not self.finish:
+            await asyncio.sleep(3600)
+
+
+async def stub_dify(request: httpx.Request) -> httpx.Response:
+    if request.url.path.endswith("/stop"):
+        return httpx.Response(200, json={"result": "success"})
+    query = json.loads(request.content)["query"]
+    ids = {"message_id": f"message-{query}", "conversation_id": "c1", "task_id": f"task-{query}"}
+    events = [{"event": "agent_message", "answer": "x" * 40, **ids} for _ in range(2)]
+    if query == "complete":
+        events.append({"event": "message_end", "metadata": {"usage": dict(USAGE)}, **ids})
+    return httpx.Response(200, stream=SlowStream(events, finish=query == "complete"))
+
+
+def test_aborted_turn_records_estimated_usage(monkeypatch):
+    submitted = []
+
+    async def submit(item, *args, **kwargs):
+        submitted.append(item)
+
+    monkeypatch.setattr(main.chat_write_queue, "submit", submit)
+
+    async def scenario():
+        service = main.dify_service
+        service._client = httpx.AsyncClient(transport=httpx.MockTransport(stub_dify))
+        try:
+            # A completed turn reports the agent's token prices
+            context = DifyCallContext(username="alice", agent_id=ACTIVE_AGENT_VERSION, conversation_id="c1")
+            async for _ in service.process_message("alice", "complete", {}, ACTIVE_AGENT_VERSION, context):
+                pass
+
+            # The next turn is abandoned after two deltas
+            context = DifyCallContext(username="alice", agent_id=ACTIVE_AGENT_VERSION, conversation_id="c1")
+            events = service.process_message("alice", "aborted", {}, ACTIVE_AGENT_VERSION, context)
+            streamed = ""
+            async for event in events:
+                streamed += event["data"]["answer"]
+                if len(streamed) == 80:
+                    break
+            await events.aclose()
+
+            chat_data = {
+                "message_id": None, "conversation_id": "c1", "response": None, "streamed_response": streamed,
+                "interaction_type": "content", "dify_metadata": {}
+            }
+            await main.abort_chat_turn(context, "aborted", chat_data, time.monotonic())
+        finally:
+            await service.aclose()
+
+    asyncio.run(scenario())
+
+    assert len(submitted) == 1
+    item = submitted[0]
+    assert item["status"] == "aborted"
+    usage = item["usage_metrics"]
+    assert usage["estimated"] is True
+    assert usage["completion_tokens"] == 20
+    # 20 completion tokens at 15e-6 and 2 prompt tokens at 3e-6
+    assert Decimal(usage["total_price"]) == Decimal("0.000306")
+
+    summary = database.summarize_chat_items([item])[0]
+    assert summary["total_tokens"] == usage["total_tokens"] > 0
+    assert summary["total_price"] > 0
@@ -0,0 +1,164 @@
+"""Idempotency-key reservation in the chat stream registry"""
+import asyncio
+
+from app.config import CHAT_STREAM_CONFIG
+from app.database import IDEMPOTENCY_COMPLETED, IDEMPOTENCY_IN_PROGRESS
+from app.services.chat_streams import ChatStreamRegistry, IdempotencyKeyBusy
+
+
+async def frames(*items):
+    for item in items:
+        await asyncio.sleep(0)
+        yield item
+
+
+class SharedKeyStore:
+    """In-memory stand-in for the idempotency table, shared by several workers"""
+
+    def __init__(self):
+        self.records = {}
+
+    async def reserve_idempotency_key(self, username, idempotency_key, request_hash, owner, ttl_seconds):
+        key = (username, idempotency_key)
+        if key in self.records:
+            return dict(self.records[key])
+        self.records[key] = {"request_hash": request_hash, "owner": owner, "status": IDEMPOTENCY_IN_PROGRESS}
+        return None
+
+    async def complete_idempotency_key(self, username, idempotency_key, owner, result, ttl_seconds):
+        record = self.records[(username, idempotency_key)]
+        if record["owner"] == owner:
+            record.update(status=IDEMPOTENCY_COMPLETED, result=result)
+
+    async def release_idempotency_key(self, username, idempotency_key, owner):
+        record = self.records.get((username, idempotency_key))
+        if record and record["owner"] == owner and record["status"] == IDEMPOTENCY_IN_PROGRESS:
+            del self.records[(username, idempotency_key)]
+
+
+async def collect(stream):
+    return [frame async for frame in stream.subscribe()]
+
+
+def test_duplicate_attached_before_start_gets_the_turn():
+    async def scenario():
+        registry = ChatStreamRegistry()
+        stream = registry.create("alice", "key-1", ("c1", "hello"))
+        duplicate = registry.get_by_key("alice", "key-1")
+        assert duplicate is stream
+
+        attached = asyncio.create_task(collect(duplicate))
+        await asyncio.sleep(0)  # Admission wait: the turn has not started yet
+        stream.start(frames("data: one\n\n", "data: two\n\n"))
+        received = await asyncio.wait_for(attached, timeout=5)
+        assert [frame.split("\n", 1)[1] for frame in received] == ["data: one\n\n", "data: two\n\n"]
+
+    asyncio.run(scenario())
+
+
+def test_rejected_turn_fails_attached_duplicates_and_frees_the_key():
+    async def scenario():
+        registry = ChatStreamRegistry()
+        stream = registry.create("alice", "key-1", ("c1", "hello"))
+        attached = asyncio.create_task(collect(stream))
+        await asyncio.sleep(0)
+        await stream.fail("Too many requests")
+        registry.discard(stream)
+
+        received = await asyncio.wait_for(attached, timeout=5)
+        assert len(received) == 1 and '"error": "Too many requests"' in received[0]
+        assert registry.get_by_key("alice", "key-1") is None
+
+    asyncio.run(scenario())
+
+
+def test_on_done_runs_after_the_producer_finishes():
+    async def scenario():
+        registry = ChatStreamRegistry()
+        stream = registry.create("alice")
+        released = asyncio.Event()
+
+        async def on_done():
+            released.set()
+
+        stream.start(frames("data: one\n\n"), on_done=on_done)
+        await collect(stream)
+        await asyncio.wait_for(released.wait(), timeout=5)
+
+    asyncio.run(scenario())
+
+
+def test_same_key_on_two_workers_runs_one_turn():
+    async def scenario():
+        key_store = SharedKeyStore()
+        worker_a = ChatStreamRegistry(key_store=key_store)
+        worker_b = ChatStreamRegistry(key_store=key_store)
+        signature = ("c1", "hello")
+
+        stream, is_owner = await worker_a.reserve("alice", "key-1", signature)
+        assert is_owner
+
+        # While worker A is still generating, worker B must not start a second turn
+        try:
+            await worker_b.reserve("alice", "key-1", signature)
+            raise AssertionError("worker B should not own the key")
+        except IdempotencyKeyBusy:
+            pass
+        assert worker_b.get_by_key("alice", "key-1") is None
+
+        stream.start(frames('data: {"response": "hi"}\n\n'))
+        await collect(stream)
+        worker_a.complete(stream, {"response": "hi"})
+        await asyncio.sleep(0)
+
+        # Once finished, worker B replays the stored answer instead of calling Dify
+        replay, is_owner = await worker_b.reserve("alice", "key-1", signature)
+        assert not is_owner
+        received = await asyncio.wait_for(collect(replay), timeout=5)
+        assert [frame.split("\n", 1)[1] for frame in received] == ['data: {"response": "hi"}\n\n', "data: [DONE]\n\n"]
+
+    asyncio.run(scenario())
+
+
+def test_unfinished_turn_frees_the_shared_key():
+    async def scenario():
+        key_store = SharedKeyStore()
+        registry = ChatStreamRegistry(key_store=key_store)
+        stream, _ = await registry.reserve("alice", "key-1", ("c1", "hello"))
+        await stream.fail("Too many requests")
+        registry.discard(stream)
+        await asyncio.sleep(0)
+        assert key_store.records == {}
+
+    asyncio.run(scenario())
+
+
+def test_prune_drops_the_oldest_finished_streams_beyond_the_caps():
+    async def scenario():
+        registry = ChatStreamRegistry(dict(CHAT_STREAM_CONFIG, max_entries=2))
+        release = asyncio.Event()
+
+        async def slow_frames():
+            await release.wait()
+            yield "data: late\n\n"
+
+        running = registry.create("alice", "key-0", ("c1", "hello"))
+        running.start(slow_frames())  # Running streams are never pruned
+        finished = []
+        for n in range(1, 4):
+            stream = registry.create("alice", f"key-{n}", ("c1", "hello"))
+            stream.start(frames(f"data: {n}\n\n"))
+            await collect(stream)
+            finished.append(stream)
+        assert registry.get_by_key("alice", "key-0") is running
+        release.set()
+        await collect(running)
+
+        registry.get("anything")  # Lookups prune
+        assert registry.get_by_key("alice", "key-1") is None
+        assert registry.get_by_key("alice", "key-2") is None
+        assert registry.get_by_key("alice", "key-3") is finished[2]
+        assert registry.get_by_key("alice", "key-0") is running
+        assert registry._buffered_bytes == finished[2].buffered_bytes + running.buffered_bytes
+
+    asyncio.run(scenario())
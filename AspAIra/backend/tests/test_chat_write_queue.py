@@ -0,0 +1,120 @@
+"""Chat write queue and conversation transactions: retries, duplicates, late batches and the dead-letter file"""
+import asyncio
+import json
+
+from botocore.exceptions import ClientError
+
+from app import database
+from app.config import WRITE_QUEUE_CONFIG
+from app.services.chat_write_queue import ChatWriteQueue
+
+
+def chat_item(n: int) -> dict:
+    return {"username": "alice", "conversation_id": "c1", "message_id": f"m{n}", "timestamp": f"2025-01-01T00:00:0{n}"}
+
+
+def transaction_cancelled(*codes, conversation=None):
+    reasons = [{"Code": code} for code in codes]
+    if conversation is not None:
+        # The summary update's old item, in DynamoDB's typed form
+        reasons[-1]["Item"] = {name: {"S": value} for name, value in conversation.items()}
+    return ClientError(
+        {"Error": {"Code": "TransactionCanceledException"}, "CancellationReasons": reasons},
+        "TransactWriteItems"
+    )
+
+
+class FakeTransactionClient:
+    """Records transactions and fails them with the scripted cancellation errors"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def transact_write_items(self, TransactItems):
+        self.calls.append(TransactItems)
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def use_client(monkeypatch, client):
+    resource = type("Resource", (), {})()
+    resource.meta = type("Meta", (), {"client": client})()
+    monkeypatch.setattr(database, "get_dynamodb", lambda: resource)
+
+
+def test_retried_write_skips_stored_messages_so_counters_are_added_once(monkeypatch):
+    client = FakeTransactionClient(transaction_cancelled("ConditionalCheckFailed", "None", "None"))
+    use_client(monkeypatch, client)
+
+    assert database.write_conversation_turns([chat_item(1), chat_item(2)]) == 1
+    retry = client.calls[1]
+    assert [action["Put"]["Item"]["message_id"] for action in retry[:-1]] == ["m2"]
+    assert retry[-1]["Update"]["ExpressionAttributeValues"][":message_count"] == 1
+
+
+def test_late_batch_only_adds_counters(monkeypatch):
+    newer = {"last_timestamp": "2025-01-01T00:00:09", "eval_status": "pending"}
+    client = FakeTransactionClient(transaction_cancelled("None", "ConditionalCheckFailed", conversation=newer))
+    use_client(monkeypatch, client)
+
+    assert database.write_conversation_turns([chat_item(1)]) == 1
+    first, retry = client.calls[0][-1]["Update"], client.calls[1][-1]["Update"]
+    assert "last_timestamp <= :last_timestamp" in first["ConditionExpression"]
+    assert "ConditionExpression" not in retry
+    assert ":last_message_id" not in retry["ExpressionAttributeValues"]
+
+
+def test_new_messages_keep_eval_attempts_unless_the_evaluation_failed(monkeypatch):
+    failed = {"last_timestamp": "2025-01-01T00:00:00", "eval_status": "failed"}
+    client = FakeTransactionClient(transaction_cancelled("None", "ConditionalCheckFailed", conversation=failed))
+    use_client(monkeypatch, client)
+
+    assert database.write_conversation_turns([chat_item(1)]) == 1
+    first, retry = client.calls[0][-1]["Update"], client.calls[1][-1]["Update"]
+    assert "eval_attempts" not in first["UpdateExpression"]
+    assert "eval_status <> :failed" in first["ConditionExpression"]
+    assert retry["UpdateExpression"].endswith("REMOVE eval_attempts")
+    assert "eval_status = :failed" in retry["ConditionExpression"]
+
+
+def test_conflicts_are_transient():
+    assert database.is_transient_error(transaction_cancelled("None", "TransactionConflict"))
+    assert not database.is_transient_error(transaction_cancelled("ValidationError", "None"))
+
+
+def test_throttled_conversations_are_retried(monkeypatch):
+    attempts = []
+
+    def write_conversation_turns(items):
+        attempts.append([item["message_id"] for item in items])
+        if len(attempts) == 1:
+            raise transaction_cancelled("None", "None", "ThrottlingError")
+        return 1
+
+    monkeypatch.setattr(database, "write_conversation_turns", write_conversation_turns)
+
+    queue = ChatWriteQueue(dict(WRITE_QUEUE_CONFIG, base_backoff=0.001, max_backoff=0.001))
+    asyncio.run(queue._flush([chat_item(1), chat_item(2)]))
+
+    assert attempts == [["m1", "m2"], ["m1", "m2"]], "the throttled transaction should have been retried once"
+
+
+def test_failed_conversations_go_to_the_dead_letter_file(monkeypatch, tmp_path):
+    attempts = []
+
+    def write_conversation_turns(items):
+        attempts.append(len(items))
+        if len(attempts) == 1:
+            raise ClientError({"Error": {"Code": "InternalServerError"}}, "TransactWriteItems")
+        raise ClientError({"Error": {"Code": "ValidationException"}}, "TransactWriteItems")
+
+    monkeypatch.setattr(database, "write_conversation_turns", write_conversation_turns)
+
+    dead_letters = tmp_path / "dead_letters.jsonl"
+    queue = ChatWriteQueue(dict(WRITE_QUEUE_CONFIG, base_backoff=0.001, max_backoff=0.001,
+                                dead_letter_path=str(dead_letters)))
+    asyncio.run(queue._flush([chat_item(1), chat_item(2)]))
+
+    assert attempts == [2, 2], "the 5xx should be retried, the validation error should not"
+    assert [json.loads(line)["message_id"] for line in dead_letters.read_text().splitlines()] == ["m1", "m2"]
@@ -0,0 +1,94 @@
+"""Half-open probe slots must come back however a probing Dify call ends"""
+import asyncio
+import json
+
+import httpx
+
+from app.config import ACTIVE_AGENT_VERSION, CIRCUIT_BREAKER_CONFIG
+from app.services.circuit_breaker import HALF_OPEN, OPEN
+from app.services.dify_service import DifyService
+
+AGENT_ID = ACTIVE_AGENT_VERSION
+PROFILE = {"profile1": {}, "profile2": {}}
+
+
+def sse(event: dict) -> bytes:
+    return f"data: {json.dumps(event)}\n\n".encode()
+
+
+class StalledStream(httpx.AsyncByteStream):
+    """Sends one agent_message, then never finishes (a slow LLM stream)"""
+
+    async def __aiter__(self):
+        yield sse({"event": "agent_message", "answer": "Hi", "message_id": "m1", "conversation_id": "c1"})
+        await asyncio.Event().wait()
+
+
+def make_service(handler) -> DifyService:
+    service = DifyService()
+    service._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return service
+
+
+def half_open_with_one_probe(service: DifyService):
+    """Trip the agent's breaker, let it cool down and take its only probe slot"""
+    breaker = service.router.breaker(AGENT_ID)
+    breaker.config = dict(CIRCUIT_BREAKER_CONFIG, half_open_max_probes=1)
+    breaker._trip()
+    breaker.opened_at -= breaker.config["open_seconds"]
+    assert service.router.select_agent(AGENT_ID) == AGENT_ID
+    assert breaker.state == HALF_OPEN
+    assert service.router.select_agent(AGENT_ID) is None
+    return breaker
+
+
+def test_cancelled_probe_releases_slot():
+    async def scenario():
+        service = make_service(lambda request: httpx.Response(200, stream=StalledStream()))
+        breaker = half_open_with_one_probe(service)
+        first_event = asyncio.Event()
+
+        async def consume():
+            async for _ in service.process_message("alice", "hello", PROFILE, agent_id=AGENT_ID):
+                first_event.set()
+
+        task = asyncio.create_task(consume())
+        await asyncio.wait_for(first_event.wait(), timeout=5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        assert breaker.state == HALF_OPEN
+        assert service.router.select_agent(AGENT_ID) == AGENT_ID
+        await service.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_closed_generator_releases_slot():
+    async def scenario():
+        service = make_service(lambda request: httpx.Response(200, stream=StalledStream()))
+        breaker = half_open_with_one_probe(service)
+        events = service.process_message("alice", "hello", PROFILE, agent_id=AGENT_ID)
+        await events.__anext__()
+        await events.aclose()  # Client disconnected mid-stream
+
+        assert breaker.state == HALF_OPEN
+        assert service.router.select_agent(AGENT_ID) == AGENT_ID
+        await service.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_stream_without_message_end_counts_as_failure():
+    async def scenario():
+        body = sse({"event": "agent_message", "answer": "Hi", "message_id": "m1", "conversation_id": "c1"})
+        service = make_service(lambda request: httpx.Response(200, content=body))
+        breaker = half_open_with_one_probe(service)
+        async for _ in service.process_message("alice", "hello", PROFILE, agent_id=AGENT_ID):
+            pass
+
+        assert breaker.state == OPEN
+        assert breaker.half_open_probes == 0
+        await service.aclose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,79 @@
+"""Concurrent conversations through the shared DifyService must not see each other's ids"""
+import asyncio
+import json
+import random
+
+import httpx
+
+from app.config import ACTIVE_AGENT_VERSION
+from app.services.dify_service import DifyCallContext, DifyService
+
+CONVERSATIONS = 50
+PROFILE = {"profile1": {}, "profile2": {}}
+
+
+class InterleavedStream(httpx.AsyncByteStream):
+    """A Dify SSE stream whose chunks arrive after random delays, so calls interleave"""
+
+    def __init__(self, events):
+        self.events = events
+
+    async def __aiter__(self):
+        for event in self.events:
+            await asyncio.sleep(random.uniform(0, 0.01))
+            yield f"data: {json.dumps(event)}\n\n".encode()
+
+
+async def stub_dify(request: httpx.Request) -> httpx.Response:
+    """Answer each query with ids derived from it; new conversations get a fresh id"""
+    body = json.loads(request.content)
+    index = body["query"].split("-")[1]
+    conversation_id = body["conversation_id"] or f"new-conversation-{index}"
+    ids = {"message_id": f"message-{index}", "conversation_id": conversation_id, "task_id": f"task-{index}"}
+    events = [
+        {"event": "agent_message", "answer": f"part {n} for {index}", **ids}
+        for n in range(3)
+    ]
+    events.append({"event": "agent_thought", "thought": f"answer {index}", **ids})
+    events.append({"event": "message_end", "metadata": {"usage": {"total_tokens": 1}}, **ids})
+    return httpx.Response(200, stream=InterleavedStream(events))
+
+
+def test_concurrent_conversations_keep_their_own_ids():
+    async def scenario():
+        service = DifyService()
+        service._client = httpx.AsyncClient(transport=httpx.MockTransport(stub_dify))
+        contexts = [
+            DifyCallContext(
+                username=f"user-{i}",
+                agent_id=ACTIVE_AGENT_VERSION,
+                # Half continue an existing conversation, half start a new one
+                conversation_id=f"existing-conversation-{i}" if i % 2 else None
+            )
+            for i in range(CONVERSATIONS)
+        ]
+
+        async def converse(i: int, context: DifyCallContext):
+            answers = []
+            async for event in service.process_message(
+                username=context.username,
+                message=f"query-{i}",
+                profile_data=PROFILE,
+                agent_id=context.agent_id,
+                context=context
+            ):
+                if event.get("event") == "agent_thought":
+                    answers.append(event["data"]["thought"])
+            return answers
+
+        results = await asyncio.gather(*(converse(i, c) for i, c in enumerate(contexts)))
+        await service.aclose()
+
+        for i, (context, answers) in enumerate(zip(contexts, results)):
+            expected_conversation = f"existing-conversation-{i}" if i % 2 else f"new-conversation-{i}"
+            assert context.conversation_id == expected_conversation
+            assert context.message_id == f"message-{i}"
+            assert context.task_id == f"task-{i}"
+            assert answers == [f"answer {i}"]
+
+    asyncio.run(scenario())
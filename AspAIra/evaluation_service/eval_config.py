@@ -15,16 +15,71 @@ AGENT_CONFIGS = {
     "eval_gpt": {
         "api_key": os.getenv("EVAL_GPT_API_KEY", "app-local-default"),  # Local Dify API key
         "base_url": os.getenv("DIFY_API_URL", "http://localhost"),  # Updated to use HTTP for local development
-        "model": "gpt-3.5-turbo"
+        "model": "gpt-3.5-turbo",
+        "rate_limits": {
+            "requests_per_minute": int(os.getenv("EVAL_GPT_REQUESTS_PER_MINUTE", "60")),
+            "tokens_per_minute": int(os.getenv("EVAL_GPT_TOKENS_PER_MINUTE", "90000"))
+        }
         },
     "eval_claude": {
         "api_key": os.getenv("EVAL_CLAUDE_API_KEY", "app-local-default"),  # Local Dify API key
         "base_url": os.getenv("DIFY_API_URL", "http://localhost"),  # Updated to use HTTP for local development
-        "model": "claude-3-opus-20240229"
+        "model": "claude-3-opus-20240229",
+        "rate_limits": {
+            "requests_per_minute": int(os.getenv("EVAL_CLAUDE_REQUESTS_PER_MINUTE", "50")),
+            "tokens_per_minute": int(os.getenv("EVAL_CLAUDE_TOKENS_PER_MINUTE", "40000"))
+        }
     },
     "eval_gemini": {
         "api_key": os.getenv("EVAL_GEMINI_API_KEY", "app-local-default"),  # Local Dify API key
         "base_url": os.getenv("DIFY_API_URL", "http://localhost"),  # Updated to use HTTP for local development
         "model": "gemini-1.5-pro",
+        "rate_limits": {
+            "requests_per_minute": int(os.getenv("EVAL_GEMINI_REQUESTS_PER_MINUTE", "60")),
+            "tokens_per_minute": int(os.getenv("EVAL_GEMINI_TOKENS_PER_MINUTE", "120000"))
+        }
     }
 }
+
+# HTTP client settings for judge calls
+# Each judge service keeps one pooled aiohttp session for the whole run.
+EVAL_HTTP_CONFIG = {
+    "max_connections": int(os.getenv("EVAL_HTTP_MAX_CONNECTIONS", "20")),
+    "max_connections_per_host": int(os.getenv("EVAL_HTTP_MAX_CONNECTIONS_PER_HOST", "10")),
+    "keepalive_timeout": float(os.getenv("EVAL_HTTP_KEEPALIVE_TIMEOUT", "30")),
+    "connect_timeout": float(os.getenv("EVAL_HTTP_CONNECT_TIMEOUT", "10")),
+    "read_timeout": float(os.getenv("EVAL_HTTP_READ_TIMEOUT", "120")),  # Max gap between stream chunks
+    "total_timeout": float(os.getenv("EVAL_HTTP_TOTAL_TIMEOUT", "600"))
+}
+
+# Evaluation run settings
+# Judges for one conversation run concurrently; this bounds how many conversations
+# are in flight at once. Per-judge rate_limits above (0 = unlimited) pace the calls.
+EVALUATION_CONFIG = {
+    "max_concurrent_conversations": int(os.getenv("EVAL_MAX_CONCURRENT_CONVERSATIONS", "4")),
+    # Rough prompt-size estimate used to reserve tokens before a judge call;
+    # the reservation is corrected with the judge's reported usage afterwards.
+    "chars_per_token": int(os.getenv("EVAL_CHARS_PER_TOKEN", "4")),
+    "expected_completion_tokens": int(os.getenv("EVAL_EXPECTED_COMPLETION_TOKENS", "800")),
+    # Pending-evaluation queue: conversations are claimed once they have been idle
+    # this long (so still-active chats are not judged mid-way), at most batch_size
+    # per run, and marked failed after max_attempts unsuccessful evaluations.
+    "queue_batch_size": int(os.getenv("EVAL_QUEUE_BATCH_SIZE", "50")),
+    "idle_minutes_before_evaluation": int(os.getenv("EVAL_IDLE_MINUTES", "10")),
+    "max_attempts": int(os.getenv("EVAL_MAX_ATTEMPTS", "3")),
+    # Claims expire after lease_seconds unless renewed (every third of the lease while
+    # a conversation is being evaluated), so work held by a crashed replica is retried.
+    "lease_seconds": int(os.getenv("EVAL_LEASE_SECONDS", "300")),
+    # Blocking DynamoDB calls run on this many threads, off the event loop; keep it
+    # within the boto3 connection pool (DYNAMODB_MAX_WORKERS, default 16)
+    "db_workers": int(os.getenv("EVAL_DB_WORKERS", "8"))
+}
+
+# Continuous worker mode (python -m evaluation_service.evaluator --worker)
+EVAL_WORKER_CONFIG = {
+    "poll_interval_seconds": float(os.getenv("EVAL_WORKER_POLL_INTERVAL", "30")),
+    "stats_interval_seconds": float(os.getenv("EVAL_WORKER_STATS_INTERVAL", "60")),
+    # On SIGTERM/SIGINT in-flight conversations get this long to finish before
+    # they are cancelled and returned to the queue
+    "drain_timeout_seconds": float(os.getenv("EVAL_WORKER_DRAIN_TIMEOUT", "120"))
+}
@@ -2,49 +2,201 @@ from typing import List, Dict, Optional
 import os
 import uuid
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from botocore.exceptions import ClientError
 from backend.app.database import (
-    dynamodb,
+    get_dynamodb,
     CHATS_TABLE,
     USERS_TABLE,
-    EVALUATIONS_TABLE
+    EVALUATIONS_TABLE,
+    CONVERSATIONS_TABLE,
+    EVAL_RUNS_TABLE,
+    EVAL_CHECKPOINTS_TABLE,
+    EVAL_STATUS_INDEX,
+    EVAL_STATUS_PENDING,
+    EVAL_STATUS_IN_PROGRESS,
+    EVAL_STATUS_FAILED
 )
 from .eval_models import UserProfile, DifyEvaluationOutput, PROFILE1_FIELDS, PROFILE2_FIELDS
 
 load_dotenv()
 
+# checkpoint_id suffix of a run's per-conversation manifest row (judge rows use the judge_id)
+RUN_MANIFEST_SUFFIX = '#manifest'
+
 class EvaluationDatabase:
     """Handles all DynamoDB interactions for evaluation service"""
     
     def __init__(self):
         """Initialize database tables"""
+        dynamodb = get_dynamodb()
         self.chats_table = dynamodb.Table(CHATS_TABLE)
         self.evaluations_table = dynamodb.Table(EVALUATIONS_TABLE)
         self.users_table = dynamodb.Table(USERS_TABLE)
+        self.conversations_table = dynamodb.Table(CONVERSATIONS_TABLE)
+        self.runs_table = dynamodb.Table(EVAL_RUNS_TABLE)
+        self.checkpoints_table = dynamodb.Table(EVAL_CHECKPOINTS_TABLE)
     
-    def get_unevaluated_conversations(self) -> List[str]:
-        """Get conversation IDs that exist in chats but not in evaluations"""
+    def get_unevaluated_conversations(self, limit: int, idle_before: str) -> List[Dict]:
+        """
+        Get up to limit pending conversation summaries, oldest activity first,
+        from the sparse EvalStatusIndex. Only conversations whose last message
+        is older than idle_before (an ISO timestamp) are returned.
+        """
         try:
-            # Get all conversations from chats table using GSI
-            chats_response = self.chats_table.scan(
-                ProjectionExpression='conversation_id'
-            )
-            chat_conversations = {item['conversation_id'] for item in chats_response.get('Items', [])}
-            
-            # Get all evaluated conversations
-            eval_response = self.evaluations_table.scan(
-                ProjectionExpression='conversation_id'
-            )
-            evaluated_conversations = {item['conversation_id'] for item in eval_response.get('Items', [])}
-            
-            # Return conversations that haven't been evaluated
-            return list(chat_conversations - evaluated_conversations)
+            conversations = []
+            query_kwargs = {
+                'IndexName': EVAL_STATUS_INDEX,
+                'KeyConditionExpression': 'eval_status = :pending AND last_timestamp < :idle_before',
+                'ExpressionAttributeValues': {
+                    ':pending': EVAL_STATUS_PENDING,
+                    ':idle_before': idle_before
+                },
+                'ScanIndexForward': True
+            }
+            while len(conversations) < limit:
+                response = self.conversations_table.query(Limit=limit - len(conversations), **query_kwargs)
+                conversations.extend(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            return conversations
         except Exception as e:
             print(f"Error getting unevaluated conversations: {str(e)}")
             return []
-    
+
+    def get_expired_claims(self, limit: int, now: str) -> List[Dict]:
+        """
+        Get up to limit in_progress conversations whose claim lease ended before now.
+        Limit applies before the filter, so live claims can fill a page with no
+        matches; keep paging until enough expired claims are found.
+        """
+        try:
+            expired = []
+            query_kwargs = {
+                'IndexName': EVAL_STATUS_INDEX,
+                'KeyConditionExpression': 'eval_status = :in_progress',
+                'FilterExpression': 'eval_lease_expires < :now',
+                'ExpressionAttributeValues': {
+                    ':in_progress': EVAL_STATUS_IN_PROGRESS,
+                    ':now': now
+                }
+            }
+            while len(expired) < limit:
+                response = self.conversations_table.query(**query_kwargs)
+                expired.extend(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            return expired[:limit]
+        except Exception as e:
+            print(f"Error getting expired claims: {str(e)}")
+            return []
+
+    def claim_conversation(self, username: str, conversation_id: str, owner: str,
+                           lease_seconds: int, run_id: str) -> Optional[Dict]:
+        """
+        Atomically move a conversation from pending (or an expired claim, or a
+        claim made earlier by the same run) to in_progress under a lease.
+        Returns the claimed summary, or None if another evaluator holds it.
+        """
+        now = datetime.utcnow()
+        try:
+            response = self.conversations_table.update_item(
+                Key={'username': username, 'conversation_id': conversation_id},
+                UpdateExpression=(
+                    'SET eval_status = :in_progress, eval_claimed_by = :owner, eval_claimed_at = :now, '
+                    'eval_lease_expires = :lease_expires, eval_run_id = :run_id '
+                    'ADD eval_attempts :one'
+                ),
+                ConditionExpression=(
+                    'eval_status = :pending OR '
+                    '(eval_status = :in_progress AND (eval_lease_expires < :now OR eval_run_id = :run_id))'
+                ),
+                ExpressionAttributeValues={
+                    ':pending': EVAL_STATUS_PENDING,
+                    ':in_progress': EVAL_STATUS_IN_PROGRESS,
+                    ':owner': owner,
+                    ':now': now.isoformat(),
+                    ':lease_expires': (now + timedelta(seconds=lease_seconds)).isoformat(),
+                    ':run_id': run_id,
+                    ':one': 1
+                },
+                ReturnValues='ALL_NEW'
+            )
+            return response.get('Attributes')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            print(f"Error claiming conversation {conversation_id}: {str(e)}")
+            return None
+
+    def renew_claim(self, username: str, conversation_id: str, owner: str, lease_seconds: int) -> bool:
+        """Extend this evaluator's lease; False if the claim was lost or the conversation re-queued"""
+        try:
+            self.conversations_table.update_item(
+                Key={'username': username, 'conversation_id': conversation_id},
+                UpdateExpression='SET eval_lease_expires = :lease_expires',
+                ConditionExpression='eval_status = :in_progress AND eval_claimed_by = :owner',
+                ExpressionAttributeValues={
+                    ':in_progress': EVAL_STATUS_IN_PROGRESS,
+                    ':owner': owner,
+                    ':lease_expires': (datetime.utcnow() + timedelta(seconds=lease_seconds)).isoformat()
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error renewing claim on conversation {conversation_id}: {str(e)}")
+            return False
+
+    def holds_claim(self, username: str, conversation_id: str, owner: str) -> bool:
+        """Whether owner still holds the in_progress claim on a conversation"""
+        try:
+            response = self.conversations_table.get_item(
+                Key={'username': username, 'conversation_id': conversation_id},
+                ProjectionExpression='eval_status, eval_claimed_by',
+                ConsistentRead=True
+            )
+            item = response.get('Item', {})
+            return item.get('eval_status') == EVAL_STATUS_IN_PROGRESS and item.get('eval_claimed_by') == owner
+        except Exception as e:
+            print(f"Error checking claim on conversation {conversation_id}: {str(e)}")
+            return False
+
+    def release_conversation(self, conversation: Dict, owner: str, max_attempts: Optional[int] = None) -> bool:
+        """
+        Return a claimed conversation to the queue after a failed evaluation, or
+        mark it failed once it has used up max_attempts. Without max_attempts
+        (interrupted, e.g. by shutdown) it goes back to pending and the attempt
+        the claim counted is given back, so restarts never use up attempts.
+        """
+        attempts = int(conversation.get('eval_attempts', 1))
+        give_up = max_attempts is not None and attempts >= max_attempts
+        values = {
+            ':status': EVAL_STATUS_FAILED if give_up else EVAL_STATUS_PENDING,
+            ':in_progress': EVAL_STATUS_IN_PROGRESS,
+            ':owner': owner
+        }
+        update = 'SET eval_status = :status REMOVE eval_claimed_by, eval_claimed_at, eval_lease_expires'
+        if max_attempts is None:
+            update += ' ADD eval_attempts :minus_one'
+            values[':minus_one'] = -1
+        try:
+            self.conversations_table.update_item(
+                Key={'username': conversation['username'], 'conversation_id': conversation['conversation_id']},
+                UpdateExpression=update,
+                # A new message re-queues the conversation; leave that marker alone
+                ConditionExpression='eval_status = :in_progress AND eval_claimed_by = :owner',
+                ExpressionAttributeValues=values
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error releasing conversation {conversation['conversation_id']}: {str(e)}")
+            return False
+
     def get_conversation_messages(self, conversation_id: str) -> List[Dict]:
         """Get all messages for a conversation using the ConversationIndex GSI"""
         try:
@@ -168,20 +320,30 @@ class EvaluationDatabase:
             print(f"Error getting evaluation: {str(e)}")
             return {}
     
-    def mark_conversation_evaluated(self, conversation_id: str) -> bool:
-        """Mark a conversation as evaluated"""
+    def mark_conversation_evaluated(self, username: str, conversation_id: str, owner: str) -> bool:
+        """
+        Clear a claimed conversation's queue marker after its evaluation was stored.
+        Returns False if the conversation received new messages meanwhile; it then
+        stays pending and is evaluated again.
+        """
         try:
-            self.chats_table.update_item(
-                Key={'conversation_id': conversation_id},
-                UpdateExpression='SET evaluation_status = :status, evaluated_at = :timestamp',
+            self.conversations_table.update_item(
+                Key={'username': username, 'conversation_id': conversation_id},
+                UpdateExpression=(
+                    'SET evaluated_at = :timestamp '
+                    'REMOVE eval_status, eval_claimed_by, eval_claimed_at, eval_lease_expires, eval_attempts'
+                ),
+                ConditionExpression='eval_status = :in_progress AND eval_claimed_by = :owner',
                 ExpressionAttributeValues={
-                    ':status': 'completed',
+                    ':in_progress': EVAL_STATUS_IN_PROGRESS,
+                    ':owner': owner,
                     ':timestamp': datetime.utcnow().isoformat()
                 }
             )
             return True
-        except Exception as e:
-            print(f"Error marking conversation as evaluated: {str(e)}")
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error marking conversation as evaluated: {str(e)}")
             return False
     
     def get_conversation(self, conversation_id: str) -> Optional[Dict]:
@@ -200,4 +362,171 @@ class EvaluationDatabase:
             return items[0] if items else None
         except Exception as e:
             print(f"Error getting conversation: {str(e)}")
-            return None 
\ No newline at end of file
+            return None
+
+    def create_run(self, run_id: str, mode: str) -> bool:
+        """
+        Write the manifest for a new evaluation run. The run item only holds
+        status and counters; its conversations are rows in the checkpoints table.
+        """
+        now = datetime.utcnow().isoformat()
+        try:
+            self.runs_table.put_item(Item={
+                'run_id': run_id,
+                'mode': mode,
+                'status': 'running',
+                'started_at': now,
+                'updated_at': now,
+                'conversations_scheduled': 0,
+                'conversations_completed': 0,
+                'judge_results_saved': 0
+            })
+            return True
+        except Exception as e:
+            print(f"Error creating evaluation run {run_id}: {str(e)}")
+            return False
+
+    def get_run(self, run_id: str) -> Optional[Dict]:
+        """Get a run manifest"""
+        try:
+            response = self.runs_table.get_item(Key={'run_id': run_id}, ConsistentRead=True)
+            return response.get('Item')
+        except Exception as e:
+            print(f"Error getting evaluation run {run_id}: {str(e)}")
+            return None
+
+    def set_run_status(self, run_id: str, status: str) -> bool:
+        try:
+            self.runs_table.update_item(
+                Key={'run_id': run_id},
+                UpdateExpression='SET #status = :status, updated_at = :now',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':status': status,
+                    ':now': datetime.utcnow().isoformat()
+                }
+            )
+            return True
+        except Exception as e:
+            print(f"Error updating evaluation run {run_id}: {str(e)}")
+            return False
+
+    def record_run_scheduled(self, run_id: str, username: str, conversation_id: str) -> bool:
+        """Add a claimed conversation to the run as its own manifest row"""
+        now = datetime.utcnow().isoformat()
+        try:
+            self.checkpoints_table.put_item(
+                Item={
+                    'run_id': run_id,
+                    'checkpoint_id': f"{conversation_id}{RUN_MANIFEST_SUFFIX}",
+                    'conversation_id': conversation_id,
+                    'username': username,
+                    'status': 'scheduled',
+                    'scheduled_at': now
+                },
+                # A conversation claimed again by the same run keeps its row and is counted once
+                ConditionExpression='attribute_not_exists(checkpoint_id)'
+            )
+            self.runs_table.update_item(
+                Key={'run_id': run_id},
+                UpdateExpression='SET updated_at = :now ADD conversations_scheduled :one',
+                ExpressionAttributeValues={':one': 1, ':now': now}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error recording conversation {conversation_id} in run {run_id}: {str(e)}")
+            return False
+
+    def record_run_completed(self, run_id: str, conversation_id: str) -> bool:
+        """Mark a conversation's manifest row completed once its evaluation is stored"""
+        now = datetime.utcnow().isoformat()
+        try:
+            self.checkpoints_table.update_item(
+                Key={'run_id': run_id, 'checkpoint_id': f"{conversation_id}{RUN_MANIFEST_SUFFIX}"},
+                UpdateExpression='SET #status = :completed, completed_at = :now',
+                # Only the first completion moves the run's counter
+                ConditionExpression='attribute_exists(checkpoint_id) AND #status <> :completed',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':completed': 'completed', ':now': now}
+            )
+            self.runs_table.update_item(
+                Key={'run_id': run_id},
+                UpdateExpression='SET updated_at = :now ADD conversations_completed :one',
+                ExpressionAttributeValues={':one': 1, ':now': now}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error recording completion of {conversation_id} in run {run_id}: {str(e)}")
+            return False
+
+    def get_unfinished_run_conversations(self, run_id: str) -> List[Dict]:
+        """Conversations a run scheduled but did not complete, from its manifest rows"""
+        conversations = []
+        query_args = {
+            'KeyConditionExpression': 'run_id = :run_id',
+            'FilterExpression': 'attribute_exists(username) AND #status <> :completed',
+            'ExpressionAttributeNames': {'#status': 'status'},
+            'ExpressionAttributeValues': {':run_id': run_id, ':completed': 'completed'}
+        }
+        try:
+            while True:
+                response = self.checkpoints_table.query(**query_args)
+                conversations.extend(
+                    {'username': item['username'], 'conversation_id': item['conversation_id']}
+                    for item in response.get('Items', [])
+                    if item['checkpoint_id'].endswith(RUN_MANIFEST_SUFFIX)
+                )
+                if 'LastEvaluatedKey' not in response:
+                    return conversations
+                query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except Exception as e:
+            print(f"Error getting conversations of run {run_id}: {str(e)}")
+            return conversations
+
+    def save_checkpoint(self, run_id: str, conversation_id: str, last_message_id: str,
+                        judge_evaluation: Dict) -> bool:
+        """Persist one judge's result for a conversation as soon as it completes"""
+        try:
+            self.checkpoints_table.put_item(Item={
+                'run_id': run_id,
+                'checkpoint_id': f"{conversation_id}#{judge_evaluation['judge_id']}",
+                'conversation_id': conversation_id,
+                'judge_id': judge_evaluation['judge_id'],
+                'last_message_id': last_message_id,
+                'judge_evaluation': self._convert_to_dynamodb_format(judge_evaluation),
+                'created_at': datetime.utcnow().isoformat()
+            })
+            self.runs_table.update_item(
+                Key={'run_id': run_id},
+                UpdateExpression='ADD judge_results_saved :one',
+                ExpressionAttributeValues={':one': 1}
+            )
+            return True
+        except Exception as e:
+            print(f"Error saving checkpoint for {conversation_id}/{judge_evaluation.get('judge_id')}: {str(e)}")
+            return False
+
+    def get_checkpoints(self, run_id: str, conversation_id: str, last_message_id: str) -> Dict[str, Dict]:
+        """
+        Judge results already saved by this run for a conversation, keyed by
+        judge_id. Results for an older state of the conversation are ignored.
+        """
+        try:
+            response = self.checkpoints_table.query(
+                KeyConditionExpression='run_id = :run_id AND begins_with(checkpoint_id, :prefix)',
+                ExpressionAttributeValues={
+                    ':run_id': run_id,
+                    ':prefix': f"{conversation_id}#"
+                }
+            )
+            return {
+                item['judge_id']: item['judge_evaluation']
+                for item in response.get('Items', [])
+                # The conversation's manifest row shares the prefix but holds no judge result
+                if 'judge_id' in item and item.get('last_message_id') == last_message_id
+            }
+        except Exception as e:
+            print(f"Error getting checkpoints for {conversation_id}: {str(e)}")
+            return {}
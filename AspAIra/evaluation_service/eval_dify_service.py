@@ -2,9 +2,9 @@
 Service for handling Dify API integration for evaluation.
 Core functionality:
 1. Format conversation data for evaluation
-2. Send evaluation requests to Dify
+2. Send evaluation requests to Dify over a pooled, long-lived HTTP session
 3. Process and validate responses
-4. Return evaluation results
+4. Return evaluation results with connect, first-event and total latency
 """
 import os
 import json
@@ -13,6 +13,7 @@ from typing import Dict, List, Optional, AsyncGenerator
 from datetime import datetime
 from dotenv import load_dotenv
 from .eval_models import DifyEvaluationOutput, EvaluationNotes
+from .eval_config import EVAL_HTTP_CONFIG
 from decimal import Decimal
 import logging
 import time
@@ -21,18 +22,68 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+async def _on_connection_create_start(session, trace_config_ctx, params):
+    trace_config_ctx.connect_started_at = time.perf_counter()
+
+async def _on_connection_create_end(session, trace_config_ctx, params):
+    timings = trace_config_ctx.trace_request_ctx
+    if timings is not None:
+        timings["connect_ms"] = (time.perf_counter() - trace_config_ctx.connect_started_at) * 1000
+
+async def _on_connection_reuseconn(session, trace_config_ctx, params):
+    timings = trace_config_ctx.trace_request_ctx
+    if timings is not None:
+        timings["connect_ms"] = 0.0
+
+def _build_trace_config() -> aiohttp.TraceConfig:
+    """Record TCP/TLS connect time per request into the dict passed as trace_request_ctx"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(_on_connection_create_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    return trace_config
+
 class DifyEvaluationService:
     """Service for handling Dify API integration for evaluation"""
     
-    def __init__(self, config: Dict):
+    def __init__(self, config: Dict, http_config: Optional[Dict] = None):
         """Initialize DifyEvaluationService with configuration and headers"""
         self.config = config
+        self.http_config = http_config or EVAL_HTTP_CONFIG
         self.headers = {
             "Authorization": f"Bearer {self.config['api_key']}",
             "Content-Type": "application/json"
         }
+        self._session: Optional[aiohttp.ClientSession] = None
         print(f"Initialized DifyEvaluationService with base_url: {self.config['base_url']}")
     
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Pooled session, created on first use inside the running event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.http_config["max_connections"],
+                limit_per_host=self.http_config["max_connections_per_host"],
+                keepalive_timeout=self.http_config["keepalive_timeout"]
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.http_config["total_timeout"],
+                connect=self.http_config["connect_timeout"],
+                sock_read=self.http_config["read_timeout"]
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                trace_configs=[_build_trace_config()]
+            )
+        return self._session
+    
+    async def close(self):
+        """Close the pooled session; called by the evaluator on shutdown"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
     def format_conversation_data(self, evaluation_input: Dict) -> Dict:
         """Format conversation data for evaluation"""
         # Create evaluation inputs with correct field names
@@ -232,127 +283,132 @@ class DifyEvaluationService:
             # Record start time for latency calculation
             start_time = time.time()
             judge_metrics = None
+            timings = {"connect_ms": None, "first_event_ms": None}
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.config['base_url']}/chat-messages",
-                    headers=self.headers,
-                    json=data
-                ) as response:
-                    if response.status == 200:
-                        last_thought_event = None
-                        raw_thought = None
+            async with self.session.post(
+                f"{self.config['base_url']}/chat-messages",
+                headers=self.headers,
+                json=data,
+                trace_request_ctx=timings
+            ) as response:
+                if response.status == 200:
+                    last_thought_event = None
+                    raw_thought = None
                         
-                        async for line in response.content:
-                            if line:
-                                try:
-                                    line = line.decode('utf-8')
+                    async for line in response.content:
+                        if line:
+                            try:
+                                line = line.decode('utf-8')
                                     
-                                    if line.startswith('data: '):
-                                        data = json.loads(line[6:])
-                                        event_type = data.get('event')
+                                if line.startswith('data: '):
+                                    if timings["first_event_ms"] is None:
+                                        timings["first_event_ms"] = (time.time() - start_time) * 1000
+                                    data = json.loads(line[6:])
+                                    event_type = data.get('event')
                                         
-                                        if event_type == 'agent_thought':
-                                            last_thought_event = data
-                                            raw_thought = data.get('thought')
-                                            logger.info(f"Received agent thought: {raw_thought}")
+                                    if event_type == 'agent_thought':
+                                        last_thought_event = data
+                                        raw_thought = data.get('thought')
+                                        logger.info(f"Received agent thought: {raw_thought}")
                                         
-                                        elif event_type == 'message_end':
-                                            # Calculate judge metrics from message_end event
-                                            end_time = time.time()
-                                            latency = Decimal(str((end_time - start_time) * 1000))
+                                    elif event_type == 'message_end':
+                                        # Calculate judge metrics from message_end event
+                                        end_time = time.time()
+                                        latency = Decimal(str((end_time - start_time) * 1000))
                                             
-                                            # Get usage metrics from message_end event
-                                            usage_metrics = data.get('metadata', {}).get('usage', {})
-                                            prompt_tokens = Decimal(str(usage_metrics.get('prompt_tokens', 0)))
-                                            completion_tokens = Decimal(str(usage_metrics.get('completion_tokens', 0)))
-                                            eval_tokens = prompt_tokens + completion_tokens
-                                            eval_cost = Decimal(str(usage_metrics.get('total_price', 0)))
+                                        # Get usage metrics from message_end event
+                                        usage_metrics = data.get('metadata', {}).get('usage', {})
+                                        prompt_tokens = Decimal(str(usage_metrics.get('prompt_tokens', 0)))
+                                        completion_tokens = Decimal(str(usage_metrics.get('completion_tokens', 0)))
+                                        eval_tokens = prompt_tokens + completion_tokens
+                                        eval_cost = Decimal(str(usage_metrics.get('total_price', 0)))
                                             
-                                            # Store judge metrics
-                                            judge_metrics = {
-                                                "latency": latency,
-                                                "eval_tokens": eval_tokens,
-                                                "eval_cost": eval_cost,
-                                                "currency": "USD"
-                                            }
+                                        # Store judge metrics
+                                        judge_metrics = {
+                                            "latency": latency,
+                                            "connect_latency": Decimal(str(timings["connect_ms"] or 0)),
+                                            "first_event_latency": Decimal(str(timings["first_event_ms"] or 0)),
+                                            "eval_tokens": eval_tokens,
+                                            "eval_cost": eval_cost,
+                                            "currency": "USD"
+                                        }
                                             
-                                            logger.info(f"Collected judge metrics: {judge_metrics}")
+                                        logger.info(f"Collected judge metrics: {judge_metrics}")
                                         
-                                        elif event_type == 'error':
-                                            logger.error(f"Error from Dify: {data.get('message', 'Unknown error')}")
-                                            return {
-                                                "Personalization": Decimal('0'),
-                                                "Language_Simplicity": Decimal('0'),
-                                                "Response_Length": Decimal('0'),
-                                                "Content_Relevance": Decimal('0'),
-                                                "Content_Difficulty": Decimal('0'),
-                                                "evaluation_notes": {
-                                                    "summary": "",
-                                                    "key_insights": "",
-                                                    "areas_for_improvement": "",
-                                                    "recommendations": ""
-                                                },
-                                                "process_status": "error",
-                                                "raw_response": data.get('message', 'Unknown error')
-                                            }
+                                    elif event_type == 'error':
+                                        logger.error(f"Error from Dify: {data.get('message', 'Unknown error')}")
+                                        return {
+                                            "Personalization": Decimal('0'),
+                                            "Language_Simplicity": Decimal('0'),
+                                            "Response_Length": Decimal('0'),
+                                            "Content_Relevance": Decimal('0'),
+                                            "Content_Difficulty": Decimal('0'),
+                                            "evaluation_notes": {
+                                                "summary": "",
+                                                "key_insights": "",
+                                                "areas_for_improvement": "",
+                                                "recommendations": ""
+                                            },
+                                            "process_status": "error",
+                                            "raw_response": data.get('message', 'Unknown error')
+                                        }
 
-                                except json.JSONDecodeError as e:
-                                    logger.error(f"Error decoding JSON line: {str(e)}")
-                                    continue
-                                except Exception as e:
-                                    logger.error(f"Error processing line: {str(e)}")
-                                    continue
+                            except json.JSONDecodeError as e:
+                                logger.error(f"Error decoding JSON line: {str(e)}")
+                                continue
+                            except Exception as e:
+                                logger.error(f"Error processing line: {str(e)}")
+                                continue
                         
-                        if last_thought_event:
-                            thought = last_thought_event.get('thought', '')
-                            logger.info(f"Processing final thought: {thought}")
+                    if last_thought_event:
+                        thought = last_thought_event.get('thought', '')
+                        logger.info(f"Processing final thought: {thought}")
                             
-                            evaluation_data = self._extract_json_from_response(thought, raw_thought)
-                            if evaluation_data:
-                                # Add judge metrics to evaluation data
-                                if judge_metrics:
-                                    evaluation_data['judge_metrics'] = judge_metrics
-                                return evaluation_data
-                            else:
-                                return {
-                                    "Personalization": Decimal('0'),
-                                    "Language_Simplicity": Decimal('0'),
-                                    "Response_Length": Decimal('0'),
-                                    "Content_Relevance": Decimal('0'),
-                                    "Content_Difficulty": Decimal('0'),
-                                    "evaluation_notes": {
-                                        "summary": "",
-                                        "key_insights": "",
-                                        "areas_for_improvement": "",
-                                        "recommendations": ""
-                                    },
-                                    "process_status": "error",
-                                    "raw_response": raw_thought
-                                }
+                        evaluation_data = self._extract_json_from_response(thought, raw_thought)
+                        if evaluation_data:
+                            # Add judge metrics to evaluation data
+                            if judge_metrics:
+                                evaluation_data['judge_metrics'] = judge_metrics
+                            return evaluation_data
                         else:
-                            logger.error("No agent_thought events received")
-                            return None
-                            
+                            return {
+                                "Personalization": Decimal('0'),
+                                "Language_Simplicity": Decimal('0'),
+                                "Response_Length": Decimal('0'),
+                                "Content_Relevance": Decimal('0'),
+                                "Content_Difficulty": Decimal('0'),
+                                "evaluation_notes": {
+                                    "summary": "",
+                                    "key_insights": "",
+                                    "areas_for_improvement": "",
+                                    "recommendations": ""
+                                },
+                                "process_status": "error",
+                                "raw_response": raw_thought
+                            }
                     else:
-                        error_data = await response.json()
-                        error_message = error_data.get('message', 'Unknown error')
-                        logger.error(f"Error from Dify: {error_message}")
-                        return {
-                            "Personalization": Decimal('0'),
-                            "Language_Simplicity": Decimal('0'),
-                            "Response_Length": Decimal('0'),
-                            "Content_Relevance": Decimal('0'),
-                            "Content_Difficulty": Decimal('0'),
-                            "evaluation_notes": {
-                                "summary": "",
-                                "key_insights": "",
-                                "areas_for_improvement": "",
-                                "recommendations": ""
-                            },
-                            "process_status": "error",
-                            "raw_response": error_message
-                        }
+                        logger.error("No agent_thought events received")
+                        return None
+                            
+                else:
+                    error_data = await response.json()
+                    error_message = error_data.get('message', 'Unknown error')
+                    logger.error(f"Error from Dify: {error_message}")
+                    return {
+                        "Personalization": Decimal('0'),
+                        "Language_Simplicity": Decimal('0'),
+                        "Response_Length": Decimal('0'),
+                        "Content_Relevance": Decimal('0'),
+                        "Content_Difficulty": Decimal('0'),
+                        "evaluation_notes": {
+                            "summary": "",
+                            "key_insights": "",
+                            "areas_for_improvement": "",
+                            "recommendations": ""
+                        },
+                        "process_status": "error",
+                        "raw_response": error_message
+                    }
                         
         except Exception as e:
             logger.error(f"Error sending data to Dify: {str(e)}")
@@ -85,8 +85,10 @@ class EvaluationNotes(BaseModel):
     recommendations: str
 
 class JudgeMetrics(BaseModel):
-    """Model for judge-specific metrics"""
-    latency: Decimal
+    """Model for judge-specific metrics (latencies in ms)"""
+    latency: Decimal  # Total, request start to message_end
+    connect_latency: Optional[Decimal] = None  # 0 when a pooled connection was reused
+    first_event_latency: Optional[Decimal] = None
     eval_tokens: Decimal
     eval_cost: Decimal
     currency: str = "USD"
@@ -0,0 +1,75 @@
+"""
+Per-judge rate limiting for evaluation calls.
+Core functionality:
+1. Token buckets for requests per minute and tokens per minute
+2. Reserve an estimated token count before a judge call
+3. Settle the reservation against the judge's reported usage afterwards
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Bucket refilled continuously at capacity_per_minute; capacity 0 means unlimited"""
+
+    def __init__(self, capacity_per_minute: int):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if it can be taken now)"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        # Requests larger than the bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        """Remove tokens (a negative amount refunds them); the balance may go below zero"""
+        if not self.unlimited:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+class JudgeRateLimiter:
+    """Requests/min and tokens/min limits for one judge"""
+
+    def __init__(self, judge_id: str, rate_limits: Optional[Dict] = None):
+        rate_limits = rate_limits or {}
+        self.judge_id = judge_id
+        self.requests = TokenBucket(rate_limits.get("requests_per_minute", 0))
+        self.tokens = TokenBucket(rate_limits.get("tokens_per_minute", 0))
+        self._lock = asyncio.Lock()  # Waiters are served in arrival order
+
+    async def acquire(self, estimated_tokens: int):
+        """Wait until one request and estimated_tokens fit within the limits, then reserve them"""
+        async with self._lock:
+            while True:
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    return
+                logger.info(f"Rate limit for judge {self.judge_id}: waiting {wait:.1f}s")
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[float]):
+        """Correct a reservation with the tokens the judge actually used"""
+        if actual_tokens is None:
+            return
+        self.tokens.take(float(actual_tokens) - estimated_tokens)
@@ -0,0 +1,143 @@
+"""
+Continuous evaluation worker.
+Core functionality:
+1. Poll the pending-evaluation queue and keep up to max_concurrent_conversations in flight
+2. Claims carry a renewable lease, so several replicas can run side by side and
+   work held by a crashed replica is picked up once its lease expires
+3. Log progress and throughput counters periodically
+4. On SIGTERM/SIGINT stop claiming, let in-flight judge calls finish within the
+   drain timeout, then cancel the rest and return them to the queue
+5. Each worker process is one evaluation run, so its judge results are checkpointed
+"""
+import asyncio
+import logging
+import signal
+import time
+from collections import Counter
+from typing import Dict, Optional, Set
+from .eval_config import EVALUATION_CONFIG, EVAL_WORKER_CONFIG
+
+logger = logging.getLogger(__name__)
+
+class WorkerStats:
+    """Outcome counters for one worker process"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.outcomes = Counter()
+
+    def record(self, outcome: str):
+        self.outcomes[outcome] += 1
+
+    def snapshot(self, in_flight: int) -> Dict:
+        minutes = max((time.monotonic() - self.started_at) / 60, 1e-9)
+        return {
+            "evaluated": self.outcomes["evaluated"],
+            "failed": self.outcomes["failed"],
+            "requeued": self.outcomes["requeued"],
+            "skipped": self.outcomes["skipped"],
+            "lost": self.outcomes["lost"],
+            "errors": self.outcomes["error"],
+            "in_flight": in_flight,
+            "evaluated_per_minute": round(self.outcomes["evaluated"] / minutes, 2)
+        }
+
+class EvaluationWorker:
+    """Long-running loop around a ConversationEvaluator"""
+
+    def __init__(self, evaluator, config: Optional[dict] = None):
+        self.evaluator = evaluator
+        self.config = config or EVAL_WORKER_CONFIG
+        self.max_in_flight = EVALUATION_CONFIG["max_concurrent_conversations"]
+        self.stats = WorkerStats()
+        self.stopping = asyncio.Event()
+        self.in_flight: Set[asyncio.Task] = set()
+        self.in_flight_ids: Set[str] = set()
+
+    def request_stop(self):
+        if not self.stopping.is_set():
+            logger.info("Shutdown requested; no new conversations will be claimed")
+            self.stopping.set()
+
+    def _install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.request_stop)
+
+    async def run(self):
+        """Evaluate queued conversations until a stop is requested, then drain"""
+        self._install_signal_handlers()
+        logger.info(f"Evaluation worker {self.evaluator.worker_id} started "
+                    f"(max {self.max_in_flight} conversations in flight)")
+        await self.evaluator.start_run("worker")
+        reporter = asyncio.create_task(self._report_stats())
+        try:
+            while not self.stopping.is_set():
+                free_slots = self.max_in_flight - len(self.in_flight)
+                if free_slots > 0:
+                    try:
+                        for conversation in await self.evaluator.find_work(free_slots):
+                            if conversation['conversation_id'] not in self.in_flight_ids:
+                                self._start(conversation)
+                    except Exception as e:
+                        logger.error(f"Error polling for work: {str(e)}", exc_info=True)
+                await self._wait_for_slot_or_poll()
+        finally:
+            await self._drain()
+            reporter.cancel()
+            self._log_stats()
+            await self.evaluator.finish_run("stopped")
+            logger.info("Evaluation worker stopped")
+
+    def _start(self, conversation: Dict):
+        conversation_id = conversation['conversation_id']
+        task = asyncio.create_task(self._run_one(conversation))
+        self.in_flight.add(task)
+        self.in_flight_ids.add(conversation_id)
+
+        def _done(finished):
+            self.in_flight.discard(finished)
+            self.in_flight_ids.discard(conversation_id)
+        task.add_done_callback(_done)
+
+    async def _run_one(self, conversation: Dict):
+        try:
+            self.stats.record(await self.evaluator.claim_and_process(conversation))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats.record("error")
+            logger.error(f"Error evaluating conversation {conversation['conversation_id']}: {str(e)}",
+                         exc_info=True)
+
+    async def _wait_for_slot_or_poll(self):
+        """Sleep until the poll interval passes, a conversation finishes or a stop is requested"""
+        stop_waiter = asyncio.ensure_future(self.stopping.wait())
+        try:
+            await asyncio.wait(
+                {stop_waiter, *self.in_flight},
+                timeout=self.config["poll_interval_seconds"],
+                return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            stop_waiter.cancel()
+
+    async def _drain(self):
+        if not self.in_flight:
+            return
+        timeout = self.config["drain_timeout_seconds"]
+        logger.info(f"Waiting up to {timeout:.0f}s for {len(self.in_flight)} in-flight conversations")
+        _, unfinished = await asyncio.wait(set(self.in_flight), timeout=timeout)
+        if unfinished:
+            logger.warning(f"Cancelling {len(unfinished)} conversations still in flight")
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(self.config["stats_interval_seconds"])
+            self._log_stats()
+
+    def _log_stats(self):
+        logger.info(f"Worker progress: {self.stats.snapshot(len(self.in_flight))}")
@@ -1,13 +1,22 @@
+import argparse
 import asyncio
+import functools
 import logging
+import os
+import socket
+import time
 import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Union
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from .eval_database import EvaluationDatabase
 from .eval_dify_service import DifyEvaluationService
 from .eval_models import DifyEvaluationOutput, UsageMetrics, QuizMetrics, JudgeEvaluation, JudgeMetrics, ScoreMetrics, EvaluationNotes
-from .eval_config import AGENT_CONFIGS
+from .eval_config import AGENT_CONFIGS, EVALUATION_CONFIG
+from .eval_rate_limiter import JudgeRateLimiter
+from .eval_worker import EvaluationWorker, WorkerStats
 from pydantic import BaseModel
 
 # Configure logging
@@ -29,66 +38,202 @@ class ConversationEvaluator:
             judge_id: DifyEvaluationService(config)
             for judge_id, config in AGENT_CONFIGS.items()
         }
+        self.rate_limiters = {
+            judge_id: JudgeRateLimiter(judge_id, config.get("rate_limits"))
+            for judge_id, config in AGENT_CONFIGS.items()
+        }
+        self.conversation_slots = asyncio.Semaphore(EVALUATION_CONFIG["max_concurrent_conversations"])
+        # Identifies this evaluator's claims on the pending-evaluation queue
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.run_id: Optional[str] = None  # Set by start_run or a resumed run
+        # boto3 calls block, so they run on this pool rather than on the event loop
+        self._db_executor = ThreadPoolExecutor(
+            max_workers=EVALUATION_CONFIG["db_workers"],
+            thread_name_prefix="eval-dynamodb"
+        )
         logger.info(f"Initialized {len(self.judge_services)} judge services")
     
-    async def process_conversations(self):
-        """Process all conversations that need evaluation sequentially"""
+    async def close(self):
+        """Close the judge services' pooled HTTP sessions and the DynamoDB thread pool"""
+        await asyncio.gather(*(service.close() for service in self.judge_services.values()))
+        self._db_executor.shutdown(wait=False)
+
+    async def _db(self, func, *args, **kwargs):
+        """Run a blocking EvaluationDatabase call on the DynamoDB thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor, functools.partial(func, *args, **kwargs))
+    
+    async def find_work(self, limit: int) -> List[Dict]:
+        """Pending conversations that have gone idle, then claims whose lease expired"""
+        idle_before = datetime.now() - timedelta(minutes=EVALUATION_CONFIG["idle_minutes_before_evaluation"])
+        # Chat timestamps are written in the backend's local time
+        conversations = await self._db(self.db.get_unevaluated_conversations, limit, idle_before.isoformat())
+        if len(conversations) < limit:
+            conversations += await self._db(
+                self.db.get_expired_claims, limit - len(conversations), datetime.utcnow().isoformat()
+            )
+        return conversations
+
+    async def start_run(self, mode: str) -> str:
+        """Open a run manifest; judge results are checkpointed under its run_id"""
+        self.run_id = str(uuid.uuid4())
+        await self._db(self.db.create_run, self.run_id, mode)
+        logger.info(f"Started evaluation run {self.run_id}")
+        return self.run_id
+
+    async def finish_run(self, status: str):
+        await self._db(self.db.set_run_status, self.run_id, status)
+        if status == "completed":
+            logger.info(f"Evaluation run {self.run_id} completed")
+        else:
+            logger.info(f"Evaluation run {self.run_id} {status}; continue it with --resume {self.run_id}")
+
+    async def process_conversations(self, resume_run_id: Optional[str] = None):
+        """
+        Claim and evaluate pending conversations, a bounded number at a time.
+        With resume_run_id, continue that run instead: only its conversations
+        that were not completed are scheduled, and judges whose results were
+        checkpointed are not called again.
+        """
         logger.info("Starting conversation evaluation process...")
         
+        if resume_run_id:
+            manifest = await self._db(self.db.get_run, resume_run_id)
+            if not manifest:
+                logger.error(f"Evaluation run {resume_run_id} not found")
+                return
+            self.run_id = resume_run_id
+            await self._db(self.db.set_run_status, self.run_id, "running")
+            conversations = await self._db(self.db.get_unfinished_run_conversations, self.run_id)
+            logger.info(f"Resuming run {self.run_id}: "
+                        f"{manifest.get('conversations_completed', 0)} conversations already completed")
+        else:
+            await self.start_run("batch")
+            conversations = await self.find_work(EVALUATION_CONFIG["queue_batch_size"])
+        
+        status = "interrupted"
+        errors = 0
         try:
-            # Get unevaluated conversations
-            conversation_ids = self.db.get_unevaluated_conversations()
-            
-            if not conversation_ids:
+            if not conversations:
                 logger.info("No conversations found for evaluation")
-                return
-            
-            logger.info(f"Found {len(conversation_ids)} conversations to evaluate")
-            
-            # Process each conversation sequentially
-            for i, conv_id in enumerate(conversation_ids, 1):
-                logger.info(f"Processing conversation {i} of {len(conversation_ids)}")
-                await self._process_single_conversation(conv_id)
+            else:
+                logger.info(f"Found {len(conversations)} conversations to evaluate")
                 
-                # Add delay between conversations to avoid rate limits
-                if i < len(conversation_ids):  # Don't delay after the last conversation
-                    logger.info("Waiting 2 seconds before next conversation...")
-                    await asyncio.sleep(2)
+                # Process conversations concurrently; per-judge rate limiters pace the judge calls.
+                # Errors are collected rather than raised, so one failing conversation does not
+                # leave the others running unawaited while the run is closed
+                outcomes = await asyncio.gather(*(
+                    self._process_with_slot(i, len(conversations), conversation)
+                    for i, conversation in enumerate(conversations, 1)
+                ), return_exceptions=True)
+                stats = WorkerStats()
+                for conversation, outcome in zip(conversations, outcomes):
+                    if isinstance(outcome, Exception):
+                        stats.record("error")
+                        logger.error(f"Error evaluating conversation {conversation['conversation_id']}: {str(outcome)}",
+                                     exc_info=outcome)
+                    else:
+                        stats.record(outcome)
+                logger.info(f"Run results: {stats.snapshot(0)}")
+                errors = stats.outcomes["error"]
             
+            # Conversations that raised were scheduled but not completed, so --resume retries them
+            status = "completed_with_errors" if errors else "completed"
             logger.info("Completed conversation evaluation process")
             
         except Exception as e:
             logger.error(f"Error in process_conversations: {str(e)}", exc_info=True)
             raise
+        finally:
+            await self.finish_run(status)
     
-    async def _process_single_conversation(self, conversation_id: str) -> None:
-        """Process a single conversation"""
+    async def _process_with_slot(self, index: int, total: int, conversation: Dict) -> str:
+        async with self.conversation_slots:
+            logger.info(f"Processing conversation {index} of {total}")
+            return await self.claim_and_process(conversation)
+
+    async def claim_and_process(self, conversation: Dict) -> str:
+        """
+        Claim a queued conversation, evaluate it while renewing the claim's lease,
+        and clear or release the claim. Returns the outcome: "skipped" (claimed
+        elsewhere), "evaluated", "requeued" (changed during evaluation), "lost"
+        (the claim could not be renewed, so the evaluation was stopped) or "failed".
+        If cancelled, e.g. on shutdown, the claim is released before re-raising.
+        """
+        conversation_id = conversation['conversation_id']
+        lease_seconds = EVALUATION_CONFIG["lease_seconds"]
+        claimed = await self._db(
+            self.db.claim_conversation,
+            conversation['username'], conversation_id, self.worker_id, lease_seconds, self.run_id
+        )
+        if not claimed:
+            logger.info(f"Conversation {conversation_id} was claimed by another evaluator")
+            return "skipped"
+        await self._db(self.db.record_run_scheduled, self.run_id, claimed['username'], conversation_id)
+
+        evaluation = asyncio.create_task(self._process_single_conversation(claimed))
+        renewer = asyncio.create_task(self._renew_lease(claimed, lease_seconds, evaluation))
+        try:
+            evaluated = await evaluation
+        except asyncio.CancelledError:
+            if renewer.done() and not renewer.cancelled() and renewer.result():
+                return "lost"
+            logger.info(f"Evaluation of conversation {conversation_id} interrupted; returning it to the queue")
+            await self._db(self.db.release_conversation, claimed, self.worker_id)
+            raise
+        finally:
+            renewer.cancel()
+
+        if not evaluated:
+            await self._db(
+                self.db.release_conversation, claimed, self.worker_id, EVALUATION_CONFIG["max_attempts"]
+            )
+            return "failed"
+        await self._db(self.db.record_run_completed, self.run_id, conversation_id)
+        if not await self._db(
+            self.db.mark_conversation_evaluated, claimed['username'], conversation_id, self.worker_id
+        ):
+            logger.info(f"Conversation {conversation_id} changed during evaluation and stays queued")
+            return "requeued"
+        return "evaluated"
+
+    async def _renew_lease(self, conversation: Dict, lease_seconds: int, evaluation: asyncio.Task) -> bool:
+        """
+        Keep a claim alive while its conversation is being evaluated. If the claim
+        was taken over (or the conversation re-queued by a new message), cancel
+        the evaluation so no more judge calls are paid for; returns True then.
+        """
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            if not await self._db(self.db.renew_claim, conversation['username'], conversation['conversation_id'],
+                                  self.worker_id, lease_seconds):
+                logger.warning(f"Lost the claim on conversation {conversation['conversation_id']}; stopping its evaluation")
+                evaluation.cancel()
+                return True
+
+    async def _process_single_conversation(self, conversation: Dict) -> bool:
+        """Process a single conversation summary; returns True once its evaluation is stored"""
+        conversation_id = conversation['conversation_id']
         try:
             logger.info(f"Processing conversation {conversation_id}")
             
-            # Get conversation details
-            conversation = self.db.get_conversation(conversation_id)
-            if not conversation:
-                logger.error(f"Conversation {conversation_id} not found")
-                return
-            
             # Get conversation messages
-            messages = self.db.get_conversation_messages(conversation_id)
+            messages = await self._db(self.db.get_conversation_messages, conversation_id)
             if not messages:
                 logger.error(f"No messages found for conversation {conversation_id}")
-                return
+                return False
             
             # Get user profile
-            user_profile = self.db.get_user_profile(conversation['username'])
+            user_profile = await self._db(self.db.get_user_profile, conversation['username'])
             if not user_profile:
                 logger.error(f"No user profile found for conversation {conversation_id}")
-                return
+                return False
             
             # Get agent_id from conversation
             agent_id = conversation.get('agent_id')
             if not agent_id:
                 logger.error(f"No agent_id found for conversation {conversation_id}")
-                return
+                return False
             
             # Evaluate conversation
             evaluation = await self._evaluate_conversation(
@@ -96,20 +241,27 @@ class ConversationEvaluator:
                 username=conversation['username'],
                 messages=messages,
                 user_profile=user_profile,
-                agent_id=agent_id
+                agent_id=agent_id,
+                last_message_id=conversation.get('last_message_id', '')
             )
             
             if evaluation:
+                # A lease taken over between renewals must not produce a second evaluation row
+                if not await self._db(self.db.holds_claim, conversation['username'], conversation_id, self.worker_id):
+                    logger.warning(f"Claim on conversation {conversation_id} was lost; not storing its evaluation")
+                    return False
                 # Store evaluation results
-                if self.db.store_evaluation(evaluation.dict()):
+                if await self._db(self.db.store_evaluation, evaluation.dict()):
                     logger.info(f"Successfully stored evaluation for conversation {conversation_id}")
-                else:
-                    logger.error(f"Failed to store evaluation for conversation {conversation_id}")
+                    return True
+                logger.error(f"Failed to store evaluation for conversation {conversation_id}")
             else:
                 logger.error(f"Failed to evaluate conversation {conversation_id}")
+            return False
                 
         except Exception as e:
             logger.error(f"Error processing conversation {conversation_id}: {str(e)}", exc_info=True)
+            return False
     
     async def _evaluate_conversation(
         self,
@@ -117,127 +269,31 @@ class ConversationEvaluator:
         username: str,
         messages: List[Dict],
         user_profile: Dict,
-        agent_id: str
+        agent_id: str,
+        last_message_id: str
     ) -> Optional[DifyEvaluationOutput]:
         """Evaluate a single conversation using multiple judges"""
         try:
-            judge_evaluations = []
+            # Reuse results this run already saved for the conversation in its current state
+            checkpoints = await self._db(self.db.get_checkpoints, self.run_id, conversation_id, last_message_id)
+            if checkpoints:
+                logger.info(f"Reusing checkpointed results from judges {sorted(checkpoints)} for conversation {conversation_id}")
             
-            # Run evaluation for each judge
-            for judge_id, judge_service in self.judge_services.items():
-                try:
-                    logger.info(f"Starting evaluation with judge {judge_id} for conversation {conversation_id}")
-                    
-                    # Get evaluation from judge
-                    evaluation = await judge_service.evaluate_conversation(
-                        conversation_id=conversation_id,
-                        username=username,
-                        messages=messages,
-                        user_profile=user_profile,
-                        agent_id=agent_id
-                    )
-                    
-                    if evaluation:
-                        # Log and store raw evaluation response
-                        raw_response = json.dumps(evaluation, default=str)
-                        logger.info(f"Raw evaluation from {judge_id}: {raw_response}")
-                        
-                        # Create judge evaluation with simplified validation
-                        try:
-                            # First parse the outer JSON
-                            outer_data = json.loads(raw_response)
-                            
-                            # The judge_metrics are in the raw_response field
-                            if "raw_response" in outer_data:
-                                # Parse the raw_response JSON
-                                inner_data = json.loads(outer_data["raw_response"])
-                                
-                                # Get judge_metrics from the inner data
-                                if "judge_metrics" in inner_data:
-                                    metrics = inner_data["judge_metrics"]
-                                    # Only include numeric fields, convert to Decimal
-                                    judge_metrics = {
-                                        "latency": Decimal(str(metrics["latency"])),
-                                        "eval_tokens": Decimal(str(metrics["eval_tokens"])),
-                                        "eval_cost": Decimal(str(metrics["eval_cost"]))
-                                    }
-                                    logger.info(f"Successfully extracted judge_metrics: {judge_metrics}")
-                                else:
-                                    logger.warning(f"judge_metrics not found in inner data")
-                                    judge_metrics = None
-                            else:
-                                logger.warning(f"raw_response not found in outer data")
-                                judge_metrics = None
-                        except Exception as e:
-                            logger.warning(f"Error extracting judge_metrics: {str(e)}")
-                            judge_metrics = None
-
-                        # Create the JudgeEvaluation with properly formatted metrics
-                        judge_eval = JudgeEvaluation(
-                            judge_id=judge_id,
-                            scores=ScoreMetrics(
-                                Personalization=evaluation.get("Personalization", Decimal('0')),
-                                Language_Simplicity=evaluation.get("Language_Simplicity", Decimal('0')),
-                                Response_Length=evaluation.get("Response_Length", Decimal('0')),
-                                Content_Relevance=evaluation.get("Content_Relevance", Decimal('0')),
-                                Content_Difficulty=evaluation.get("Content_Difficulty", Decimal('0'))
-                            ),
-                            evaluation_notes=evaluation.get("evaluation_notes", {}),
-                            process_status="success",
-                            raw_response=None,
-                            judge_metrics=judge_metrics
-                        )
-                        logger.info(f"Created judge evaluation for {judge_id} with metrics: {judge_eval.judge_metrics}")
-                        judge_evaluations.append(judge_eval)
-                        
-                    else:
-                        logger.error(f"No evaluation response from judge {judge_id}")
-                        # Create error evaluation but keep multi-agent flow
-                        judge_eval = JudgeEvaluation(
-                            judge_id=judge_id,
-                            scores=ScoreMetrics(
-                                Personalization=Decimal('0'),
-                                Language_Simplicity=Decimal('0'),
-                                Response_Length=Decimal('0'),
-                                Content_Relevance=Decimal('0'),
-                                Content_Difficulty=Decimal('0')
-                            ),
-                            evaluation_notes={
-                                "summary": "",
-                                "key_insights": "",
-                                "areas_for_improvement": "",
-                                "recommendations": ""
-                            },
-                            process_status="error",
-                            raw_response="No evaluation response from judge"
-                        )
-                        logger.info(f"Created error evaluation for no response: {judge_eval.dict()}")
-                        judge_evaluations.append(judge_eval)
-                        
-                except Exception as e:
-                    logger.error(f"Error with judge {judge_id}: {str(e)}", exc_info=True)
-                    # Create error evaluation but keep multi-agent flow
-                    judge_eval = JudgeEvaluation(
-                        judge_id=judge_id,
-                        scores=ScoreMetrics(
-                            Personalization=Decimal('0'),
-                            Language_Simplicity=Decimal('0'),
-                            Response_Length=Decimal('0'),
-                            Content_Relevance=Decimal('0'),
-                            Content_Difficulty=Decimal('0')
-                        ),
-                        evaluation_notes={
-                            "summary": "",
-                            "key_insights": "",
-                            "areas_for_improvement": "",
-                            "recommendations": ""
-                        },
-                        process_status="error",
-                        raw_response="Error with judge"
-                    )
-                    logger.info(f"Created error evaluation for judge error: {judge_eval.dict()}")
-                    judge_evaluations.append(judge_eval)
-                    continue
+            # Run the remaining judges concurrently; each returns an error evaluation rather than raising
+            judge_evaluations = list(await asyncio.gather(*(
+                self._run_judge_with_checkpoint(
+                    judge_id=judge_id,
+                    judge_service=judge_service,
+                    conversation_id=conversation_id,
+                    username=username,
+                    messages=messages,
+                    user_profile=user_profile,
+                    agent_id=agent_id,
+                    last_message_id=last_message_id,
+                    checkpoint=checkpoints.get(judge_id)
+                )
+                for judge_id, judge_service in self.judge_services.items()
+            )))
             
             if not judge_evaluations:
                 logger.error(f"No successful judge evaluations for conversation {conversation_id}")
@@ -272,6 +328,170 @@ class ConversationEvaluator:
             logger.error(f"Error in _evaluate_conversation: {str(e)}", exc_info=True)
             return None
             
+    async def _run_judge_with_checkpoint(
+        self,
+        judge_id: str,
+        judge_service: DifyEvaluationService,
+        conversation_id: str,
+        username: str,
+        messages: List[Dict],
+        user_profile: Dict,
+        agent_id: str,
+        last_message_id: str,
+        checkpoint: Optional[Dict]
+    ) -> "JudgeEvaluation":
+        """Return a checkpointed judge result, or run the judge and checkpoint a successful result"""
+        if checkpoint:
+            return JudgeEvaluation.from_dict(checkpoint)
+        judge_eval = await self._run_judge(
+            judge_id=judge_id,
+            judge_service=judge_service,
+            conversation_id=conversation_id,
+            username=username,
+            messages=messages,
+            user_profile=user_profile,
+            agent_id=agent_id
+        )
+        if judge_eval.process_status == "success":
+            await self._db(self.db.save_checkpoint, self.run_id, conversation_id, last_message_id, judge_eval.dict())
+        return judge_eval
+
+    def _estimate_judge_tokens(self, messages: List[Dict]) -> int:
+        """Rough token count of a judge call, reserved against the judge's tokens/min limit"""
+        characters = sum(len(msg.get('message', '')) + len(msg.get('response', '')) for msg in messages)
+        return characters // EVALUATION_CONFIG["chars_per_token"] + EVALUATION_CONFIG["expected_completion_tokens"]
+
+    async def _run_judge(
+        self,
+        judge_id: str,
+        judge_service: DifyEvaluationService,
+        conversation_id: str,
+        username: str,
+        messages: List[Dict],
+        user_profile: Dict,
+        agent_id: str
+    ) -> "JudgeEvaluation":
+        """Evaluate a conversation with one judge; failures become error evaluations"""
+        try:
+            logger.info(f"Starting evaluation with judge {judge_id} for conversation {conversation_id}")
+
+            # Wait for this judge's request/token budget, then get its evaluation
+            limiter = self.rate_limiters[judge_id]
+            estimated_tokens = self._estimate_judge_tokens(messages)
+            await limiter.acquire(estimated_tokens)
+            evaluation = await judge_service.evaluate_conversation(
+                conversation_id=conversation_id,
+                username=username,
+                messages=messages,
+                user_profile=user_profile,
+                agent_id=agent_id
+            )
+
+            if evaluation:
+                # Log and store raw evaluation response
+                raw_response = json.dumps(evaluation, default=str)
+                logger.info(f"Raw evaluation from {judge_id}: {raw_response}")
+
+                # Create judge evaluation with simplified validation
+                try:
+                    # First parse the outer JSON
+                    outer_data = json.loads(raw_response)
+
+                    # The judge_metrics are in the raw_response field
+                    if "raw_response" in outer_data:
+                        # Parse the raw_response JSON
+                        inner_data = json.loads(outer_data["raw_response"])
+
+                        # Get judge_metrics from the inner data
+                        if "judge_metrics" in inner_data:
+                            metrics = inner_data["judge_metrics"]
+                            # Only include numeric fields, convert to Decimal
+                            judge_metrics = {
+                                "latency": Decimal(str(metrics["latency"])),
+                                "connect_latency": Decimal(str(metrics.get("connect_latency", 0))),
+                                "first_event_latency": Decimal(str(metrics.get("first_event_latency", 0))),
+                                "eval_tokens": Decimal(str(metrics["eval_tokens"])),
+                                "eval_cost": Decimal(str(metrics["eval_cost"]))
+                            }
+                            logger.info(f"Successfully extracted judge_metrics: {judge_metrics}")
+                        else:
+                            logger.warning(f"judge_metrics not found in inner data")
+                            judge_metrics = None
+                    else:
+                        logger.warning(f"raw_response not found in outer data")
+                        judge_metrics = None
+                except Exception as e:
+                    logger.warning(f"Error extracting judge_metrics: {str(e)}")
+                    judge_metrics = None
+
+                limiter.settle(estimated_tokens, judge_metrics["eval_tokens"] if judge_metrics else None)
+
+                # Create the JudgeEvaluation with properly formatted metrics
+                judge_eval = JudgeEvaluation(
+                    judge_id=judge_id,
+                    scores=ScoreMetrics(
+                        Personalization=evaluation.get("Personalization", Decimal('0')),
+                        Language_Simplicity=evaluation.get("Language_Simplicity", Decimal('0')),
+                        Response_Length=evaluation.get("Response_Length", Decimal('0')),
+                        Content_Relevance=evaluation.get("Content_Relevance", Decimal('0')),
+                        Content_Difficulty=evaluation.get("Content_Difficulty", Decimal('0'))
+                    ),
+                    evaluation_notes=evaluation.get("evaluation_notes", {}),
+                    process_status="success",
+                    raw_response=None,
+                    judge_metrics=judge_metrics
+                )
+                logger.info(f"Created judge evaluation for {judge_id} with metrics: {judge_eval.judge_metrics}")
+                return judge_eval
+
+            else:
+                logger.error(f"No evaluation response from judge {judge_id}")
+                # Create error evaluation but keep multi-agent flow
+                judge_eval = JudgeEvaluation(
+                    judge_id=judge_id,
+                    scores=ScoreMetrics(
+                        Personalization=Decimal('0'),
+                        Language_Simplicity=Decimal('0'),
+                        Response_Length=Decimal('0'),
+                        Content_Relevance=Decimal('0'),
+                        Content_Difficulty=Decimal('0')
+                    ),
+                    evaluation_notes={
+                        "summary": "",
+                        "key_insights": "",
+                        "areas_for_improvement": "",
+                        "recommendations": ""
+                    },
+                    process_status="error",
+                    raw_response="No evaluation response from judge"
+                )
+                logger.info(f"Created error evaluation for no response: {judge_eval.dict()}")
+                return judge_eval
+
+        except Exception as e:
+            logger.error(f"Error with judge {judge_id}: {str(e)}", exc_info=True)
+            # Create error evaluation but keep multi-agent flow
+            judge_eval = JudgeEvaluation(
+                judge_id=judge_id,
+                scores=ScoreMetrics(
+                    Personalization=Decimal('0'),
+                    Language_Simplicity=Decimal('0'),
+                    Response_Length=Decimal('0'),
+                    Content_Relevance=Decimal('0'),
+                    Content_Difficulty=Decimal('0')
+                ),
+                evaluation_notes={
+                    "summary": "",
+                    "key_insights": "",
+                    "areas_for_improvement": "",
+                    "recommendations": ""
+                },
+                process_status="error",
+                raw_response="Error with judge"
+            )
+            logger.info(f"Created error evaluation for judge error: {judge_eval.dict()}")
+            return judge_eval
+
     def _validate_evaluation_response(self, response: Dict) -> bool:
         """Validate the structure of an evaluation response"""
         try:
@@ -455,20 +675,41 @@ class JudgeEvaluation(BaseModel):
             judge_metrics=data.get('judge_metrics')  # Ensure judge_metrics are included
         )
 
-async def main():
+async def main(worker: bool = False, resume_run_id: Optional[str] = None):
     """Main entry point for the evaluation service"""
     try:
         logger.info("Starting evaluation service...")
+        start_time = time.perf_counter()
         evaluator = ConversationEvaluator()
-        await evaluator.process_conversations()
+        logger.info(f"Evaluator initialized in {time.perf_counter() - start_time:.2f}s")
+        try:
+            if worker:
+                await EvaluationWorker(evaluator).run()
+            else:
+                await evaluator.process_conversations(resume_run_id)
+        finally:
+            await evaluator.close()
         logger.info("Evaluation service completed successfully")
     except Exception as e:
         logger.error(f"Error in main: {str(e)}", exc_info=True)
         raise
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate AspAIra conversations with the judge agents")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--worker",
+        action="store_true",
+        help="run continuously, polling the evaluation queue until SIGTERM/SIGINT"
+    )
+    mode.add_argument(
+        "--resume",
+        metavar="RUN_ID",
+        help="continue an interrupted run, skipping completed conversations and checkpointed judge results"
+    )
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(worker=args.worker, resume_run_id=args.resume))
     except KeyboardInterrupt:
         logger.info("Evaluation service stopped by user")
     except Exception as e:
@@ -233,6 +233,15 @@ def check_profile_status(token: str):
     except requests.RequestException:
         return {"profile1_complete": False, "profile2_complete": False}
 
+def get_profile_status(login_response: dict):
+    """Profile status returned with the token; older backends need a separate request"""
+    if "profile1_complete" in login_response and "profile2_complete" in login_response:
+        return {
+            "profile1_complete": login_response["profile1_complete"],
+            "profile2_complete": login_response["profile2_complete"]
+        }
+    return check_profile_status(login_response["access_token"])
+
 # Main container
 st.markdown('<div class="main-container">', unsafe_allow_html=True)
 
@@ -257,7 +266,7 @@ with col1:
             if success:
                 st.session_state.access_token = success["access_token"]
                 # Check profile status after successful login
-                profile_status = check_profile_status(success["access_token"])
+                profile_status = get_profile_status(success)
                 print(f"Profile status: {profile_status}")  # Debug log
                 if profile_status["profile1_complete"] and profile_status["profile2_complete"]:
                     st.success("Login successful!")
@@ -280,7 +289,7 @@ with col2:
                 if login_success:
                     st.session_state.access_token = login_success["access_token"]
                     # Check profile status after successful login
-                    profile_status = check_profile_status(login_success["access_token"])
+                    profile_status = get_profile_status(login_success)
                     print(f"Profile status: {profile_status}")  # Debug log
                     if profile_status["profile1_complete"] and profile_status["profile2_complete"]:
                         st.success("Account created and logged in successfully!")
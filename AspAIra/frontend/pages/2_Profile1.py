@@ -149,6 +149,8 @@ def update_profile(data):
         )
         if response.status_code == 200:
             st.session_state.profile1_complete = True
+            # The backend re-issues the token with updated profile claims
+            st.session_state.access_token = response.json().get("access_token", st.session_state.access_token)
             return True
         return False
     except requests.RequestException:
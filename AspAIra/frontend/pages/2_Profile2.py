@@ -153,6 +153,8 @@ def update_profile_part2(profile_data: dict):
             headers=headers
         )
         if response.status_code == 200:
+            # The backend re-issues the token with updated profile claims
+            st.session_state.access_token = response.json().get("access_token", st.session_state.access_token)
             return True
         return False
     except requests.RequestException:
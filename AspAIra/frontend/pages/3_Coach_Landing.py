@@ -4,11 +4,15 @@ import requests
 from datetime import datetime
 import json
 import time
+import uuid
 from contextlib import contextmanager
 
 # Retrieve the backend URL from environment variables (default to localhost)
 backend_url = os.getenv("BACKEND_URL", "http://localhost:8001")
 
+# How many times a dropped chat stream is resumed before giving up
+MAX_STREAM_RESUMES = 3
+
 # Initialize session states
 if 'access_token' not in st.session_state:
     st.session_state.access_token = None
@@ -20,6 +24,8 @@ if 'user_input' not in st.session_state:
     st.session_state.user_input = ""
 if 'conversation_id' not in st.session_state:
     st.session_state.conversation_id = None
+if 'agent_id' not in st.session_state:
+    st.session_state.agent_id = None
 if 'is_loading' not in st.session_state:
     st.session_state.is_loading = False
 if 'waiting_for_navigation' not in st.session_state:
@@ -113,13 +119,14 @@ def clear_session_state():
 
 def reset_for_new_topic():
     """Reset only chat-related states while preserving auth"""
-    chat_states = ['chat_history', 'conversation_id', 'waiting_for_navigation', 'is_loading', 'user_input', 'api_overloaded', 'retry_after']
+    chat_states = ['chat_history', 'conversation_id', 'agent_id', 'waiting_for_navigation', 'is_loading', 'user_input', 'api_overloaded', 'retry_after']
     for state in chat_states:
         if state in st.session_state:
             del st.session_state[state]
     # Reinitialize required states
     st.session_state.chat_history = []
     st.session_state.conversation_id = None
+    st.session_state.agent_id = None
     st.session_state.waiting_for_navigation = False
     st.session_state.is_loading = False
     st.session_state.user_input = ""
@@ -157,6 +164,9 @@ def process_response(response_data):
     """Handle all response processing in one place"""
     if response_data.get('conversation_id'):
         st.session_state.conversation_id = response_data['conversation_id']
+    if response_data.get('agent_id'):
+        # Follow-up messages must go to the agent that owns the conversation
+        st.session_state.agent_id = response_data['agent_id']
     
     if response_data.get('response'):
         # First add message to chat
@@ -166,16 +176,37 @@ def process_response(response_data):
                 st.session_state.waiting_for_navigation = True
     return False
 
-def handle_api_error(error_msg):
+def render_stream_delta(stream_state, delta):
+    """Render an incremental answer chunk as soon as it arrives"""
+    stream_state['text'] += delta
+    if stream_state['placeholder'] is None:
+        stream_state['placeholder'] = st.chat_message("assistant").empty()
+    stream_state['placeholder'].markdown(stream_state['text'] + "▌")
+
+def clear_stream_placeholder(stream_state):
+    """Remove the live preview once the final message is in chat history"""
+    if stream_state['placeholder'] is not None:
+        stream_state['placeholder'].empty()
+
+def handle_api_error(error_msg, retry_after_seconds=30):
     """Handle API errors, especially overloaded errors"""
     if 'overloaded' in error_msg.lower():
         st.session_state.api_overloaded = True
-        st.session_state.retry_after = int(time.time()) + 30  # Retry after 30 seconds
+        st.session_state.retry_after = int(time.time()) + retry_after_seconds
         return True
     return False
 
+def handle_rate_limited(response):
+    """Back off for as long as the backend's Retry-After header asks"""
+    try:
+        retry_after_seconds = int(response.headers.get('Retry-After', 30))
+    except ValueError:
+        retry_after_seconds = 30
+    st.session_state.api_overloaded = True
+    st.session_state.retry_after = int(time.time()) + retry_after_seconds
+
 def get_initial_message():
-    """Get the initial welcome message from the Dify agent"""
+    """Get the agent's opening statement; the Dify conversation starts with the first real message"""
     if st.session_state.initialization_attempted:
         return
         
@@ -185,35 +216,16 @@ def get_initial_message():
         print(f"Frontend: Starting initial message request for user {st.session_state.username}")
         
         with loading_state():
-            with requests.post(
-                f"{backend_url}/api/chat",
+            response = requests.get(
+                f"{backend_url}/api/chat/opening",
                 headers={"Authorization": f"Bearer {st.session_state.access_token}"},
-                json={
-                    "message": "Please start a new conversation and provide the opening statement so we can get started",
-                    "username": st.session_state.username
-                },
-                stream=True
-            ) as response:
-                if response.status_code == 200:
-                    for line in response.iter_lines():
-                        if line:
-                            line = line.decode('utf-8')
-                            if line.startswith('data: '):
-                                data = line[6:]
-                                if data == '[DONE]':
-                                    break
-                                try:
-                                    response_data = json.loads(data)
-                                    if 'error' in response_data:
-                                        error_msg = response_data['error']
-                                        if handle_api_error(error_msg):
-                                            return
-                                    process_response(response_data)
-                                except json.JSONDecodeError:
-                                    continue
-                else:
-                    error_data = response.json()
-                    st.error(f"Error: {error_data.get('detail', 'Unknown error occurred')}")
+                timeout=10
+            )
+            if response.status_code == 200:
+                process_response(response.json())
+            else:
+                error_data = response.json()
+                st.error(f"Error: {error_data.get('detail', 'Unknown error occurred')}")
             
     except Exception as e:
         print(f"Frontend: Error getting initial message - {str(e)}")
@@ -228,7 +240,59 @@ def start_fresh_conversation():
     st.session_state.initialization_attempted = False
     st.rerun()  # Ensure clean state
 
-def process_message(message):
+def read_chat_stream(response, stream_state):
+    """Consume SSE frames from the backend, remembering the last event ID seen"""
+    for line in response.iter_lines():
+        if line:
+            line = line.decode('utf-8')
+            if line.startswith('id: '):
+                stream_state['last_event_id'] = line[4:]
+            elif line.startswith('data: '):
+                data = line[6:]
+                if data == '[DONE]':
+                    break
+                try:
+                    response_data = json.loads(data)
+                    if 'error' in response_data:
+                        error_msg = response_data['error']
+                        if handle_api_error(error_msg):
+                            return
+                    if 'delta' in response_data:
+                        render_stream_delta(stream_state, response_data['delta'])
+                        continue
+                    process_response(response_data)
+                    clear_stream_placeholder(stream_state)
+                except json.JSONDecodeError:
+                    continue
+
+def open_chat_stream(message, idempotency_key, stream_state):
+    """Send the message, or resume its stream after the last event we received"""
+    headers = {"Authorization": f"Bearer {st.session_state.access_token}"}
+    if stream_state['last_event_id']:
+        stream_id = stream_state['last_event_id'].rsplit(':', 1)[0]
+        headers["Last-Event-ID"] = stream_state['last_event_id']
+        return requests.get(
+            f"{backend_url}/api/chat/stream/{stream_id}",
+            headers=headers,
+            stream=True
+        )
+    if idempotency_key:
+        # Reruns resend the same key, so the backend reuses the answer already being generated
+        headers["Idempotency-Key"] = idempotency_key
+    return requests.post(
+        f"{backend_url}/api/chat",
+        headers=headers,
+        json={
+            "message": message,
+            "username": st.session_state.username,
+            "conversation_id": st.session_state.conversation_id,
+            "agent_id": st.session_state.agent_id,
+            "stream": True
+        },
+        stream=True
+    )
+
+def process_message(message, idempotency_key=None):
     """Process a message after the spinner is shown"""
     if st.session_state.waiting_for_navigation:
         handle_navigation(message)
@@ -238,38 +302,31 @@ def process_message(message):
         return
     
     print(f"Frontend: Sending message - {message}")
+    stream_state = {'placeholder': None, 'text': '', 'last_event_id': None}
     
     try:
-        with requests.post(
-            f"{backend_url}/api/chat",
-            headers={"Authorization": f"Bearer {st.session_state.access_token}"},
-            json={
-                "message": message,
-                "username": st.session_state.username,
-                "conversation_id": st.session_state.conversation_id
-            },
-            stream=True
-        ) as response:
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data = line[6:]
-                            if data == '[DONE]':
-                                break
-                            try:
-                                response_data = json.loads(data)
-                                if 'error' in response_data:
-                                    error_msg = response_data['error']
-                                    if handle_api_error(error_msg):
-                                        return
-                                process_response(response_data)
-                            except json.JSONDecodeError:
-                                continue
-            else:
-                error_data = response.json()
-                st.error(f"Error: {error_data.get('detail', 'Unknown error occurred')}")
+        for attempt in range(MAX_STREAM_RESUMES + 1):
+            try:
+                with open_chat_stream(message, idempotency_key, stream_state) as response:
+                    if response.status_code == 200:
+                        read_chat_stream(response, stream_state)
+                    elif response.status_code == 409 and attempt < MAX_STREAM_RESUMES:
+                        # Another backend worker is still answering this message; wait and replay it
+                        time.sleep(int(response.headers.get('Retry-After', 1)))
+                        continue
+                    elif response.status_code in (409, 429, 503):
+                        handle_rate_limited(response)
+                    else:
+                        error_data = response.json()
+                        st.error(f"Error: {error_data.get('detail', 'Unknown error occurred')}")
+                return
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+                # Without an event ID or idempotency key a retry would pay for a second answer
+                can_resume = stream_state['last_event_id'] or idempotency_key
+                if attempt == MAX_STREAM_RESUMES or not can_resume:
+                    raise
+                print(f"Frontend: Chat stream interrupted, resuming (attempt {attempt + 1})")
+                time.sleep(1)
             
     except requests.exceptions.RequestException as e:
         st.error("Network error. Please check your connection and try again.")
@@ -284,6 +341,7 @@ def send_message():
         
     # Store message and show spinner
     st.session_state.pending_message = st.session_state.user_input.strip()
+    st.session_state.pending_message_key = str(uuid.uuid4())
     st.session_state.user_input = ""
     st.session_state.is_loading = True
     st.rerun()
@@ -305,8 +363,12 @@ def render_chat_interface():
                 st.empty()
                 # Process message if we have one pending
                 if st.session_state.pending_message:
-                    process_message(st.session_state.pending_message)
+                    process_message(
+                        st.session_state.pending_message,
+                        st.session_state.get('pending_message_key')
+                    )
                     st.session_state.pending_message = None
+                    st.session_state.pending_message_key = None
                     st.session_state.is_loading = False
                     st.rerun()
         